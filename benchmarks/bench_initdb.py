@@ -0,0 +1,88 @@
+"""
+Benchmark: loading our data with initdb.py, the ORM way vs. COPY.
+
+We make a folder with a copy of our CSVs, where the product sheet has been
+blown up to --products rows (our real products over and over, with a
+number on the end of each name), and time
+
+    $ python initdb.py -loader orm  -data <that folder>
+    $ python initdb.py -loader copy -data <that folder>
+
+For each one we print how long it took and the most memory the initdb.py
+process used (its peak "resident set size").
+
+WARNING: this runs initdb.py for real - it drops and reloads the tables in
+our database. When it's done we load our real data again with
+`python initdb.py`.
+
+to run (from the repo's top folder):
+    $ python benchmarks/bench_initdb.py
+    $ python benchmarks/bench_initdb.py --products 1000000 --loaders copy
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATA_DIR = os.path.join(REPO_DIR, "data")
+
+
+def make_data_dir(folder, products):
+    """ Copy our CSVs into folder, with products rows in the product sheet """
+    for name in ("company", "address", "facility", "locations"):
+        shutil.copy(os.path.join(DATA_DIR, f"{name}.csv"), folder)
+
+    # written one copy of our products at a time, so this process stays
+    # small - a child process starts out with a copy of its parent's memory,
+    # and we don't want that counted in initdb.py's peak memory
+    df_products = pd.read_csv(os.path.join(DATA_DIR, "product.csv"))
+    product_path = os.path.join(folder, "product.csv")
+    for copy_number, start in enumerate(range(0, products, len(df_products))):
+        df_copy = df_products.iloc[:products - start].copy()
+        df_copy["name"] = df_copy["name"] + f" #{copy_number}"
+        df_copy.to_csv(product_path, index=False, header=copy_number == 0,
+                       mode="w" if copy_number == 0 else "a")
+
+
+def run_initdb(*args):
+    """ Run initdb.py, return (seconds, peak memory in MB) """
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "initdb.py", *args], cwd=REPO_DIR,
+                               stdout=subprocess.DEVNULL)
+    # wait4 gives us the resource usage of just this process
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - started
+    if status != 0:
+        raise RuntimeError(f"initdb.py {' '.join(args)} failed")
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return seconds, usage.ru_maxrss / scale
+
+
+def run(products, loaders):
+    with tempfile.TemporaryDirectory() as folder:
+        make_data_dir(folder, products)
+        print(f"{products} products")
+        print(f"{'loader':<8} {'seconds':>10} {'rows/s':>12} {'peak MB':>10}")
+        for loader in loaders:
+            seconds, megabytes = run_initdb("-loader", loader, "-data", folder)
+            print(f"{loader:<8} {seconds:>10.2f} {products / seconds:>12,.0f} {megabytes:>10.1f}")
+
+    print("Reloading our real data")
+    run_initdb()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="compare initdb.py loaders")
+    arg_parser.add_argument("--products", type=int, default=100000,
+                            help="how many rows the product sheet should have")
+    arg_parser.add_argument("--loaders", nargs="+", choices=["orm", "copy"],
+                            default=["orm", "copy"], help="which loaders to time")
+    args = arg_parser.parse_args()
+    run(args.products, args.loaders)
@@ -0,0 +1,81 @@
+"""
+Benchmark: BetterModel.to_dict, the old way vs. the compiled way.
+
+The old to_dict looked up every column name on the table and called
+getattr for each one, every time. The compiled one (see compile_to_dict in
+model.py) is written once per class with the column names baked in and
+reads loaded values straight out of the object's __dict__.
+
+We don't need a database for this - we make objects in memory, fill in
+every column, and serialize them over and over.
+
+to run (from the repo's top folder):
+    $ python benchmarks/bench_serializers.py
+    $ python benchmarks/bench_serializers.py --objects 50000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+# let us import model.py from the folder above this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from model import Company, Facility, Address, Product
+
+
+def old_to_dict(obj):
+    """ BetterModel.to_dict as it used to be """
+    return { name : getattr(obj, name) for name in obj.__table__.columns.keys() }
+
+
+def sample_value(column, number):
+    """ Something that fits in column """
+    python_type = column.type.python_type
+    if python_type is bool:
+        return number % 2 == 0
+    if python_type is int:
+        return number
+    if python_type is float:
+        return number / 7
+    return f"{column.key} {number}"
+
+
+def make_objects(model_class, count):
+    objects = []
+    for number in range(count):
+        fields = { column.key: sample_value(column, number)
+                   for column in model_class.__table__.columns
+                   if column.info.get("serialize", True) }
+        objects.append(model_class(**fields))
+    return objects
+
+
+def run(count, repeat):
+    print(f"{'model':<10} {'old to_dict':>14} {'compiled':>14} {'speedup':>8}")
+    for model_class in (Company, Facility, Address, Product):
+        objects = make_objects(model_class, count)
+
+        # both ways have to give the same answer (minus columns we hide)
+        expected = [ { name: value for name, value in old_to_dict(obj).items()
+                       if name in model_class.column_names() } for obj in objects[:10] ]
+        assert expected == [obj.to_dict() for obj in objects[:10]]
+
+        old = min(timeit.repeat(lambda: [old_to_dict(obj) for obj in objects],
+                                number=1, repeat=repeat))
+        new = min(timeit.repeat(lambda: [obj.to_dict() for obj in objects],
+                                number=1, repeat=repeat))
+
+        per_object = lambda seconds: f"{seconds / count * 1e6:.2f} us/obj"
+        print(f"{model_class.__name__:<10} {per_object(old):>14} {per_object(new):>14} "
+              f"{old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="compare to_dict implementations")
+    arg_parser.add_argument("--objects", type=int, default=10000,
+                            help="how many objects of each model to serialize")
+    arg_parser.add_argument("--repeat", type=int, default=5,
+                            help="how many times to time it (we keep the fastest)")
+    args = arg_parser.parse_args()
+    run(args.objects, args.repeat)
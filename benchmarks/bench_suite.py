@@ -0,0 +1,386 @@
+"""
+Benchmark suite: how long loading, searching and serializing take with
+made-up data the size we ask for (see make_data.py), written down in
+benchmarks/results.jsonl so we can see when a change makes things slower.
+
+Three groups of benchmarks:
+  * import     - initdb.py loading the sheets into the database
+  * search     - search_page (search.py) for a list of searches, with
+                 PostgreSQL full-text search and with our in-memory index
+                 (search_index.py), and building that index
+  * serialize  - to_dict (model.py), product_result (serializers.py) and
+                 turning the results into JSON
+
+Where the data lives (--database):
+  * postgres - our real database (DATABASE_URL, see db_utils/engine.py).
+               WARNING: like bench_initdb.py this drops and reloads our
+               tables, and loads our real data again when it's done.
+  * memory   - no database at all: we read and clean the sheets like
+               initdb.py does (that's "import"), make model objects
+               ourselves, and search them with the in-memory index. Our
+               tables need PostgreSQL (full-text search columns, COPY), so
+               this stands in for it when there's no PostgreSQL around.
+
+Every run is added to benchmarks/results.jsonl with the git commit it ran
+on, and compared with the last run with the same --database, --products
+and computer - anything that got more than --threshold slower is marked
+REGRESSION (and with --fail-on-regression we exit with an error, for CI).
+Timings are the median of --repeat runs. results.jsonl stays on your
+computer (it's in .gitignore) - numbers from one computer can't be compared
+with another's.
+
+to run (from the repo's top folder):
+    $ python benchmarks/bench_suite.py --products 100000
+    $ python benchmarks/bench_suite.py --products 1000000 --database memory
+    $ python benchmarks/bench_suite.py --data /tmp/farms_100k --only search serialize
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCHMARKS_DIR, "..")
+RESULTS_PATH = os.path.join(BENCHMARKS_DIR, "results.jsonl")
+
+# let us import the repo's modules and the other benchmarks
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from bench_initdb import run_initdb
+from make_data import make_data
+
+GROUPS = ("import", "search", "serialize")
+
+# what people search for: single words, two words, a company, and a
+# misspelling (which makes search.py try fixing the spelling)
+SEARCHES = ("lettuce", "basil", "kale", "strawberries", "microgreens", "salad greens",
+            "spicy mix", "gotham greens", "arugla")
+
+
+#####################################################################
+# Timing
+#####################################################################
+
+def median_seconds(function, repeat: int):
+    """ The median time function() takes, over repeat calls """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def percentile(values, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def time_searches(search, repeat: int):
+    """ p50/p95 milliseconds of search(words) over SEARCHES, each repeat times """
+    times = []
+    for _ in range(repeat):
+        for words in SEARCHES:
+            started = time.perf_counter()
+            search(words)
+            times.append(time.perf_counter() - started)
+    return percentile(times, 0.5) * 1000, percentile(times, 0.95) * 1000
+
+
+def time_serializing(products, repeat: int):
+    """ Microseconds per product to to_dict, product_result and JSON encode products """
+    from serializers import SubtreeCache, product_result
+
+    def make_results():
+        # a new SubtreeCache each time, like the first search after a reload
+        subtrees = SubtreeCache()
+        return [ product_result(product, subtrees) for product in products ]
+
+    count = max(1, len(products))
+    results = make_results()
+    return {
+        "serialize_to_dict_us": median_seconds(
+            lambda: [ product.to_dict() for product in products ], repeat) / count * 1e6,
+        "serialize_product_result_us": median_seconds(make_results, repeat) / count * 1e6,
+        "serialize_json_us": median_seconds(lambda: json.dumps(results), repeat) / count * 1e6,
+    }
+
+
+#####################################################################
+# With PostgreSQL
+#####################################################################
+
+def postgres_benchmarks(data_dir: str, groups, repeat: int, serialize_limit: int, loaders):
+    """ Returns the results and how many products the database had """
+    results = {}
+    if "import" in groups:
+        for loader in loaders:
+            print(f"  initdb.py -loader {loader}")
+            seconds, megabytes = run_initdb("-loader", loader, "-data", data_dir)
+            results[f"import_{loader}_seconds"] = seconds
+            results[f"import_{loader}_peak_mb"] = megabytes
+    else:
+        print("  (using what's in the database now for search and serialize)")
+
+    from server import app, suggest_index
+    from model import Product
+    from db_utils import count_queries
+    from search import search_page
+    from search_index import SearchIndex
+    from serializers import SubtreeCache
+
+    with app.app_context():
+        product_count = Product.query.count()
+        if "search" in groups:
+            print("  search")
+            suggest_index.rebuild()
+            subtrees = SubtreeCache()
+            query_counts = []
+
+            def fulltext(words):
+                with count_queries() as counter:
+                    search_page(words, None, suggest_index, None, 50, None, subtrees)
+                query_counts.append(counter.count)
+
+            fulltext("warm up")
+            query_counts.clear()
+            p50, p95 = time_searches(fulltext, repeat)
+            results.update(search_fulltext_p50_ms=p50, search_fulltext_p95_ms=p95,
+                           search_fulltext_queries=max(query_counts))
+
+            index = SearchIndex()
+            index.rebuild()
+            # (not counting the memory use rebuild prints, which takes a while)
+            results["search_index_build_seconds"] = index.build_seconds
+            p50, p95 = time_searches(
+                lambda words: search_page(words, index, None, None, 50), repeat)
+            results.update(search_memory_p50_ms=p50, search_memory_p95_ms=p95)
+
+        if "serialize" in groups:
+            print("  serialize")
+            started = time.perf_counter()
+            products = Product.query.order_by(Product.id).limit(serialize_limit).all()
+            results["serialize_load_seconds"] = time.perf_counter() - started
+            results.update(time_serializing(products, repeat))
+    return results, product_count
+
+
+#####################################################################
+# Without a database
+#####################################################################
+
+def make_objects(data_dir: str):
+    """
+    Our model objects for the sheets in data_dir, linked up like initdb.py
+    links them, but never saved anywhere. Returns the products.
+    """
+    import pandas as pd
+    from model import db, Address, Company, Facility, Product
+    from db_utils import get_matching_column_names
+    from db_utils.clean import read_sheet
+    from db_utils.row_sync import records
+
+    tables = db.metadata.tables
+    sheets = { name: read_sheet(os.path.join(data_dir, f"{name}.csv"), tables[name])
+               for name in ("company", "address", "facility", "product") }
+    locations = pd.read_csv(os.path.join(data_dir, "locations.csv"))
+    sheets["address"] = sheets["address"].merge(locations, on="nickname", how="left")
+
+    def rows(name):
+        df = sheets[name]
+        columns = get_matching_column_names(df, name, db)
+        return zip(records(df[columns]), df.to_dict("records"))
+
+    companies = {}
+    for number, (fields, row) in enumerate(rows("company"), start=1):
+        companies.setdefault(row["trade_name"], Company(id=number, **fields))
+
+    addresses = {}
+    for number, (fields, row) in enumerate(rows("address"), start=1):
+        address = Address(id=number, **fields)
+        addresses.setdefault(row["nickname"], address)
+        company = companies.get(row["company_trade_name"])
+        if company is not None and row["make_default"] == True and company.address is None:
+            company.address = address
+
+    for number, (fields, row) in enumerate(rows("facility"), start=1):
+        company = companies.get(row["company_trade_name"])
+        if company is not None:
+            Facility(id=number, company=company, address=addresses.get(row["nickname"]), **fields)
+
+    products = []
+    for number, (fields, row) in enumerate(rows("product"), start=1):
+        company = companies.get(row["company_trade_name"])
+        if company is not None:
+            products.append(Product(id=number, company=company, **fields))
+    return products
+
+
+def memory_benchmarks(data_dir: str, groups, repeat: int, serialize_limit: int):
+    from search import search_page
+    from search_index import SearchIndex
+
+    results = {}
+    print("  reading the sheets and making objects")
+    started = time.perf_counter()
+    products = make_objects(data_dir)
+    results["import_memory_seconds"] = time.perf_counter() - started
+
+    if "search" in groups:
+        print("  search")
+        # what SearchIndex.build does, with our objects instead of a query
+        index = SearchIndex()
+        started = time.perf_counter()
+        index.build_from(products)
+        index.stale = False
+        results["search_index_build_seconds"] = time.perf_counter() - started
+        p50, p95 = time_searches(
+            lambda words: search_page(words, index, None, None, 50), repeat)
+        results.update(search_memory_p50_ms=p50, search_memory_p95_ms=p95)
+
+    if "serialize" in groups:
+        print("  serialize")
+        results.update(time_serializing(products[:serialize_limit], repeat))
+    return results
+
+
+#####################################################################
+# Writing down results
+#####################################################################
+
+def git_commit():
+    """ The commit we're running on, with "+changes" if there are uncommitted changes """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changed = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                 cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}+changes" if changed else commit
+
+
+def read_results(path: str=RESULTS_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [ json.loads(line) for line in file if line.strip() ]
+
+
+def save_result(run: dict, path: str=RESULTS_PATH):
+    with open(path, "a") as file:
+        file.write(json.dumps(run, sort_keys=True) + "\n")
+
+
+def same_setup(run: dict, other: dict):
+    return all(run[key] == other.get(key) for key in ("database", "products", "seed", "machine"))
+
+
+def compare(run: dict, previous: dict, threshold: float):
+    """ Print run's results next to previous's, return the names that got slower than threshold """
+    regressions = []
+    print(f"{'benchmark':<32} {'before':>12} {'now':>12} {'change':>9}")
+    for name, value in sorted(run["results"].items()):
+        before = previous["results"].get(name) if previous else None
+        change = (value - before) / before if before else None
+        # every number we record is better when it's smaller
+        flag = ""
+        if change is not None and change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<32} {_format(before):>12} {_format(value):>12} "
+              f"{'' if change is None else f'{change:+.0%}':>9}{flag}")
+    return regressions
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    if isinstance(value, int):
+        return f"{value:,}"
+    return f"{value:,.0f}" if value >= 100 else f"{value:.3f}"
+
+
+#####################################################################
+# Running everything
+#####################################################################
+
+def run(args):
+    groups = args.only or GROUPS
+    # without import, the postgres benchmarks use whatever is in the database
+    needs_sheets = args.database == "memory" or "import" in groups
+    with tempfile.TemporaryDirectory() as folder:
+        data_dir = args.data
+        # what we write down as the size of the data: how many products,
+        # or the folder of sheets we were given
+        products = f"data:{os.path.abspath(data_dir)}" if data_dir else args.products
+        seed = args.seed if data_dir is None and needs_sheets else None
+        if data_dir is None and needs_sheets:
+            data_dir = folder
+            print(f"Making {args.products} products (seed {args.seed})")
+            products = make_data(folder, args.products, args.seed)["product"]
+
+        print(f"Running {', '.join(groups)} on {args.database}")
+        if args.database == "postgres":
+            results, product_count = postgres_benchmarks(data_dir, groups, args.repeat,
+                                                         args.serialize_limit, args.loaders)
+            if not needs_sheets:
+                products = f"database:{product_count}"
+        else:
+            results = memory_benchmarks(data_dir, groups, args.repeat, args.serialize_limit)
+
+    if args.database == "postgres" and "import" in groups:
+        print("Reloading our real data")
+        run_initdb()
+
+    this_run = {
+        "run_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "database": args.database,
+        "products": products,
+        "seed": seed,
+        "machine": f"{platform.node()} {platform.machine()} python {platform.python_version()}",
+        "results": { name: round(value, 4) for name, value in results.items() },
+    }
+    earlier = [ other for other in read_results(args.results) if same_setup(this_run, other) ]
+    previous = earlier[-1] if earlier else None
+    print()
+    print(f"Compared with {previous['commit']} ({previous['run_at']})" if previous
+          else "Nothing to compare with yet")
+    regressions = compare(this_run, previous, args.threshold)
+    save_result(this_run, args.results)
+    print(f"Saved to {args.results}")
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="time import, search and serialization")
+    arg_parser.add_argument("--products", type=int, default=100000,
+                            help="how many made-up products (see make_data.py)")
+    arg_parser.add_argument("--seed", type=int, default=1)
+    arg_parser.add_argument("--data", help="use the sheets in this folder instead of making some")
+    arg_parser.add_argument("--database", choices=["postgres", "memory"], default="postgres")
+    arg_parser.add_argument("--only", nargs="+", choices=GROUPS, help="just these benchmarks")
+    arg_parser.add_argument("--loaders", nargs="+", choices=["orm", "copy", "sync"],
+                            default=["copy"], help="initdb.py loaders to time")
+    arg_parser.add_argument("--repeat", type=int, default=5,
+                            help="how many times to time each thing (we keep the median)")
+    arg_parser.add_argument("--serialize-limit", type=int, default=10000,
+                            help="how many products to serialize")
+    arg_parser.add_argument("--threshold", type=float, default=0.2,
+                            help="how much slower counts as a regression (0.2 = 20%%)")
+    arg_parser.add_argument("--results", default=RESULTS_PATH, help="where to write down results")
+    arg_parser.add_argument("--fail-on-regression", action="store_true",
+                            help="exit with an error if anything got slower than --threshold")
+    args = arg_parser.parse_args()
+
+    regressions = run(args)
+    if regressions and args.fail_on_regression:
+        raise SystemExit(f"Slower than before: {', '.join(regressions)}")
@@ -0,0 +1,182 @@
+"""
+Make a folder of made-up sheets (company, address, facility, product and
+locations CSVs) that look like ours, only bigger - for timing initdb.py,
+searches and serialization with as many products as we might have one day.
+
+    $ python benchmarks/make_data.py --products 100000 --out /tmp/farms_100k
+    $ python initdb.py -loader copy -data /tmp/farms_100k
+
+How the made-up data stays like ours:
+  * every made-up company is a copy of one of our real companies (picked
+    at random), with a made-up word in front of its trade name -
+    "Kalomi Gotham Greens". It gets copies of that company's addresses,
+    facilities and locations, so companies have as many addresses and
+    facilities as ours do, and they're farms and offices in the same
+    proportions
+  * it gets as many products as its real company has, each a copy of one
+    of our products picked at random (so "lettuce" matches about as big a
+    share of the products as it does now), and no two with the same name
+  * nicknames get the made-up trade name in front, so facilities still
+    find their address by nickname, and map locations are moved a few
+    kilometers so farms don't all sit on top of each other
+  * the columns are exactly the ones in our sheets, and rows are linked by
+    company_trade_name like ours
+
+The same --seed makes the same sheets, so benchmark runs are comparable.
+Rows are written as they're made, a company at a time, so 10 million
+products doesn't need 10 million rows in memory.
+"""
+import argparse
+import csv
+import os
+import random
+import time
+
+import pandas as pd
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATA_DIR = os.path.join(REPO_DIR, "data")
+
+SHEETS = ("company", "address", "facility", "product", "locations")
+
+# made-up trade name words are made of these - "ka" "lo" "mi" -> "Kalomi"
+SYLLABLES = ("ka", "lo", "mi", "ra", "ve", "su", "to", "ne", "bi", "da", "fe", "go",
+             "hu", "ji", "po", "ze", "ly", "an", "or", "el")
+
+# how far (in degrees, about 11km per 0.1) made-up locations are moved
+LOCATION_JITTER = 0.05
+
+
+def made_up_word(number: int):
+    """ A different word for every number: 0 -> "Ka", 1 -> "Lo", 20 -> "Loka" ... """
+    syllables = []
+    while True:
+        number, digit = divmod(number, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+        if number == 0:
+            break
+        number -= 1
+    return "".join(reversed(syllables)).capitalize()
+
+
+def read_real_sheets(data_dir: str=DATA_DIR):
+    """ Our sheets, as text exactly as it is in the CSVs ("" for blanks) """
+    return { name: pd.read_csv(os.path.join(data_dir, f"{name}.csv"), dtype=str,
+                               keep_default_na=False)
+             for name in SHEETS }
+
+
+class Templates(object):
+    """ Our real rows, grouped by company, ready to be copied """
+
+    def __init__(self, sheets: dict):
+        self.columns = { name: list(df.columns) for name, df in sheets.items() }
+        self.companies = sheets["company"].to_dict("records")
+
+        def by_company(df):
+            grouped = {}
+            for row in df.to_dict("records"):
+                grouped.setdefault(row["company_trade_name"], []).append(row)
+            return grouped
+
+        self.addresses = by_company(sheets["address"])
+        self.facilities = by_company(sheets["facility"])
+        self.product_counts = sheets["product"]["company_trade_name"].value_counts().to_dict()
+        self.products = sheets["product"].to_dict("records")
+        self.locations = { row["nickname"]: row for row in sheets["locations"].to_dict("records") }
+
+
+def jitter(value: str, limit: float, rng: random.Random):
+    """ A coordinate moved a little """
+    moved = float(value) + rng.uniform(-LOCATION_JITTER, LOCATION_JITTER)
+    return max(-limit, min(limit, moved))
+
+
+def make_company(number: int, templates: Templates, rng: random.Random, max_products: int):
+    """ One made-up company: {sheet name: [rows]} """
+    company = dict(rng.choice(templates.companies))
+    real_name = company["trade_name"]
+    trade_name = f"{made_up_word(number)} {real_name}"
+    company["trade_name"] = trade_name
+    if company.get("legal_name"):
+        company["legal_name"] = f"{made_up_word(number)} {company['legal_name']}"
+    if company.get("website"):
+        company["website"] = f"https://www.{made_up_word(number).lower()}.example/"
+    rows = {"company": [company], "address": [], "facility": [], "product": [], "locations": []}
+
+    def nickname(real_nickname):
+        # "BrightFarms CAR Greenhouse" -> "Ka BrightFarms CAR Greenhouse"
+        if real_nickname.startswith(real_name):
+            real_nickname = real_nickname[len(real_name):].lstrip()
+        return f"{trade_name} {real_nickname}"[:75]
+
+    for address in templates.addresses.get(real_name, []):
+        rows["address"].append(dict(address, company_trade_name=trade_name,
+                                    nickname=nickname(address["nickname"])))
+        location = templates.locations.get(address["nickname"])
+        if location is not None:
+            rows["locations"].append(dict(location, nickname=nickname(address["nickname"]),
+                                          latitude=jitter(location["latitude"], 90, rng),
+                                          longitude=jitter(location["longitude"], 180, rng)))
+    for facility in templates.facilities.get(real_name, []):
+        rows["facility"].append(dict(facility, company_trade_name=trade_name,
+                                     nickname=nickname(facility["nickname"])))
+
+    names = set()
+    for _ in range(min(templates.product_counts.get(real_name, 0), max_products)):
+        product = dict(rng.choice(templates.products), company_trade_name=trade_name)
+        # a company has each product name once (it's how initdb.py tells
+        # products apart) - another "Basil" becomes "Basil 2"
+        name, copy_number = product["name"], 1
+        while product["name"] in names:
+            copy_number += 1
+            product["name"] = f"{name} {copy_number}"
+        names.add(product["name"])
+        rows["product"].append(product)
+    return rows
+
+
+def make_data(out_dir: str, products: int, seed: int=1, data_dir: str=DATA_DIR):
+    """ Write made-up sheets with products product rows to out_dir, return the row counts """
+    templates = Templates(read_real_sheets(data_dir))
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    files = { name: open(os.path.join(out_dir, f"{name}.csv"), "w", newline="")
+              for name in SHEETS }
+    try:
+        writers = {}
+        for name, file in files.items():
+            # our sheets quote every value, so do we (gc.py leaves the
+            # numbers in locations.csv unquoted)
+            quoting = csv.QUOTE_NONNUMERIC if name == "locations" else csv.QUOTE_ALL
+            writers[name] = csv.DictWriter(file, templates.columns[name], quoting=quoting,
+                                           lineterminator="\n")
+            writers[name].writeheader()
+
+        counts = dict.fromkeys(SHEETS, 0)
+        number = 0
+        while counts["product"] < products:
+            rows = make_company(number, templates, rng, products - counts["product"])
+            for name, sheet_rows in rows.items():
+                writers[name].writerows(sheet_rows)
+                counts[name] += len(sheet_rows)
+            number += 1
+    finally:
+        for file in files.values():
+            file.close()
+    return counts
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="make big made-up sheets like ours")
+    arg_parser.add_argument("--products", type=int, default=10000,
+                            help="how many rows the product sheet should have")
+    arg_parser.add_argument("--out", required=True, help="folder to write the CSVs to")
+    arg_parser.add_argument("--seed", type=int, default=1,
+                            help="the same seed makes the same sheets")
+    args = arg_parser.parse_args()
+
+    started = time.perf_counter()
+    counts = make_data(args.out, args.products, args.seed)
+    print(f"Wrote {counts} to {args.out} in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,216 @@
+"""
+Clustering farms for the map.
+
+When the map is zoomed out over a whole country there can be thousands of
+farms on screen - too many to send to the browser, and too many icons on
+top of each other to see anything. So instead of one point per farm we
+send clusters: "37 farms around here", at a spot in the middle of them.
+
+We work the clusters out ahead of time for every zoom level. Web maps
+split the world into square tiles (256 pixels on a side): 1 tile at zoom
+0, 2 x 2 tiles at zoom 1, 4 x 4 at zoom 2 and so on. We split each tile
+into a CELLS_PER_TILE x CELLS_PER_TILE grid, and every farm in the same
+grid cell is one cluster at that zoom. One cell at zoom z is exactly four
+cells at zoom z + 1, so we only place the farms once (at MAX_ZOOM) and
+then build each zoom level out by adding up the four cells under each
+cell of the level below it:
+
+    zoom 3   [ 12 ]
+    zoom 4   [ 5 ][ 0 ]
+             [ 4 ][ 3 ]
+
+Every cluster also counts its farms by state (or country, when there's no
+state), which is what our Data Maps view shows.
+
+to use:
+    index = ClusterIndex()
+    index.rebuild()              # needs an app context, reads our tables
+    clusters = index.clusters(zoom=5, south=38, west=-80, north=44, east=-70)
+    print(index.stats())
+
+https://docs.mapbox.com/help/glossary/zoom-level/
+"""
+from db_utils.rebuildable import Rebuildable
+from model import db, Address, Facility
+import math
+
+
+# zoom levels go from 0 (the whole world) to MAX_ZOOM (a few streets), past
+# that we just keep using MAX_ZOOM
+MAX_ZOOM = 16
+# 4 cells per 256 pixel tile - each cluster covers 64 x 64 pixels on screen
+CELLS_PER_TILE = 4
+# small clusters also list their facility ids, so clicking one can show
+# the farms in it without asking again
+MAX_LISTED_FACILITIES = 10
+# web maps can't show the poles, their maps stop at this latitude
+MAX_LATITUDE = 85.05112878
+
+
+def world_xy(latitude: float, longitude: float):
+    """
+    Where a point is on a square map of the whole world (Web Mercator),
+    from (0, 0) at the top left to (1, 1) at the bottom right
+    """
+    latitude = max(-MAX_LATITUDE, min(latitude, MAX_LATITUDE))
+    x = (longitude + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(latitude))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def cells_across(zoom: int):
+    """ How many grid cells wide (and tall) the world is at zoom """
+    return CELLS_PER_TILE * 2 ** zoom
+
+
+def region_of(state, country):
+    """ What we count a farm under in a cluster's regions """
+    return state or country or "unknown"
+
+
+class Cluster(object):
+    __slots__ = ("count", "latitude_sum", "longitude_sum", "regions", "facility_ids")
+
+    def __init__(self):
+        self.count = 0
+        self.latitude_sum = 0.0
+        self.longitude_sum = 0.0
+        # region -> how many farms
+        self.regions = {}
+        # None once there are too many to list
+        self.facility_ids = []
+
+    def add_facility(self, facility_id, latitude, longitude, region):
+        self.count += 1
+        self.latitude_sum += latitude
+        self.longitude_sum += longitude
+        self.regions[region] = self.regions.get(region, 0) + 1
+        self._add_ids([facility_id])
+
+    def add_cluster(self, other):
+        self.count += other.count
+        self.latitude_sum += other.latitude_sum
+        self.longitude_sum += other.longitude_sum
+        for region, count in other.regions.items():
+            self.regions[region] = self.regions.get(region, 0) + count
+        self._add_ids(other.facility_ids)
+
+    def _add_ids(self, facility_ids):
+        if self.facility_ids is None or facility_ids is None:
+            self.facility_ids = None
+        elif self.count > MAX_LISTED_FACILITIES:
+            self.facility_ids = None
+        else:
+            self.facility_ids.extend(facility_ids)
+
+    def to_dict(self, zoom, column, row):
+        cluster = {
+            "id": f"{zoom}/{column}/{row}",
+            "count": self.count,
+            # the middle of the cluster's farms (not of its grid cell), so
+            # a cluster of one farm sits right on that farm
+            "latitude": self.latitude_sum / self.count,
+            "longitude": self.longitude_sum / self.count,
+            "regions": self.regions,
+        }
+        if self.facility_ids is not None:
+            cluster["facility_ids"] = sorted(self.facility_ids)
+        return cluster
+
+
+class ClusterIndex(Rebuildable):
+
+    label = "cluster index"
+
+    def __init__(self, max_zoom: int=MAX_ZOOM):
+        super().__init__()
+        self.max_zoom = max_zoom
+        # one dict per zoom level: (column, row) -> Cluster
+        self.levels = [{} for zoom in range(max_zoom + 1)]
+        self.facilities = 0
+
+    def build(self):
+        """
+        Read the location of every facility and build the clusters for
+        every zoom level. Like SearchIndex.build, the new levels are
+        swapped in all at once.
+        """
+        # one small row per facility, no need for whole model objects
+        rows = (db.session.query(Facility.id, Address.latitude, Address.longitude,
+                                 Address.state, Address.country)
+                .join(Facility.address)
+                .filter(Address.latitude.isnot(None), Address.longitude.isnot(None))
+                .order_by(Facility.id)
+                .all())
+
+        finest = {}
+        across = cells_across(self.max_zoom)
+        for facility_id, latitude, longitude, state, country in rows:
+            if math.isnan(latitude) or math.isnan(longitude):
+                continue
+            x, y = world_xy(latitude, longitude)
+            cell = (min(int(x * across), across - 1), min(int(y * across), across - 1))
+            cluster = finest.get(cell)
+            if cluster is None:
+                cluster = finest[cell] = Cluster()
+            cluster.add_facility(facility_id, latitude, longitude, region_of(state, country))
+
+        levels = [finest]
+        for zoom in range(self.max_zoom - 1, -1, -1):
+            level = {}
+            for (column, row), child in levels[0].items():
+                parent = level.get((column // 2, row // 2))
+                if parent is None:
+                    parent = level[(column // 2, row // 2)] = Cluster()
+                parent.add_cluster(child)
+            levels.insert(0, level)
+
+        self.levels = levels
+        self.facilities = sum(cluster.count for cluster in levels[0].values())
+
+    def clusters(self, zoom: float, south: float, west: float, north: float, east: float):
+        """
+        The clusters at zoom whose grid cell is inside the box between
+        south/north latitude and west/east longitude, biggest first
+        """
+        zoom = max(0, min(int(zoom), self.max_zoom))
+        level = self.levels[zoom]
+        across = cells_across(zoom)
+
+        def cell_range(low, high):
+            return range(max(int(low * across), 0), min(int(high * across), across - 1) + 1)
+
+        left, top = world_xy(north, west)
+        right, bottom = world_xy(south, east)
+        rows = cell_range(top, bottom)
+        if west <= east:
+            column_ranges = [cell_range(left, right)]
+        else:
+            # the box crosses the date line (180 degrees)
+            column_ranges = [cell_range(left, 1.0), cell_range(0.0, right)]
+
+        found = []
+        for columns in column_ranges:
+            if len(columns) * len(rows) <= len(level):
+                # look up each cell on screen
+                for column in columns:
+                    for row in rows:
+                        cluster = level.get((column, row))
+                        if cluster is not None:
+                            found.append(cluster.to_dict(zoom, column, row))
+            else:
+                # the box is mostly empty cells, check each cluster instead
+                for (column, row), cluster in level.items():
+                    if column in columns and row in rows:
+                        found.append(cluster.to_dict(zoom, column, row))
+        found.sort(key=lambda cluster: (-cluster["count"], cluster["id"]))
+        return found
+
+    def stats(self):
+        """ How many clusters each zoom level has and how long they took to build """
+        return {
+            "facilities": self.facilities,
+            "clusters_per_zoom": [len(level) for level in self.levels],
+            **super().stats(),
+        }
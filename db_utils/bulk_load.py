@@ -0,0 +1,108 @@
+"""
+Loading pandas DataFrames into PostgreSQL with COPY.
+
+Making one model object per row and letting SQLAlchemy INSERT them one at
+a time is fine for a few hundred rows, but slow for a lot of them - every
+row is its own INSERT ... RETURNING id, and every object stays in the
+session until we commit. PostgreSQL's COPY command instead takes a whole
+table's worth of rows as one stream of CSV text:
+
+    COPY product (id, company_id, name, ...) FROM STDIN WITH (FORMAT csv)
+    1,4,Arugula,...
+    2,4,Basil,...
+
+psycopg2 sends it with cursor.copy_expert(sql, file), reading the CSV from
+any object that has a read() method - so we hand it a DataFrameReader that
+writes the CSV a chunk of rows at a time, instead of making one big string.
+
+Since nothing comes back from COPY, we pick the ids ourselves (see
+add_ids) and tell PostgreSQL afterwards where to continue counting
+(reset_id_sequence).
+
+https://www.postgresql.org/docs/current/sql-copy.html
+https://www.psycopg.org/docs/cursor.html#cursor.copy_expert
+"""
+import numpy as np
+import pandas as pd
+
+from db_utils.clean import convert_column
+
+
+def add_ids(df, first_id: int=1):
+    """ df with an "id" column numbering its rows from first_id """
+    df = df.copy()
+    df["id"] = np.arange(first_id, first_id + len(df), dtype="int64")
+    return df
+
+
+def frame_for_table(df, table, columns=None):
+    """
+    Just the columns of df that table has (or just columns), each converted
+    to something PostgreSQL will read as the table column's type (see
+    db_utils/clean.py). For example a pandas float column holding 12.0 and
+    NaN becomes an integer column holding 12 and <NA>, which COPY gets as
+    12 and NULL.
+    """
+    if columns is None:
+        columns = [ column.name for column in table.columns if column.name in df.columns ]
+
+    frame = pd.DataFrame(index=df.index)
+    for name in columns:
+        frame[name] = convert_column(df[name], table.columns[name].type)
+    return frame
+
+
+class DataFrameReader(object):
+    """
+    A read-only file that holds df as CSV - but only ever makes chunk_rows
+    rows of CSV at a time, however big df is
+    """
+
+    def __init__(self, df, chunk_rows: int=50000):
+        self.df = df
+        self.chunk_rows = chunk_rows
+        self.next_row = 0
+        # the CSV for the current chunk, and how much of it we've handed out
+        self.buffer = ""
+        self.position = 0
+
+    def read(self, size: int=-1):
+        if self.position >= len(self.buffer):
+            if self.next_row >= len(self.df):
+                return ""
+            chunk = self.df.iloc[self.next_row:self.next_row + self.chunk_rows]
+            self.next_row += self.chunk_rows
+            self.buffer = chunk.to_csv(header=False, index=False)
+            self.position = 0
+
+        # psycopg2 asks for a few KB at a time - hand out pieces of the
+        # chunk rather than cutting the rest of it off every time
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        return data
+
+
+def copy_dataframe(cursor, table_name: str, df, chunk_rows: int=50000):
+    """
+    COPY every row of df into table_name, using df's column names as the
+    table's. cursor is a plain psycopg2 cursor (e.g. from
+    engine.raw_connection().cursor()). Returns how many rows went in.
+
+    Blank cells (None, NaN, <NA>) go in as NULL.
+    """
+    if df.empty:
+        return 0
+    column_list = ", ".join(f'"{name}"' for name in df.columns)
+    cursor.copy_expert(f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT csv)',
+                       DataFrameReader(df, chunk_rows))
+    return len(df)
+
+
+def reset_id_sequence(cursor, table_name: str):
+    """
+    We wrote our own ids with COPY, so make the next id PostgreSQL hands
+    out (e.g. for a row added from the website) come after the biggest one
+    """
+    cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+                   f"COALESCE(MAX(id), 0) + 1, false) FROM \"{table_name}\"")
@@ -0,0 +1,97 @@
+"""
+Cleaning our sheets, using the column types of our tables (model.py).
+
+pandas guesses a type for every column of a CSV from what's in it: a column
+of whole numbers with one blank cell comes out as floats (12.0, NaN), a
+column of postal codes comes out as numbers (and loses the 0 in "07102"),
+and a column of "True " / "False " stays text - and bool("False ") is True.
+
+Instead, we look at the table each sheet goes into and convert every column
+the table has to the matching pandas type, one whole column at a time:
+
+    db.Integer  ->  "Int64"    whole numbers, <NA> for blanks
+    db.Float    ->  "float64"  NaN for blanks
+    db.Boolean  ->  "boolean"  "TRUE", "yes", "1"... -> True, <NA> for blanks
+    db.String   ->  text       exactly what's in the cell, None for blanks
+
+Columns the table doesn't have (like company_trade_name) are left alone.
+
+to use:
+    df_company_sheet = read_sheet("./data/company.csv", db.metadata.tables["company"])
+
+Before saving rows with SQLAlchemy, turn <NA> and NaN into None with
+records() (see db_utils/row_sync.py) - psycopg2 knows None means NULL.
+"""
+import pandas as pd
+from sqlalchemy import Boolean, Float, Integer, String
+
+
+BOOLEAN_WORDS = {
+    "true": True, "t": True, "yes": True, "y": True, "1": True,
+    "false": False, "f": False, "no": False, "n": False, "0": False,
+}
+
+
+def column_dtype(column_type):
+    """ The pandas dtype we use for a column of this SQLAlchemy type """
+    if isinstance(column_type, Integer):
+        return "Int64"
+    if isinstance(column_type, Float):
+        return "float64"
+    if isinstance(column_type, Boolean):
+        return "boolean"
+    return "object"
+
+
+def sheet_dtypes(table):
+    """
+    read_csv's dtype argument for a sheet going into table: text columns
+    are read as text, so pandas doesn't turn "07102" into 7102
+    """
+    return { column.name: str for column in table.columns if isinstance(column.type, String) }
+
+
+def convert_column(values: pd.Series, column_type):
+    """ values converted to column_type's pandas dtype (see column_dtype) """
+    if isinstance(column_type, Integer):
+        return pd.to_numeric(values, errors="coerce").round().astype("Int64")
+    if isinstance(column_type, Float):
+        return pd.to_numeric(values, errors="coerce").astype("float64")
+    if isinstance(column_type, Boolean):
+        if pd.api.types.is_bool_dtype(values):
+            return values.astype("boolean")
+        words = values.astype("string").str.strip().str.lower()
+        return words.map(BOOLEAN_WORDS).astype("boolean")
+    # text - anything that isn't blank becomes a str, blanks become None
+    text = values.astype(object)
+    return text.where(text.isna(), text.astype(str)).where(text.notna(), None)
+
+
+def clean_sheet(df: pd.DataFrame, table, columns=None):
+    """
+    A copy of df with each of table's columns (or just columns) converted
+    to its pandas dtype. Prints the cells that had something in them we
+    couldn't convert (they become blank).
+    """
+    if columns is None:
+        columns = [ column.name for column in table.columns if column.name in df.columns ]
+
+    df = df.copy()
+    for name in columns:
+        before = df[name]
+        df[name] = convert_column(before, table.columns[name].type)
+        lost = df[name].isna() & before.notna()
+        if pd.api.types.is_object_dtype(before) or pd.api.types.is_string_dtype(before):
+            # a cell with just spaces in it was blank anyway
+            lost &= before.astype("string").str.strip().fillna("") != ""
+        if lost.any():
+            print(f"   !!! {lost.sum()} {table.name}.{name} values aren't "
+                  f"{column_dtype(table.columns[name].type)}, leaving them blank: "
+                  f"{before[lost].drop_duplicates().tolist()[:5]}")
+    return df
+
+
+def read_sheet(path: str, table, **read_csv_args):
+    """ Read a CSV going into table and clean it (see clean_sheet) """
+    df = pd.read_csv(path, dtype=sheet_dtypes(table), **read_csv_args)
+    return clean_sheet(df, table)
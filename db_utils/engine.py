@@ -0,0 +1,315 @@
+"""
+Connecting to our database - one set of settings for server.py, initdb.py,
+gc.py and scratch.py, read from environment variables:
+
+    DATABASE_URL             postgresql:///indoorfarms
+    DB_POOL_SIZE             connections each process keeps open
+    DB_MAX_OVERFLOW          extra connections it may open when they're all busy
+    DB_POOL_TIMEOUT          10     seconds to wait for a free connection before giving up
+    DB_POOL_RECYCLE          1800   seconds before a connection is closed and replaced
+    DB_POOL_PRE_PING         1      check a connection still works before using it
+    DB_STATEMENT_TIMEOUT_MS  30000  PostgreSQL cancels statements that run longer (0 = never)
+    DB_SLOW_QUERY_MS         250    print statements that take at least this long
+    DB_SQL_SAMPLE_RATE       0      also print this fraction of all statements (0.01 = 1 in 100)
+    DB_ECHO                  0      print every statement (what SQLALCHEMY_ECHO did)
+
+e.g.  $ DB_SLOW_QUERY_MS=50 DB_SQL_SAMPLE_RATE=0.1 python server.py
+
+Running several server processes ("workers", e.g. gunicorn -w 4): every
+worker has its own pool, so PostgreSQL sees up to
+workers x (pool size + overflow) connections, and it only allows
+max_connections (100 unless changed). Unless DB_POOL_SIZE/DB_MAX_OVERFLOW
+are set, we split DB_MAX_CONNECTIONS (default 80, leaving room for
+initdb.py and psql) between WEB_CONCURRENCY workers (default 1). A worker
+that was forked from a process that had already connected never uses its
+parent's connections either (see _check_connection_pid).
+
+The pool (TimedQueuePool) keeps track of how long requests wait for a
+connection and how close to full it gets - server.py shows this at
+/db/pool.json.
+
+SQLAlchemy pools and engine options:
+https://docs.sqlalchemy.org/en/14/core/pooling.html
+https://docs.sqlalchemy.org/en/14/core/engines.html#engine-creation-api
+"""
+import os
+import random
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool
+
+from db_utils.query_counter import statement_listeners
+from db_utils.request_metrics import RowCountingCursor
+
+
+def _env_int(environ, name: str, default):
+    value = environ.get(name)
+    return default if value in (None, "") else int(value)
+
+
+def _env_float(environ, name: str, default):
+    value = environ.get(name)
+    return default if value in (None, "") else float(value)
+
+
+def _env_bool(environ, name: str, default: bool):
+    value = environ.get(name)
+    return default if value in (None, "") else value.lower() in ("1", "true", "yes", "on")
+
+
+class DatabaseSettings(object):
+    """ How we connect to the database (see the top of this file) """
+
+    def __init__(self, url="postgresql:///indoorfarms", pool_size=5, max_overflow=10,
+                 pool_timeout=10, pool_recycle=1800, pool_pre_ping=True,
+                 statement_timeout_ms=30000, slow_query_ms=250, sql_sample_rate=0.0, echo=False):
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        self.statement_timeout_ms = statement_timeout_ms
+        self.slow_query_ms = slow_query_ms
+        self.sql_sample_rate = sql_sample_rate
+        self.echo = echo
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        # the connections each worker may have, if DB_POOL_SIZE and
+        # DB_MAX_OVERFLOW don't say
+        workers = max(1, _env_int(environ, "WEB_CONCURRENCY", 1))
+        per_worker = max(1, _env_int(environ, "DB_MAX_CONNECTIONS", 80) // workers)
+        pool_size = _env_int(environ, "DB_POOL_SIZE", min(5, per_worker))
+        max_overflow = _env_int(environ, "DB_MAX_OVERFLOW", min(10, max(0, per_worker - pool_size)))
+
+        return cls(
+            url=environ.get("DATABASE_URL") or "postgresql:///indoorfarms",
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=_env_float(environ, "DB_POOL_TIMEOUT", 10),
+            pool_recycle=_env_int(environ, "DB_POOL_RECYCLE", 1800),
+            pool_pre_ping=_env_bool(environ, "DB_POOL_PRE_PING", True),
+            statement_timeout_ms=_env_int(environ, "DB_STATEMENT_TIMEOUT_MS", 30000),
+            slow_query_ms=_env_float(environ, "DB_SLOW_QUERY_MS", 250),
+            sql_sample_rate=_env_float(environ, "DB_SQL_SAMPLE_RATE", 0.0),
+            echo=_env_bool(environ, "DB_ECHO", False),
+        )
+
+    def engine_options(self, statement_timeout_ms=None, search_path: str=None):
+        """
+        Keyword arguments for create_engine (or Flask-SQLAlchemy's
+        SQLALCHEMY_ENGINE_OPTIONS). statement_timeout_ms overrides ours -
+        initdb.py's big loads pass 0.
+        """
+        if statement_timeout_ms is None:
+            statement_timeout_ms = self.statement_timeout_ms
+        # settings PostgreSQL applies to every connection we open
+        # https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-CONNECT-OPTIONS
+        options = []
+        if statement_timeout_ms:
+            options.append(f"-c statement_timeout={int(statement_timeout_ms)}")
+        if search_path:
+            options.append(f"-c search_path={search_path}")
+
+        engine_options = {
+            "poolclass": TimedQueuePool,
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.pool_timeout,
+            "pool_recycle": self.pool_recycle,
+            "pool_pre_ping": self.pool_pre_ping,
+        }
+        # RowCountingCursor counts the rows each request fetches, for
+        # server.py's Server-Timing header (see db_utils/request_metrics.py)
+        connect_args = {"cursor_factory": RowCountingCursor}
+        if options:
+            connect_args["options"] = " ".join(options)
+        engine_options["connect_args"] = connect_args
+        return engine_options
+
+    def __repr__(self):
+        return (f"<DatabaseSettings pool_size={self.pool_size} max_overflow={self.max_overflow} "
+                f"statement_timeout_ms={self.statement_timeout_ms} slow_query_ms={self.slow_query_ms} "
+                f"sql_sample_rate={self.sql_sample_rate}>")
+
+
+#####################################################################
+# The pool
+#####################################################################
+
+# a checkout that took longer than this had to wait for a connection
+# (rather than just being handed one that was free)
+WAITED_SECONDS = 0.001
+
+_checkout_depth = threading.local()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    SQLAlchemy's usual pool, plus how long each checkout waited for a
+    connection, how many hit pool_timeout and the most connections that
+    were ever in use at once
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.waited_checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.peak_checked_out = 0
+
+    def _do_get(self):
+        # QueuePool._do_get can call itself, only time the outside call
+        depth = getattr(_checkout_depth, "depth", 0)
+        if depth:
+            return super()._do_get()
+
+        _checkout_depth.depth = 1
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            _checkout_depth.depth = 0
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                if waited >= WAITED_SECONDS:
+                    self.waited_checkouts += 1
+                if timed_out:
+                    self.timeouts += 1
+                self.peak_checked_out = max(self.peak_checked_out, self.checkedout())
+
+    def stats(self):
+        """ The pool right now, and its checkout wait times so far """
+        capacity = self.size() + max(self._max_overflow, 0)
+        checked_out = self.checkedout()
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": checked_out,
+                "idle": self.checkedin(),
+                # how full the pool is - 1.0 means the next checkout waits
+                "saturation": round(checked_out / capacity, 3) if capacity else None,
+                "peak_checked_out": self.peak_checked_out,
+                "checkouts": self.checkouts,
+                "waited_checkouts": self.waited_checkouts,
+                "timeouts": self.timeouts,
+                "average_wait_ms": round(1000 * self.wait_seconds / self.checkouts, 3)
+                                   if self.checkouts else None,
+                "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+            }
+
+
+# A pooled connection belongs to the process that opened it - if a worker
+# process is forked from one that already had connections, the two would
+# share one connection to PostgreSQL and mix up each other's results. We
+# write down which process opened each connection and throw it away if
+# another process checks it out. We also hang on to it: letting go of a
+# psycopg2 connection closes it, and closing it from here would hang up
+# the other process's connection too.
+# https://docs.sqlalchemy.org/en/14/core/pooling.html#using-connection-pools-with-multiprocessing-or-os-fork
+_inherited_connections = []
+
+
+@event.listens_for(TimedQueuePool, "connect")
+def _remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(TimedQueuePool, "checkout")
+def _check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get("pid") != pid:
+        _inherited_connections.append(dbapi_connection)
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"connection opened by process {connection_record.info.get('pid')}, "
+            f"not this one ({pid})")
+
+
+#####################################################################
+# Slow and sampled SQL
+#####################################################################
+
+class SQLLog(object):
+    """ Prints the statements that were slow, plus a random sample of the rest """
+
+    def __init__(self, slow_query_ms: float=250, sample_rate: float=0.0):
+        self.slow_query_ms = slow_query_ms
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self.statements = 0
+        self.slow = 0
+        self.sampled = 0
+        self.total_seconds = 0.0
+
+    def configure(self, settings: DatabaseSettings):
+        self.slow_query_ms = settings.slow_query_ms
+        self.sample_rate = settings.sql_sample_rate
+
+    def record(self, statement: str, parameters, seconds: float):
+        milliseconds = seconds * 1000
+        slow = self.slow_query_ms is not None and milliseconds >= self.slow_query_ms
+        sampled = not slow and self.sample_rate > 0 and random.random() < self.sample_rate
+        with self._lock:
+            self.statements += 1
+            self.total_seconds += seconds
+            self.slow += slow
+            self.sampled += sampled
+        if slow or sampled:
+            label = "SLOW SQL" if slow else "SQL (sampled)"
+            text = " ".join(statement.split())
+            if len(text) > 500:
+                text = text[:500] + " ..."
+            print(f"{label} {milliseconds:.1f}ms: {text}  {str(parameters)[:200]}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "statements": self.statements,
+                "slow": self.slow,
+                "sampled": self.sampled,
+                "total_ms": round(self.total_seconds * 1000, 1),
+                "slow_query_ms": self.slow_query_ms,
+                "sample_rate": self.sample_rate,
+            }
+
+
+sql_log = SQLLog()
+# every statement on every Engine, timed by db_utils/query_counter.py
+statement_listeners.append(sql_log.record)
+
+
+#####################################################################
+# Making engines
+#####################################################################
+
+def make_engine(settings: DatabaseSettings=None, statement_timeout_ms=None, search_path: str=None):
+    """ A SQLAlchemy engine for scripts that don't use Flask (e.g. initdb.py) """
+    settings = settings or DatabaseSettings.from_environment()
+    sql_log.configure(settings)
+    return create_engine(settings.url, echo=settings.echo,
+                         **settings.engine_options(statement_timeout_ms, search_path))
+
+
+def configure_app(app, settings: DatabaseSettings=None):
+    """ Point Flask-SQLAlchemy (and everything that uses our app) at our database """
+    settings = settings or DatabaseSettings.from_environment()
+    sql_log.configure(settings)
+    app.config["SQLALCHEMY_DATABASE_URI"] = settings.url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = settings.engine_options()
+    app.config["SQLALCHEMY_ECHO"] = settings.echo
+    return settings
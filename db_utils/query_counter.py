@@ -0,0 +1,119 @@
+"""
+Count the SQL statements (round trips) our code sends to the database.
+
+SQLAlchemy fires a "before_cursor_execute" event every time it hands a
+statement to psycopg2, and "after_cursor_execute" when psycopg2 is done
+with it. We listen for those on every Engine, time the statement and add it
+to whichever counters are currently active on this thread. That lets us
+check things like "searching for lettuce takes 2 queries, no matter how
+many products match".
+
+These are the only statement listeners we have - anything else that wants
+to see every statement adds a function to statement_listeners instead of
+listening itself: db_utils/engine.py's slow SQL log does, and
+db_utils/request_metrics.py's RequestMetrics is a QueryCounter.
+
+to use in a script or a test:
+
+    with count_queries() as counter:
+        search_product("lettuce")
+    print(counter.count, counter.statements)
+
+server.py measures every request with a RequestMetrics and reports its
+count in an X-Query-Count response header.
+
+SQLAlchemy events: https://docs.sqlalchemy.org/en/14/core/events.html
+"""
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# each thread (each request, when flask runs threaded) gets its own stack
+# of counters so requests don't count each other's queries
+_local = threading.local()
+
+
+# functions called with (statement, parameters, seconds) after every
+# statement, on any thread
+statement_listeners = []
+
+
+class QueryCounter(object):
+    """ Holds the number of statements executed while it was active """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+
+    def add(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        self.statements.append(statement)
+
+    def __repr__(self):
+        return f"<QueryCounter count={self.count}>"
+
+
+def _active_counters():
+    if not hasattr(_local, "counters"):
+        _local.counters = []
+    return _local.counters
+
+
+def start_counting(counter: QueryCounter=None):
+    """ Start counting with counter (a new one if not given) on this thread and return it """
+    counter = counter if counter is not None else QueryCounter()
+    _active_counters().append(counter)
+    return counter
+
+
+def stop_counting(counter):
+    """ Stop a counter we got from start_counting() """
+    counters = _active_counters()
+    if counter in counters:
+        counters.remove(counter)
+    return counter
+
+
+@contextmanager
+def count_queries():
+    counter = start_counting()
+    try:
+        yield counter
+    finally:
+        stop_counting(counter)
+
+
+def _finished(statement, parameters, seconds):
+    for counter in _active_counters():
+        counter.add(statement, seconds)
+    for listener in statement_listeners:
+        listener(statement, parameters, seconds)
+
+
+# The start times go on a stack on the connection, in case one statement
+# runs inside another's event handler
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    _finished(statement, parameters, time.perf_counter() - started)
+
+
+# a statement that failed (say, cancelled by statement_timeout) still
+# counts, and took as long as it took
+@event.listens_for(Engine, "handle_error")
+def _failed_query(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        started = conn.info["query_started"].pop()
+        _finished(exception_context.statement, exception_context.parameters,
+                  time.perf_counter() - started)
@@ -0,0 +1,75 @@
+"""
+Things server.py builds from our tables and keeps in memory until the data
+changes: the search index (search_index.py), suggestions (suggest.py), map
+clusters (clusters.py) and the facilities GeoJSON (geojson_layer.py).
+
+They all work the same way:
+  * they start out stale, and server.py marks them stale again when
+    initdb.py loads new data
+  * a request that needs one calls ensure_built(), which rebuilds it if
+    it's stale
+  * rebuild() builds it now no matter what (server.py does this at startup)
+  * what's being used is swapped for the new build all at once, so
+    requests during a rebuild keep using the old one
+
+Only one thread builds at a time. After a data load, lots of requests can
+find the index stale at once - the first one rebuilds, and the rest wait
+for it and then use what it built (they check stale again once it's their
+turn) instead of each building it again.
+
+Each kind writes build(), which reads our tables and swaps in the new
+data, and a stats() with its own numbers added to ours.
+"""
+import threading
+import time
+
+
+class Rebuildable(object):
+
+    # for the "Built ...: {stats}" line we print after every build
+    label = "index"
+
+    def __init__(self):
+        self.build_seconds = None
+        self.built_at = None
+        # set by a reload signal or a new data version, see server.py
+        self.stale = True
+        self._lock = threading.Lock()
+
+    def build(self):
+        """ Read our tables and swap in what we built from them """
+        raise NotImplementedError
+
+    def rebuild(self):
+        """ Build now, stale or not """
+        with self._lock:
+            self._timed_build()
+
+    def ensure_built(self):
+        """ Rebuild if we've never been built or were told to reload """
+        if self.stale:
+            with self._lock:
+                # another request may have rebuilt while we waited
+                if self.stale:
+                    self._timed_build()
+
+    def _timed_build(self):
+        started = time.perf_counter()
+        # cleared first: new data loaded while we're reading makes us
+        # stale again, so the next request builds with it
+        self.stale = False
+        try:
+            self.build()
+        except BaseException:
+            self.stale = True
+            raise
+        self.build_seconds = time.perf_counter() - started
+        self.built_at = time.time()
+        print(f"Built {self.label}: {self.stats()}")
+
+    def stats(self):
+        """ How long the last build took and when it finished """
+        return {
+            "build_seconds": self.build_seconds,
+            "built_at": self.built_at,
+        }
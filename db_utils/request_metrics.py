@@ -0,0 +1,178 @@
+"""
+Where does a request spend its time? Timers and counters for one request
+at a time, so server.py can say e.g.
+
+    Server-Timing: db;dur=8.1;desc="3 queries, 212 rows", search;dur=14.9,
+                   serialize;dur=5.6;desc="1 lazy query", encode;dur=1.2,
+                   total;dur=17.3
+
+(browsers show this in the Network tab of their developer tools).
+
+What gets counted while a request's RequestMetrics is running:
+  * db         - every statement SQLAlchemy sends, and how long the
+                 database took to answer it (a RequestMetrics is a
+                 QueryCounter, see db_utils/query_counter.py - so this is
+                 also the X-Query-Count header's count)
+  * rows       - every row psycopg2 fetches for us, including the ones
+                 yield_per streams in batches (RowCountingCursor below -
+                 cursor.rowcount doesn't know about those until the end)
+  * phases     - whatever our code wraps in  with timed("search"):
+                 search.py times making result dicts as "serialize",
+                 server.py times the search and turning it into JSON
+  * lazy loads - statements run inside a phase (say "serialize") are
+                 counted for it too, so a relationship that wasn't loaded
+                 up front shows up as "serialize ... 1 lazy query"
+
+Phases can be inside each other (serialize happens during search) and db
+time happens inside them too, so the numbers don't add up to total.
+
+Each thread has at most one RequestMetrics running - flask handles one
+request per thread - and timed() does nothing when there isn't one, so
+search.py works the same in scripts.
+
+Server-Timing: https://www.w3.org/TR/server-timing/
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2.extensions
+
+from db_utils.query_counter import QueryCounter, start_counting, stop_counting
+
+
+_local = threading.local()
+
+
+class RequestMetrics(QueryCounter):
+    """ Timers and counters for one request (see the top of this file) """
+
+    def __init__(self):
+        super().__init__()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.rows = 0
+        # phase name -> seconds spent in it, and statements run inside it
+        self.phase_seconds = {}
+        self.phase_queries = {}
+        # the phases running right now, innermost last
+        self._phases = []
+
+    @property
+    def total_seconds(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def add_phase(self, phase: str, seconds: float):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    @property
+    def queries(self):
+        return self.count
+
+    @property
+    def db_seconds(self):
+        return self.seconds
+
+    def add(self, statement: str, seconds: float):
+        super().add(statement, seconds)
+        for phase in set(self._phases):
+            self.phase_queries[phase] = self.phase_queries.get(phase, 0) + 1
+
+    def server_timing(self):
+        """ The value of a Server-Timing header for what we've measured so far """
+        entries = [ _timing_entry("db", self.db_seconds,
+                                  f"{_plural(self.queries, 'query', 'queries')}, "
+                                  f"{_plural(self.rows, 'row', 'rows')}") ]
+        for phase, seconds in self.phase_seconds.items():
+            queries = self.phase_queries.get(phase, 0)
+            # statements during serialize are relationships loaded late
+            description = (_plural(queries, "lazy query", "lazy queries")
+                           if phase == "serialize" and queries else None)
+            entries.append(_timing_entry(phase, seconds, description))
+        entries.append(_timing_entry("total", self.total_seconds))
+        return ", ".join(entries)
+
+    def __repr__(self):
+        return (f"<RequestMetrics queries={self.queries} rows={self.rows} "
+                f"db_ms={self.db_seconds * 1000:.1f} total_ms={self.total_seconds * 1000:.1f}>")
+
+
+def _plural(count: int, one: str, many: str):
+    return f"{count} {one if count == 1 else many}"
+
+
+def _timing_entry(name: str, seconds: float, description: str=None):
+    entry = f"{name};dur={seconds * 1000:.1f}"
+    return f'{entry};desc="{description}"' if description else entry
+
+
+def start_request():
+    """ Start measuring a new request on this thread and return its RequestMetrics """
+    # the last request's, if it was finished on some other thread
+    previous = getattr(_local, "metrics", None)
+    if previous is not None:
+        stop_counting(previous)
+    _local.metrics = start_counting(RequestMetrics())
+    return _local.metrics
+
+
+def finish_request(metrics: RequestMetrics):
+    """ Stop measuring metrics (from start_request) """
+    if metrics.finished is None:
+        metrics.finished = time.perf_counter()
+    stop_counting(metrics)
+    if getattr(_local, "metrics", None) is metrics:
+        _local.metrics = None
+    return metrics
+
+
+def current_metrics():
+    """ This thread's running RequestMetrics, or None """
+    return getattr(_local, "metrics", None)
+
+
+@contextmanager
+def timed(phase: str):
+    """ Add the time the with block takes to phase, if we're measuring a request """
+    metrics = getattr(_local, "metrics", None)
+    if metrics is None:
+        yield
+        return
+    metrics._phases.append(phase)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_phase(phase, time.perf_counter() - started)
+        metrics._phases.pop()
+
+
+class RowCountingCursor(psycopg2.extensions.cursor):
+    """
+    A psycopg2 cursor that adds the rows it fetches to the running
+    RequestMetrics. db_utils/engine.py asks psycopg2 to use it for every
+    cursor (cursor_factory) - server-side ones too.
+    """
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        _count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows))
+        return rows
+
+
+def _count_rows(count: int):
+    metrics = getattr(_local, "metrics", None)
+    if metrics is not None:
+        metrics.rows += count
+
@@ -0,0 +1,85 @@
+"""
+Working out which rows of a sheet changed since we last loaded it.
+
+Every row gets a natural key (something in the row that names it, like a
+company's trade name) and a hash of everything else in it. Comparing those
+with the keys and hashes we saved last time (the row_hash table, see
+RowHash in model.py) sorts the rows three ways:
+
+    inserts - keys we've never seen
+    updates - keys we've seen, but the hash is different
+    deletes - keys we saw last time that aren't in the sheet any more
+
+Rows whose hash didn't change aren't touched at all.
+
+The hashes are saved between runs, so they're made from the row's values
+written out as text (a JSON list, in column order) - not from how pandas
+keeps them in memory, which changes with the column's dtype and the pandas
+version. 7105, 7105.0 and "7105" all hash the same, so reading a column
+as a different type doesn't make every row look changed.
+"""
+import hashlib
+import json
+import numbers
+
+import pandas as pd
+
+
+def cell_text(value):
+    """ A cell's value as text, the same whatever type it was read as (None for blanks) """
+    if value is None or value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        if value != value:
+            # NaN
+            return None
+        if float(value).is_integer():
+            return str(int(value))
+        return repr(float(value))
+    return str(value)
+
+
+def hash_rows(df, columns):
+    """
+    A hex string for each row of df, made from the values in columns. The
+    same values always give the same string, in any run of our program
+    (and with any version of pandas).
+    """
+    hashes = [ hashlib.blake2b(json.dumps([ cell_text(value) for value in row ],
+                                          ensure_ascii=False).encode(),
+                               digest_size=8).hexdigest()
+               for row in df[columns].itertuples(index=False, name=None) ]
+    return pd.Series(hashes, index=df.index, dtype=object)
+
+
+def diff_rows(desired, stored):
+    """
+    desired - a DataFrame with natural_key and row_hash columns (what our
+              sheet says now)
+    stored  - a DataFrame with natural_key, row_hash and row_id columns
+              (what we loaded last time)
+
+    Returns (inserts, updates, deletes): the desired rows to insert, the
+    desired rows to update (with the row_id to update) and the stored rows
+    to delete.
+    """
+    merged = desired.merge(stored.rename(columns={"row_hash": "stored_hash"}),
+                           on="natural_key", how="outer", indicator=True)
+    inserts = desired[desired["natural_key"].isin(
+        merged.loc[merged["_merge"] == "left_only", "natural_key"])]
+
+    both = merged[merged["_merge"] == "both"]
+    changed = both.loc[both["row_hash"] != both["stored_hash"], ["natural_key", "row_id"]]
+    updates = desired.merge(changed, on="natural_key")
+
+    deletes = stored[stored["natural_key"].isin(
+        merged.loc[merged["_merge"] == "right_only", "natural_key"])]
+    return inserts, updates, deletes
+
+
+def records(df):
+    """
+    df's rows as dicts of plain Python values, with None for blank cells -
+    what SQLAlchemy needs for an insert or update
+    """
+    return df.astype(object).where(df.notna(), None).to_dict("records")
@@ -0,0 +1,157 @@
+"""
+Downloading our Google Sheets as CSV files.
+
+Each sheet is its own download, so we download them all at the same time
+with a pool of threads (most of the time is spent waiting on Google, not
+running Python). Each download:
+
+  * asks "has this changed?" - we send back the ETag / Last-Modified
+    headers from the last download (If-None-Match / If-Modified-Since),
+    and if the server answers 304 Not Modified we're done
+  * otherwise streams the sheet to a temporary file a chunk at a time,
+    working out its sha256 hash as it goes - the whole sheet is never in
+    memory at once
+  * compares that hash with the last download's. If it's the same (Google
+    doesn't always send ETags) we throw the new file away, if it's
+    different we put the new one in its place (initdb.py snapshots the
+    old ones first, see db_utils/snapshots.py)
+
+What we remember about the last download of each sheet is kept in
+data/downloads.json.
+
+to use:
+    results = download_google_worksheets(GSHEET_ID, ["company", "product"])
+    # -> {"company": "changed", "product": "unchanged"}
+
+base_url lets us download from somewhere other than Google, e.g. a test
+server on our own computer:
+    $ python -m http.server 8000     (in a folder with company.csv in it)
+    download_google_worksheets("", ["company"], base_url="http://localhost:8000/{sheet_name}.csv")
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import tempfile
+import urllib.error
+import urllib.request
+
+
+GOOGLE_SHEET_URL = ("https://docs.google.com/spreadsheets/d/{doc_id}/gviz/tq"
+                    "?tqx=out:csv&sheet={sheet_name}")
+CHUNK_BYTES = 64 * 1024
+STATE_FILE = "downloads.json"
+
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+def load_download_state(data_dir: str):
+    """ sheet name -> {"etag", "last_modified", "sha256"} from the last downloads """
+    try:
+        with open(os.path.join(data_dir, STATE_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_download_state(data_dir: str, state: dict):
+    with open(os.path.join(data_dir, STATE_FILE), "w") as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+
+
+def file_sha256(path: str):
+    """ The sha256 of a file we already have, or None """
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_google_worksheet(doc_id, sheet_name, data_dir: str="./data", last: dict=None,
+                              base_url: str=GOOGLE_SHEET_URL, timeout: float=60):
+    """
+    Download one sheet to data_dir/<sheet_name>.csv, unless it hasn't
+    changed since last (what load_download_state had for it).
+    Returns (CHANGED or UNCHANGED, what to remember for next time).
+    """
+    last = dict(last or {})
+    csv_path = os.path.join(data_dir, f"{sheet_name}.csv")
+    on_disk = file_sha256(csv_path)
+    if on_disk != last.get("sha256"):
+        # the file isn't the one we downloaded last time (it's gone, or was
+        # restored from a snapshot) - the server's "not modified" would be
+        # about the wrong file, so only compare hashes
+        last = {"sha256": on_disk}
+
+    csv_url = base_url.format(doc_id=doc_id, sheet_name=sheet_name)
+    request = urllib.request.Request(csv_url)
+    if last.get("etag"):
+        request.add_header("If-None-Match", last["etag"])
+    if last.get("last_modified"):
+        request.add_header("If-Modified-Since", last["last_modified"])
+
+    print(f"Getting {sheet_name} sheet data using URL: {csv_url}")
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            return UNCHANGED, last
+        raise
+
+    with response:
+        remember = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        # write to a temporary file next to the real one, so a download that
+        # fails halfway never leaves us with half a CSV
+        digest = hashlib.sha256()
+        handle, temp_path = tempfile.mkstemp(prefix=f".{sheet_name}-", suffix=".csv", dir=data_dir)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                for chunk in iter(lambda: response.read(CHUNK_BYTES), b""):
+                    digest.update(chunk)
+                    file.write(chunk)
+            remember["sha256"] = digest.hexdigest()
+
+            if remember["sha256"] == last.get("sha256"):
+                return UNCHANGED, remember
+            os.replace(temp_path, csv_path)
+            return CHANGED, remember
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def download_google_worksheets(doc_id, sheet_names, data_dir: str="./data",
+                               base_url: str=GOOGLE_SHEET_URL, max_workers: int=4):
+    """
+    Download several sheets at once (see download_google_worksheet).
+    Returns sheet name -> CHANGED, UNCHANGED or FAILED.
+    """
+    state = load_download_state(data_dir)
+
+    def download(sheet_name):
+        try:
+            return download_google_worksheet(doc_id, sheet_name, data_dir, state.get(sheet_name),
+                                             base_url)
+        except (OSError, urllib.error.URLError) as err:
+            print(f"  !!! Couldn't download {sheet_name}: {err}")
+            return FAILED, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        outcomes = dict(zip(sheet_names, pool.map(download, sheet_names)))
+
+    # only this thread writes the state file, once everyone's done
+    results = {}
+    for sheet_name, (result, remember) in outcomes.items():
+        results[sheet_name] = result
+        if remember is not None:
+            state[sheet_name] = remember
+    save_download_state(data_dir, state)
+    return results
@@ -0,0 +1,335 @@
+"""
+Snapshots of our CSV sheets, so we can go back to (or compare with) the data
+we had before.
+
+Every time initdb.py loads our data it saves a snapshot: a small JSON
+manifest saying which version of each sheet it loaded. The sheets themselves
+are stored gzip-compressed and named after the sha256 hash of what's in
+them, so a sheet that didn't change between two snapshots is only stored
+once - most snapshots only cost the few KB of their manifest.
+
+    data/backup/
+        snapshots/20261018-153012.json      one manifest per snapshot
+        objects/3f/3f9a...c1.csv.gz         one file per version of a sheet
+
+to use (from the repo's top folder):
+    $ python -m db_utils.snapshots list
+    $ python -m db_utils.snapshots save --note "before fixing product names"
+    $ python -m db_utils.snapshots restore 20261018-153012
+    $ python -m db_utils.snapshots diff latest current
+    $ python -m db_utils.snapshots diff 20261017-090000 20261018-153012 --sheets product
+
+A snapshot can be named by its id, the start of its id, or "latest".
+diff also takes "current" - the CSVs in the data folder right now.
+Restoring first saves a snapshot of the CSVs it's about to replace, so a
+restore can itself be undone.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+from db_utils.row_sync import diff_rows, hash_rows
+from db_utils.sheet_download import file_sha256
+
+
+SNAPSHOT_SHEETS = ["company", "address", "facility", "product", "locations"]
+
+# the columns that name a row in each sheet, for matching up the rows of
+# two versions of it - like the natural keys initdb.py uses
+SHEET_KEYS = {
+    "company": ["trade_name"],
+    "address": ["company_trade_name", "nickname"],
+    "facility": ["company_trade_name", "nickname"],
+    "product": ["company_trade_name", "name"],
+    "locations": ["nickname"],
+}
+
+
+def default_store_dir(data_dir: str):
+    return os.path.join(data_dir, "backup")
+
+
+def object_path(store_dir: str, sha256: str):
+    return os.path.join(store_dir, "objects", sha256[:2], f"{sha256}.csv.gz")
+
+
+def manifest_path(store_dir: str, snapshot_id: str):
+    return os.path.join(store_dir, "snapshots", f"{snapshot_id}.json")
+
+
+def snapshot_order(snapshot_id: str):
+    """
+    Sort key for snapshot ids: "20261018-153012" then "20261018-153012-2"
+    ... "-10" (as plain strings "-10" would come before "-2", and "-2"
+    before the first one)
+    """
+    timestamp, _, sequence = snapshot_id.partition("-")[2].partition("-")
+    return (snapshot_id[:8], timestamp, int(sequence) if sequence.isdigit() else 1)
+
+
+def list_snapshots(store_dir: str):
+    """ Every snapshot's manifest, oldest first """
+    folder = os.path.join(store_dir, "snapshots")
+    if not os.path.isdir(folder):
+        return []
+    manifests = []
+    for file_name in os.listdir(folder):
+        if file_name.endswith(".json"):
+            with open(os.path.join(folder, file_name)) as file:
+                manifests.append(json.load(file))
+    return sorted(manifests, key=lambda manifest: snapshot_order(manifest["id"]))
+
+
+def find_snapshot(store_dir: str, name: str):
+    """ The manifest of the snapshot called name (an id, the start of one, or "latest") """
+    manifests = list_snapshots(store_dir)
+    if name == "latest":
+        matches = manifests[-1:]
+    else:
+        matches = [ manifest for manifest in manifests if manifest["id"].startswith(name) ]
+        exact = [ manifest for manifest in matches if manifest["id"] == name ]
+        matches = exact or matches
+    if len(matches) != 1:
+        problem = "no snapshot" if not matches else f"{len(matches)} snapshots"
+        raise ValueError(f"{problem} called {name!r} in {store_dir}")
+    return matches[0]
+
+
+def store_object(store_dir: str, path: str, sha256: str):
+    """
+    Save a gzipped copy of the file at path, named by its hash, unless we
+    have one already. Returns the compressed size.
+    """
+    stored_path = object_path(store_dir, sha256)
+    if not os.path.exists(stored_path):
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+        # compress to a temporary file first, so there's never half an
+        # object under the real name
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(stored_path))
+        try:
+            with open(path, "rb") as source, os.fdopen(handle, "wb") as raw:
+                # mtime=0 - the same sheet always compresses to the same bytes
+                with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as compressed:
+                    shutil.copyfileobj(source, compressed)
+            os.replace(temp_path, stored_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return os.path.getsize(stored_path)
+
+
+def save_snapshot(data_dir: str="./data", store_dir: str=None, sheet_names=SNAPSHOT_SHEETS,
+                  note: str="", skip_if_unchanged: bool=False):
+    """
+    Snapshot the sheets in data_dir (sheets that don't have a CSV are left
+    out). With skip_if_unchanged, if every sheet is the same as in the
+    latest snapshot we don't make a new one. Returns the snapshot's id.
+    """
+    store_dir = store_dir or default_store_dir(data_dir)
+    sheets = {}
+    for sheet_name in sheet_names:
+        path = os.path.join(data_dir, f"{sheet_name}.csv")
+        sha256 = file_sha256(path)
+        if sha256 is None:
+            continue
+        sheets[sheet_name] = {
+            "sha256": sha256,
+            "bytes": os.path.getsize(path),
+            "stored_bytes": store_object(store_dir, path, sha256),
+        }
+
+    manifests = list_snapshots(store_dir)
+    if skip_if_unchanged and manifests and manifests[-1]["sheets"] == sheets:
+        return manifests[-1]["id"]
+
+    now = datetime.datetime.now()
+    snapshot_id = now.strftime("%Y%m%d-%H%M%S")
+    taken = { manifest["id"] for manifest in manifests }
+    suffix = 1
+    while snapshot_id in taken or os.path.exists(manifest_path(store_dir, snapshot_id)):
+        suffix += 1
+        snapshot_id = f"{now:%Y%m%d-%H%M%S}-{suffix}"
+
+    os.makedirs(os.path.join(store_dir, "snapshots"), exist_ok=True)
+    manifest = {
+        "id": snapshot_id,
+        "created": now.isoformat(timespec="seconds"),
+        "note": note,
+        "sheets": sheets,
+    }
+    with open(manifest_path(store_dir, snapshot_id), "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return snapshot_id
+
+
+def restore_snapshot(snapshot_name: str, data_dir: str="./data", store_dir: str=None,
+                     sheet_names=None):
+    """
+    Put the sheets from a snapshot back in data_dir (just sheet_names, if
+    given). Sheets that are already the same aren't touched.
+    Returns (the names of the sheets we replaced, the id of the snapshot
+    of what was there before).
+    """
+    store_dir = store_dir or default_store_dir(data_dir)
+    manifest = find_snapshot(store_dir, snapshot_name)
+    sheets = manifest["sheets"]
+    if sheet_names is not None:
+        sheets = { name: sheets[name] for name in sheet_names if name in sheets }
+
+    before_id = save_snapshot(data_dir, store_dir, SNAPSHOT_SHEETS,
+                              note=f"before restoring {manifest['id']}", skip_if_unchanged=True)
+
+    restored = []
+    for sheet_name, sheet in sheets.items():
+        path = os.path.join(data_dir, f"{sheet_name}.csv")
+        if file_sha256(path) == sheet["sha256"]:
+            continue
+        handle, temp_path = tempfile.mkstemp(prefix=f".{sheet_name}-", suffix=".csv", dir=data_dir)
+        try:
+            with gzip.open(object_path(store_dir, sheet["sha256"]), "rb") as source, \
+                    os.fdopen(handle, "wb") as destination:
+                shutil.copyfileobj(source, destination)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        restored.append(sheet_name)
+    return restored, before_id
+
+
+#####################################################################
+# Comparing two versions of a sheet row by row
+#####################################################################
+
+def read_sheet(path: str):
+    """ A sheet as a DataFrame of strings - we compare exactly what's in the CSV """
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def keyed_sheet(df, key_columns):
+    """
+    df with a natural_key column naming each row. If two rows have the same
+    key the second one gets "#2" on the end, and so on.
+    """
+    df = df.reset_index(drop=True)
+    if key_columns and all(name in df.columns for name in key_columns):
+        keys = df[key_columns].apply(lambda row: json.dumps(list(row)), axis=1)
+    else:
+        # we don't know what names a row - the whole row has to match
+        keys = df.apply(lambda row: json.dumps(list(row)), axis=1)
+    repeat = df.groupby(keys).cumcount() + 1
+    keys = keys.where(repeat == 1, keys + "#" + repeat.astype(str))
+    return df.assign(natural_key=keys.values)
+
+
+def diff_sheets(df_a, df_b, key_columns):
+    """
+    What changed going from df_a to df_b:
+      added   - natural keys of rows only in df_b
+      removed - natural keys of rows only in df_a
+      changed - (natural key, {column: (value in a, value in b)}) for rows
+                in both whose values are different
+    Only columns both versions have are compared.
+    """
+    columns = [ name for name in df_b.columns if name in df_a.columns ]
+    a = keyed_sheet(df_a[columns], key_columns)
+    b = keyed_sheet(df_b[columns], key_columns)
+    a["row_hash"] = hash_rows(a, columns).values
+    b["row_hash"] = hash_rows(b, columns).values
+
+    stored = a[["natural_key", "row_hash"]].assign(row_id=a.index)
+    inserts, updates, deletes = diff_rows(b[["natural_key", "row_hash"]], stored)
+
+    b_rows = b.set_index("natural_key")
+    changed = []
+    for natural_key, row_id in zip(updates["natural_key"], updates["row_id"]):
+        old, new = a.loc[row_id], b_rows.loc[natural_key]
+        changed.append((natural_key, { name: (old[name], new[name])
+                                       for name in columns if old[name] != new[name] }))
+    return inserts["natural_key"].tolist(), deletes["natural_key"].tolist(), changed
+
+
+def sheet_version(name: str, sheet_name: str, data_dir: str, store_dir: str):
+    """
+    (sha256, where to read it from) for sheet_name in snapshot name (or
+    "current"), or (None, None) if it isn't there
+    """
+    if name == "current":
+        path = os.path.join(data_dir, f"{sheet_name}.csv")
+        sha256 = file_sha256(path)
+        return sha256, path if sha256 else None
+    sheet = find_snapshot(store_dir, name)["sheets"].get(sheet_name)
+    if sheet is None:
+        return None, None
+    return sheet["sha256"], object_path(store_dir, sheet["sha256"])
+
+
+def print_diff(name_a: str, name_b: str, data_dir: str="./data", store_dir: str=None,
+               sheet_names=SNAPSHOT_SHEETS):
+    store_dir = store_dir or default_store_dir(data_dir)
+    for sheet_name in sheet_names:
+        sha256_a, path_a = sheet_version(name_a, sheet_name, data_dir, store_dir)
+        sha256_b, path_b = sheet_version(name_b, sheet_name, data_dir, store_dir)
+        if path_a is None and path_b is None:
+            continue
+        if path_a is None or path_b is None:
+            print(f"{sheet_name}: only in {name_a if path_b is None else name_b}")
+            continue
+        if sha256_a == sha256_b:
+            # same hash, same sheet - no need to read it
+            print(f"{sheet_name}: no changes")
+            continue
+
+        df_a, df_b = read_sheet(path_a), read_sheet(path_b)
+        added, removed, changed = diff_sheets(df_a, df_b, SHEET_KEYS.get(sheet_name))
+        print(f"{sheet_name}: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+        for name in df_b.columns.difference(df_a.columns):
+            print(f"  + column {name}")
+        for name in df_a.columns.difference(df_b.columns):
+            print(f"  - column {name}")
+        for natural_key in added:
+            print(f"  + {natural_key}")
+        for natural_key in removed:
+            print(f"  - {natural_key}")
+        for natural_key, values in changed:
+            print(f"  ~ {natural_key}")
+            for name, (old, new) in values.items():
+                print(f"      {name}: {old!r} -> {new!r}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="save, restore and compare snapshots of our CSVs")
+    arg_parser.add_argument("--data", default="./data", help="the folder our CSVs are in")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list")
+    save_parser = commands.add_parser("save")
+    save_parser.add_argument("--note", default="")
+    restore_parser = commands.add_parser("restore")
+    restore_parser.add_argument("snapshot")
+    restore_parser.add_argument("--sheets", nargs="+")
+    diff_parser = commands.add_parser("diff")
+    diff_parser.add_argument("a")
+    diff_parser.add_argument("b")
+    diff_parser.add_argument("--sheets", nargs="+", default=SNAPSHOT_SHEETS)
+    args = arg_parser.parse_args()
+
+    try:
+        if args.command == "list":
+            for manifest in list_snapshots(default_store_dir(args.data)):
+                print(f"{manifest['id']:<20} {manifest['note']:<40} {', '.join(manifest['sheets'])}")
+        elif args.command == "save":
+            print(f"Saved snapshot {save_snapshot(args.data, note=args.note)}")
+        elif args.command == "restore":
+            restored, before_id = restore_snapshot(args.snapshot, args.data, sheet_names=args.sheets)
+            print(f"Restored {', '.join(restored) or 'nothing (already the same)'}")
+            print(f"(what was there before is snapshot {before_id})")
+        elif args.command == "diff":
+            print_diff(args.a, args.b, args.data, sheet_names=args.sheets)
+    except ValueError as err:
+        raise SystemExit(f"!!! {err}")
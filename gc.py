@@ -1,46 +1,198 @@
-from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-from model import Company, Address, Product, Facility
-from server import app
-import math
-
-app.app_context().push()
-
-locator = Nominatim(user_agent="thanks")
-geocode = RateLimiter(locator.geocode, min_delay_seconds=5)
-location = None
-
-facilities = Facility.query.all()
-with open("./data/locations.csv", "w") as file:
-    file.write('"nickname","latitude","longitude"\n')
-    for facility in facilities:
-        address = facility.address
-        addr_str = ""
-        if address.address_1:
-            addr_str += f"{address.address_1}"
-
-        if address.address_2:
-            addr_str += f" {address.address_2}"
-
-        if address.suite:
-            addr_str += f" {address.suite}"
-
-        if address.postal:
-            postal = math.floor(float(address.postal))
-        else:
-            postal = ""
-
-        if address.city:
-            addr_str += f" {address.city}"
-                
-        if address.state:
-            addr_str += f" {address.state} {postal}"
-
-        location = geocode(addr_str)
-
-        print(addr_str)
-        if location and hasattr(location,"latitude"):
-            data = f'"{facility.nickname}",{location.latitude},{location.longitude}\n'
-            file.write(data)
-            file.flush()
+"""
+Find the map coordinates of every facility's address (see geocoding.py).
 
+Addresses we've looked up before come from data/geocode_cache.csv, so only
+new or changed addresses are sent to a geocoder. The coordinates go:
+  * straight into the Address rows in our database (one batch update), and
+  * into data/locations.csv, so the next initdb.py load keeps them
+Addresses no geocoder finds get the middle of their postal code (or city)
+from data/postal_codes.txt, a GeoNames postal code file, if we have one -
+download e.g. https://download.geonames.org/export/zip/US.zip and save the
+US.txt inside it as data/postal_codes.txt.
+
+to run:
+    $ python gc.py                              (Nominatim, 1 request/second)
+    $ python gc.py -retry                       (also retry addresses nobody found)
+    $ python gc.py -provider fake               (no network - pretends to be a
+                                                 geocoder that knows where our
+                                                 addresses already are)
+    $ python gc.py -offline                     (no geocoders at all - just the
+                                                 cache and postal codes)
+"""
+from model import db, Address, DataVersion, Facility
+from geo import encode_geohash
+from geocoding import (PRECISION_ADDRESS, FakeGeocoder, GeocodeCache, PostalCentroids, Provider,
+                       address_query, geocode_addresses, nominatim_geocoder, normalize_address)
+from sqlalchemy import bindparam, update
+import argparse
+import csv
+import os
+import tempfile
+
+import pandas as pd
+
+
+def read_locations(path: str):
+    """ nickname -> (latitude, longitude, precision) from locations.csv """
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="") as file:
+        return { row["nickname"]: (float(row["latitude"]), float(row["longitude"]),
+                                   row.get("location_precision") or PRECISION_ADDRESS)
+                 for row in csv.DictReader(file) }
+
+
+def write_locations(path: str, locations: dict):
+    """ Write locations.csv all at once, so it's never half-written """
+    handle, temp_path = tempfile.mkstemp(suffix=".csv", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, "w", newline="") as file:
+            writer = csv.writer(file, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+            writer.writerow(["nickname", "latitude", "longitude", "location_precision"])
+            for nickname in sorted(locations):
+                writer.writerow([nickname, *locations[nickname]])
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def make_providers(names, rows):
+    providers = []
+    for name in names:
+        if name == "nominatim":
+            providers.append(Provider("nominatim", nominatim_geocoder(), per_second=1))
+        elif name == "fake":
+            # it knows the street addresses we already have coordinates for
+            known = { address_query(*row[2:9]): (row[9], row[10])
+                      for row in rows if row[9] is not None and row[11] in (None, PRECISION_ADDRESS) }
+            providers.append(Provider("fake", FakeGeocoder(known, delay_seconds=0.05), per_second=20, burst=5))
+    return providers
+
+
+def address_keys(rows):
+    """
+    (Address.id -> address key, address key -> address text) for rows -
+    one lookup per distinct address, however many facilities share it.
+    Facility nicknames aren't unique ("Headquarters"), so we go by the
+    address's id.
+    """
+    key_for_address = {}
+    queries = {}
+    for row in rows:
+        query = address_query(*row[2:9])
+        key = normalize_address(query)
+        key_for_address[row[1]] = key
+        queries[key] = query
+    return key_for_address, queries
+
+
+def postal_code_locations(rows, key_for_address: dict, found: dict, postal_codes_path: str):
+    """
+    address key -> (latitude, longitude, precision) from postal code
+    centroids, for the rows' addresses that aren't in found
+    """
+    missing = [ row for row in rows if key_for_address[row[1]] not in found ]
+    if not missing or not os.path.exists(postal_codes_path):
+        return {}
+    centroids = PostalCentroids(postal_codes_path)
+    df = pd.DataFrame([ row[5:9] for row in missing ], columns=["city", "state", "postal", "country"])
+    located = centroids.locate(df)
+    print(f"Postal codes: {centroids.stats()}")
+    return { key_for_address[row[1]]: (latitude, longitude, precision)
+             for row, latitude, longitude, precision
+             in zip(missing, located["latitude"], located["longitude"], located["location_precision"])
+             if precision is not None }
+
+
+def address_changes(rows, key_for_address: dict, found: dict, locations: dict):
+    """
+    Address.id -> the new coordinates for every Address row whose
+    coordinates changed (ready for one executemany). Also puts every
+    point we found in locations (what we write to locations.csv).
+    """
+    changes = {}
+    for nickname, address_id, *_, latitude, longitude, precision in rows:
+        point = found.get(key_for_address[address_id])
+        if point is None:
+            continue
+        # locations.csv goes by nickname, it's how initdb.py matches it to
+        # the address sheet
+        locations[nickname] = point
+        if (latitude, longitude, precision) != point:
+            changes[address_id] = { "address_id": address_id, "lat": point[0], "lon": point[1],
+                                    "precision": point[2],
+                                    "hash": encode_geohash(point[0], point[1]) }
+    return changes
+
+
+def geocode_facilities(provider_names, cache_path: str, locations_path: str, postal_codes_path: str,
+                       retry_not_found: bool=False):
+    """ Geocode every facility's address, save the results. Needs an app context. """
+    rows = (db.session.query(Facility.nickname, Address.id,
+                             Address.address_1, Address.address_2, Address.suite, Address.city,
+                             Address.state, Address.postal, Address.country,
+                             Address.latitude, Address.longitude, Address.location_precision)
+            .join(Facility.address)
+            .order_by(Facility.id)
+            .all())
+
+    key_for_address, queries = address_keys(rows)
+    print(f"{len(rows)} facilities, {len(queries)} different addresses")
+
+    cache = GeocodeCache(cache_path)
+    providers = make_providers(provider_names, rows)
+    found = geocode_addresses(queries, providers, cache, retry_not_found)
+    cache.save()
+    print(f"Cache: {cache.stats()}")
+    for provider in providers:
+        print(f"  {provider.name}: {provider.stats()}")
+
+    # geocoders give us the street address - whatever they didn't find, we
+    # try to place by its postal code
+    found = { key: (latitude, longitude, PRECISION_ADDRESS)
+              for key, (latitude, longitude, provider) in found.items() }
+    found.update(postal_code_locations(rows, key_for_address, found, postal_codes_path))
+
+    locations = read_locations(locations_path)
+    changes = address_changes(rows, key_for_address, found, locations)
+    write_locations(locations_path, locations)
+    if changes:
+        statement = (update(Address.__table__)
+                     .where(Address.__table__.c.id == bindparam("address_id"))
+                     .values(latitude=bindparam("lat"), longitude=bindparam("lon"),
+                             location_precision=bindparam("precision"),
+                             geohash=bindparam("hash")))
+        db.session.execute(statement, list(changes.values()))
+        # a new data version tells a running server.py to rebuild its map
+        # layers and drop cached results
+        db.session.add(DataVersion())
+        db.session.commit()
+    missing = sum(1 for row in rows if key_for_address[row[1]] not in found)
+    print(f"Updated {len(changes)} addresses, {missing} facilities still have no coordinates")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="geocode our facilities' addresses")
+    arg_parser.add_argument("-provider", action="append", choices=["nominatim", "fake"],
+                            help="geocoder to use (more than one works at the same time)")
+    arg_parser.add_argument("-retry", action="store_true",
+                            help="look up addresses no geocoder found last time again")
+    arg_parser.add_argument("-offline", action="store_true",
+                            help="no geocoders - only the cache and postal code centroids")
+    arg_parser.add_argument("-postal-codes", default="./data/postal_codes.txt",
+                            help="a GeoNames postal code file")
+    arg_parser.add_argument("-cache", default="./data/geocode_cache.csv")
+    arg_parser.add_argument("-locations", default="./data/locations.csv")
+    args = arg_parser.parse_args()
+
+    from server import app
+    app.app_context().push()
+    if args.offline:
+        if not os.path.exists(args.postal_codes):
+            raise SystemExit(f"-offline needs a GeoNames postal code file at {args.postal_codes} "
+                             f"(see the top of gc.py)")
+        provider_names = []
+    else:
+        provider_names = args.provider or ["nominatim"]
+    geocode_facilities(provider_names, args.cache, args.locations, args.postal_codes, args.retry)
@@ -0,0 +1,189 @@
+"""
+Finding farms near a place.
+
+Address.latitude and Address.longitude are plain numbers, and a database
+index on two separate numbers can't answer "what's within 50km of here?"
+very well. So every address also gets a geohash (Address.geohash, filled
+in by initdb.py): the world is split into 32 boxes, each box into 32
+smaller boxes, and so on, and a geohash is the list of boxes a point is in,
+one letter per level:
+
+    Brooklyn, NY  ->  "dr5rkx..."   (dr5 is a box around New York City)
+
+Points that are close together share the start of their geohash, so "every
+address in box dr5r" is just geohash LIKE 'dr5r%' - which an ordinary
+B-tree index answers quickly. To search an area we work out which boxes
+cover it (geohash_cover), fetch the addresses in those boxes, and then
+check the exact distance of each one.
+
+https://en.wikipedia.org/wiki/Geohash
+"""
+from model import Address, Company, Facility
+from serializers import company_dict
+from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+import math
+
+
+#####################################################################
+# Geohash helpers
+#####################################################################
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9       # about 5m x 5m boxes
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32      # north/south, at any latitude
+
+# how many boxes we're willing to look in for one search
+MAX_COVER_CELLS = 32
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int=GEOHASH_PRECISION):
+    """ The geohash of a point, or None if we don't know where it is """
+    if latitude is None or longitude is None:
+        return None
+    if math.isnan(latitude) or math.isnan(longitude):
+        return None
+
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    use_longitude = True
+    # each bit halves the box: even bits split longitude, odd bits latitude
+    while len(geohash) < precision:
+        value, value_range = ((longitude, lon_range) if use_longitude
+                              else (latitude, lat_range))
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        use_longitude = not use_longitude
+
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def cell_size(precision: int):
+    """ (height, width) in degrees of a geohash box with precision letters """
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def geohash_cover(south: float, west: float, north: float, east: float):
+    """
+    Geohash prefixes of boxes that together cover the area between
+    south/north latitude and west/east longitude. We use the smallest boxes
+    we can without needing more than MAX_COVER_CELLS of them.
+    """
+    south, north = max(south, -90.0), min(north, 90.0)
+    if west > east:
+        # the area crosses the date line (180 degrees), cover each side
+        return (geohash_cover(south, west, north, 180.0)
+                | geohash_cover(south, -180.0, north, east))
+
+    cells = {""}
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        height, width = cell_size(precision)
+        rows = range(math.floor((south + 90) / height), math.floor((north + 90) / height) + 1)
+        columns = range(math.floor((west + 180) / width), math.floor((east + 180) / width) + 1)
+        if len(rows) * len(columns) > MAX_COVER_CELLS:
+            break
+        # the geohash of the middle of each box
+        cells = { encode_geohash(min(-90 + (row + 0.5) * height, 90.0),
+                                 min(-180 + (column + 0.5) * width, 180.0), precision)
+                  for row in rows for column in columns }
+    return cells
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float):
+    """ Distance between two points along the earth's surface (haversine formula) """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def box_around(latitude: float, longitude: float, km: float):
+    """ (south, west, north, east) of a box that holds a circle of km around a point """
+    lat_change = km / KM_PER_DEGREE
+    lon_change = km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    if lon_change >= 180:
+        west, east = -180.0, 180.0
+    else:
+        west = (longitude - lon_change + 180) % 360 - 180
+        east = (longitude + lon_change + 180) % 360 - 180
+    return latitude - lat_change, west, latitude + lat_change, east
+
+
+#####################################################################
+# Queries
+#####################################################################
+
+def facilities_in_cells(cells):
+    """
+    Facilities (with their address, company, company address and products)
+    whose address geohash starts with any of cells
+    """
+    if "" in cells:
+        # the area is the whole world
+        cell_filter = Address.geohash.isnot(None)
+    else:
+        cell_filter = or_(*[Address.geohash.startswith(cell) for cell in sorted(cells)])
+
+    return (Facility.query
+            .join(Facility.address)
+            .options(contains_eager(Facility.address),
+                     joinedload(Facility.company).selectinload(Company.products))
+            .filter(cell_filter)
+            .all())
+
+
+def facilities_near(latitude: float, longitude: float, km: float, limit: int=None):
+    """ Facilities within km of a point, closest first """
+    found = []
+    for facility in facilities_in_cells(geohash_cover(*box_around(latitude, longitude, km))):
+        distance = distance_km(latitude, longitude,
+                               facility.address.latitude, facility.address.longitude)
+        if distance <= km:
+            found.append((distance, facility))
+    found.sort(key=lambda pair: (pair[0], pair[1].id))
+    return found[:limit]
+
+
+def facilities_in_box(south: float, west: float, north: float, east: float, limit: int=None):
+    """ Facilities inside a box (like the part of the map on screen), closest to its middle first """
+    middle_lat = (south + north) / 2
+    middle_lon = (west + east) / 2 if west <= east else ((west + east + 360) / 2 + 180) % 360 - 180
+    found = []
+    for facility in facilities_in_cells(geohash_cover(south, west, north, east)):
+        address = facility.address
+        inside_lon = (west <= address.longitude <= east if west <= east
+                      else address.longitude >= west or address.longitude <= east)
+        if south <= address.latitude <= north and inside_lon:
+            distance = distance_km(middle_lat, middle_lon, address.latitude, address.longitude)
+            found.append((distance, facility))
+    found.sort(key=lambda pair: (pair[0], pair[1].id))
+    return found[:limit]
+
+
+def facility_result(facility: Facility, distance: float):
+    """ The dict we send back for one facility found on the map """
+    this_facility = facility.to_dict()
+    this_facility.update({ "address": facility.address.to_dict() })
+    company = facility.company
+    return {
+        "facility": this_facility,
+        "company": company_dict(company) if company else None,
+        "products": [product.to_dict() for product in company.products] if company else [],
+        "distance_km": round(distance, 3),
+    }
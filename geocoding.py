@@ -0,0 +1,469 @@
+"""
+Turning our addresses into map coordinates (geocoding), without asking
+anyone twice.
+
+A geocoder is a web service: we send it "212 Rome Street Newark NJ 07105"
+and it sends back a latitude and longitude. They're slow and ask us not to
+send more than about one request a second, so:
+
+  * every answer goes in a cache file (data/geocode_cache.csv) that's kept
+    between runs - an address we've looked up before is never sent again
+  * the cache is keyed by a normalized address string (lower case, no
+    punctuation, "street" -> "st" ...), so "212 Rome Street" and
+    "212 Rome St." are the same address, and facilities that share an
+    address ("AeroFarms HQ Farm" and "AeroFarms HQ Office") are looked up
+    once
+  * each geocoder (a "provider") gets a token bucket that hands out
+    permission to send one request at a time, at the rate the provider
+    allows - and several providers can work through our addresses at the
+    same time, each at its own rate. An address one provider can't find
+    is handed to a provider that hasn't tried it yet.
+
+to use:
+    cache = GeocodeCache("./data/geocode_cache.csv")
+    providers = [Provider("nominatim", nominatim_geocoder(), per_second=1)]
+    found = geocode_addresses(queries, providers, cache)   # queries: key -> address text
+    cache.save()
+
+FakeGeocoder answers from a dict instead of the internet, for trying all
+this out without a network (see gc.py -provider fake).
+
+With no geocoder at all, PostalCentroids finds the middle of an address's
+postal code (or failing that, its city) in a GeoNames postal code file -
+less exact, but a whole sheet of addresses takes milliseconds. Every
+coordinate is marked with how exact it is (PRECISION_ADDRESS, _POSTAL,
+_CITY), so the map can show approximate points differently.
+"""
+import csv
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+
+import pandas as pd
+
+# geopy talks to the real geocoders ("pip install geopy") - without it we
+# can still use the cache and FakeGeocoder
+try:
+    from geopy.geocoders import Nominatim
+except ImportError:
+    Nominatim = None
+
+
+#####################################################################
+# Normalizing addresses
+#####################################################################
+
+# the spellings we turn into one (whole words only)
+ADDRESS_ABBREVIATIONS = {
+    "street": "st", "avenue": "ave", "road": "rd", "boulevard": "blvd",
+    "drive": "dr", "lane": "ln", "court": "ct", "place": "pl",
+    "parkway": "pkwy", "highway": "hwy", "suite": "ste", "building": "bldg",
+    "north": "n", "south": "s", "east": "e", "west": "w",
+}
+
+
+def address_query(address_1=None, address_2=None, suite=None, city=None, state=None,
+                  postal=None, country=None):
+    """ The text we send a geocoder for an address, e.g. "212 Rome Street Newark NJ 07105" """
+    if postal is not None:
+        postal = str(postal)
+        # postal codes that went through a float column look like "7105.0"
+        if postal.endswith(".0"):
+            postal = postal[:-2]
+    parts = [address_1, address_2, suite, city, state, postal, country]
+    return " ".join(str(part).strip() for part in parts if part is not None and str(part).strip())
+
+
+def normalize_address(query: str):
+    """ The cache key for an address: "212 Rome Street," -> "212 rome st" """
+    words = re.sub(r"[^\w\s]", " ", query.lower()).split()
+    return " ".join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+#####################################################################
+# The cache
+#####################################################################
+
+class GeocodeCache(object):
+    """
+    Normalized address -> (latitude, longitude, provider), saved as a CSV.
+    Addresses no provider could find are kept too (with no coordinates),
+    so we don't ask again every run.
+    """
+
+    COLUMNS = ["address_key", "latitude", "longitude", "provider", "geocoded_at"]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        if os.path.exists(path):
+            with open(path, newline="") as file:
+                for row in csv.DictReader(file):
+                    found = row["latitude"] != ""
+                    self.entries[row["address_key"]] = {
+                        "latitude": float(row["latitude"]) if found else None,
+                        "longitude": float(row["longitude"]) if found else None,
+                        "provider": row["provider"],
+                        "geocoded_at": row["geocoded_at"],
+                    }
+
+    def get(self, key: str):
+        """ The entry for key, or None if we've never looked it up """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, latitude, longitude, provider: str):
+        self.entries[key] = {
+            "latitude": latitude,
+            "longitude": longitude,
+            "provider": provider,
+            "geocoded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self.changed = True
+
+    def save(self):
+        """ Write the cache out, if anything changed (all at once, so it's never half-written) """
+        if not self.changed:
+            return
+        folder = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(suffix=".csv", dir=folder)
+        try:
+            with os.fdopen(handle, "w", newline="") as file:
+                writer = csv.DictWriter(file, self.COLUMNS)
+                writer.writeheader()
+                for key in sorted(self.entries):
+                    entry = self.entries[key]
+                    writer.writerow({"address_key": key,
+                                     **{ name: "" if value is None else value
+                                         for name, value in entry.items() }})
+            os.replace(temp_path, self.path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.changed = False
+
+    def stats(self):
+        found = sum(1 for entry in self.entries.values() if entry["latitude"] is not None)
+        return {
+            "addresses": len(self.entries),
+            "found": found,
+            "not_found": len(self.entries) - found,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+#####################################################################
+# Providers and rate limits
+#####################################################################
+
+class TokenBucket(object):
+    """
+    Permission to make per_second requests a second on average. The bucket
+    holds up to burst tokens and refills as time passes; each request takes
+    one, waiting for it if the bucket is empty.
+    https://en.wikipedia.org/wiki/Token_bucket
+    """
+
+    def __init__(self, per_second: float, burst: int=1):
+        self.per_second = per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait until there's a token, then take it. Returns how long we waited. """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_second)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.per_second
+            time.sleep(wait)
+            waited += wait
+
+
+# what Provider.lookup returns when the geocoder had a problem - unlike "not
+# found", we don't remember it, so the address is tried again next run
+FAILED = "failed"
+
+
+class Provider(object):
+    """
+    A geocoder and its rate limit. geocode is a function that takes the
+    address text and returns (latitude, longitude), or None if it can't
+    find it.
+    """
+
+    def __init__(self, name: str, geocode, per_second: float=1, burst: int=1):
+        self.name = name
+        self.geocode = geocode
+        self.bucket = TokenBucket(per_second, burst)
+        self.requests = 0
+        self.found = 0
+        self.errors = 0
+        self.waited_seconds = 0.0
+
+    def lookup(self, query: str):
+        """
+        Wait our turn, then ask the geocoder. Returns (latitude, longitude),
+        None if it can't find the address, or FAILED if something went wrong
+        (a timeout, an error from the service).
+        """
+        self.waited_seconds += self.bucket.acquire()
+        self.requests += 1
+        try:
+            result = self.geocode(query)
+        except Exception as err:
+            print(f"  !!! {self.name} couldn't geocode {query!r}: {err}")
+            self.errors += 1
+            return FAILED
+        if result is not None:
+            self.found += 1
+        return result
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "found": self.found,
+            "errors": self.errors,
+            "waited_seconds": round(self.waited_seconds, 2),
+        }
+
+
+def nominatim_geocoder(user_agent: str="visible-gardens"):
+    """
+    A geocode function for OpenStreetMap's Nominatim - free, but at most one
+    request a second: https://operations.osmfoundation.org/policies/nominatim/
+    """
+    if Nominatim is None:
+        raise RuntimeError("the nominatim provider needs geopy (pip install geopy)")
+    locator = Nominatim(user_agent=user_agent)
+
+    def geocode(query):
+        location = locator.geocode(query, timeout=10)
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+    return geocode
+
+
+class FakeGeocoder(object):
+    """
+    A pretend geocoder that knows the coordinates in coordinates (address
+    text or normalized address -> (latitude, longitude)) and takes
+    delay_seconds to answer, like a real one would
+    """
+
+    def __init__(self, coordinates: dict, delay_seconds: float=0):
+        self.coordinates = { normalize_address(query): point for query, point in coordinates.items() }
+        self.delay_seconds = delay_seconds
+        self.queries = []
+
+    def __call__(self, query: str):
+        self.queries.append(query)
+        time.sleep(self.delay_seconds)
+        return self.coordinates.get(normalize_address(query))
+
+
+#####################################################################
+# Geocoding a batch of addresses
+#####################################################################
+
+def geocode_addresses(queries: dict, providers, cache: GeocodeCache, retry_not_found: bool=False):
+    """
+    queries is address key -> address text (see address_query and
+    normalize_address). Looks up the addresses the cache doesn't have
+    (and the ones no provider could find last time, with
+    retry_not_found), each provider working on its own thread at its own
+    rate. Puts the answers in the cache and returns
+    address key -> (latitude, longitude, provider) for every address we
+    have coordinates for.
+    """
+    to_look_up = deque()
+    for key, query in queries.items():
+        entry = cache.get(key)
+        if entry is None or (retry_not_found and entry["latitude"] is None):
+            # [key, text, names of the providers that have tried it, did one fail]
+            to_look_up.append([key, query, set(), False])
+
+    if to_look_up and providers:
+        print(f"Geocoding {len(to_look_up)} addresses with {', '.join(p.name for p in providers)}")
+        condition = threading.Condition()
+        in_flight = [0]
+        provider_names = { provider.name for provider in providers }
+
+        def next_address(provider):
+            """ The next address this provider hasn't tried, or None when there won't be one """
+            with condition:
+                while True:
+                    for item in to_look_up:
+                        if provider.name not in item[2]:
+                            to_look_up.remove(item)
+                            in_flight[0] += 1
+                            return item
+                    # nothing for us now - but an address another provider
+                    # is working on might come back to us
+                    if in_flight[0] == 0:
+                        return None
+                    condition.wait()
+
+        def work(provider):
+            while True:
+                item = next_address(provider)
+                if item is None:
+                    return
+                key, query, tried, _ = item
+                point = provider.lookup(query)
+                with condition:
+                    in_flight[0] -= 1
+                    tried.add(provider.name)
+                    if point is FAILED:
+                        item[3] = True
+                        point = None
+                    if point is not None:
+                        cache.put(key, point[0], point[1], provider.name)
+                    elif tried != provider_names:
+                        to_look_up.append(item)
+                    elif not item[3]:
+                        # every provider looked and none found it
+                        cache.put(key, None, None, ",".join(sorted(tried)))
+                    condition.notify_all()
+
+        threads = [ threading.Thread(target=work, args=(provider,)) for provider in providers ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    found = {}
+    for key in queries:
+        entry = cache.entries.get(key)
+        if entry is not None and entry["latitude"] is not None:
+            found[key] = (entry["latitude"], entry["longitude"], entry["provider"])
+    return found
+
+
+#####################################################################
+# Offline: the middle of each postal code
+#####################################################################
+
+# how exact a coordinate is (Address.location_precision)
+PRECISION_ADDRESS = "address"     # a geocoder found the street address
+PRECISION_POSTAL = "postal"       # the middle of the address's postal code
+PRECISION_CITY = "city"           # the middle of the address's city
+
+# the columns of a GeoNames postal code file (tab separated, no header row),
+# from https://download.geonames.org/export/zip/ - e.g. US.zip has US.txt,
+# allCountries.zip has every country
+GEONAMES_POSTAL_COLUMNS = ["country_code", "postal_code", "place_name",
+                           "admin_name1", "admin_code1", "admin_name2", "admin_code2",
+                           "admin_name3", "admin_code3", "latitude", "longitude", "accuracy"]
+
+# how our sheets spell countries -> the two letter codes GeoNames uses
+COUNTRY_CODES = {
+    "usa": "US", "us": "US", "united states": "US", "united states of america": "US",
+    "uae": "AE", "united arab emirates": "AE",
+    "canada": "CA", "uk": "GB", "united kingdom": "GB",
+}
+
+
+def country_codes(countries: pd.Series):
+    """ Two letter country codes for a column of country names ("USA" -> "US") """
+    names = countries.astype("string").str.strip()
+    codes = names.str.lower().map(COUNTRY_CODES)
+    # anything already two letters long we take as a code
+    two_letters = names.str.len() == 2
+    return codes.fillna(names.str.upper().where(two_letters))
+
+
+def postal_keys(postal_codes: pd.Series):
+    """ Postal codes the way GeoNames writes them: "07105-1234" -> "07105", "m5v 2t6" -> "M5V2T6" """
+    return (postal_codes.astype("string").str.upper()
+            .str.replace(r"\.0$", "", regex=True)
+            .str.replace(r"\s+", "", regex=True)
+            .str.split("-").str[0])
+
+
+class PostalCentroids(object):
+    """
+    The middle of every postal code (and city) in a GeoNames postal code file
+
+    to use:
+        centroids = PostalCentroids("./data/postal_codes.txt")
+        located = centroids.locate(df_addresses)   # needs postal/city/state/country columns
+    """
+
+    def __init__(self, path: str):
+        started = time.perf_counter()
+        # keep_default_na=False - "NA" is Namibia, not a blank
+        df = pd.read_csv(path, sep="\t", header=None, names=GEONAMES_POSTAL_COLUMNS,
+                         usecols=["country_code", "postal_code", "place_name", "admin_code1",
+                                  "latitude", "longitude"],
+                         dtype=str, keep_default_na=False, quoting=csv.QUOTE_NONE)
+        frame = pd.DataFrame({
+            "country": df["country_code"].str.upper(),
+            "postal": postal_keys(df["postal_code"]),
+            "state": df["admin_code1"].str.upper(),
+            "city": df["place_name"].str.lower(),
+            "latitude": pd.to_numeric(df["latitude"], errors="coerce"),
+            "longitude": pd.to_numeric(df["longitude"], errors="coerce"),
+        }).dropna(subset=["latitude", "longitude"])
+
+        # a postal code (or city) can have several rows - we use their middle
+        self.by_postal = frame.groupby(["country", "postal"])[["latitude", "longitude"]].mean()
+        self.by_city = frame.groupby(["country", "state", "city"])[["latitude", "longitude"]].mean()
+        self.path = path
+        self.load_seconds = time.perf_counter() - started
+
+    def locate(self, addresses: pd.DataFrame):
+        """
+        latitude, longitude and location_precision for each row of
+        addresses (same index), from its postal code if we have it, or its
+        city. Rows we can't place are left blank.
+        """
+        keys = pd.DataFrame({
+            "country": country_codes(addresses["country"]),
+            "postal": postal_keys(addresses["postal"]),
+            "state": addresses["state"].astype("string").str.strip().str.upper(),
+            "city": addresses["city"].astype("string").str.strip().str.lower(),
+        }, index=addresses.index)
+        # a missing country is most likely the US, like most of our farms
+        keys["country"] = keys["country"].fillna("US")
+
+        by_postal = keys.join(self.by_postal, on=["country", "postal"])
+        by_city = keys.join(self.by_city, on=["country", "state", "city"])
+
+        has_postal = by_postal["latitude"].notna()
+        has_city = ~has_postal & by_city["latitude"].notna()
+        located = pd.DataFrame({
+            "latitude": by_postal["latitude"].where(has_postal, by_city["latitude"]),
+            "longitude": by_postal["longitude"].where(has_postal, by_city["longitude"]),
+            "location_precision": None,
+        }, index=addresses.index)
+        located.loc[has_postal, "location_precision"] = PRECISION_POSTAL
+        located.loc[has_city, "location_precision"] = PRECISION_CITY
+        return located
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "postal_codes": len(self.by_postal),
+            "cities": len(self.by_city),
+            "load_seconds": round(self.load_seconds, 3),
+        }
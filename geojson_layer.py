@@ -0,0 +1,129 @@
+"""
+Every facility as one GeoJSON file, for drawing all our farms on the map.
+
+    {"type": "FeatureCollection", "features": [
+        {"type": "Feature",
+         "geometry": {"type": "Point", "coordinates": [-73.98, 40.67]},
+         "properties": {"facility_id": 29, "nickname": "...", "company_id": 7,
+                        "trade_name": "...", "city": "Brooklyn", "state": "NY"}},
+        ...]}
+
+The file only changes when initdb.py loads new data, so we make it once per
+data load and keep it ready to send three ways: as it is, gzip-compressed
+and brotli-compressed. Browsers tell us which ones they can read in their
+Accept-Encoding header, and we send the smallest one they understand -
+compressing it again for every request would cost more than making it did.
+
+to use:
+    layer = GeoJSONLayer()
+    layer.rebuild()              # needs an app context, reads our tables
+    encoding, body, etag = layer.body_for(["br", "gzip"])
+    print(layer.stats())
+
+https://geojson.org/
+"""
+from db_utils.rebuildable import Rebuildable
+from model import db, Address, Company, Facility
+import gzip
+import hashlib
+import json
+
+# brotli squeezes text about 15-20% smaller than gzip, but it's an extra
+# package ("pip install Brotli") - without it we just offer gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# coordinates to 6 decimal places is about 10cm, more digits are just bytes
+COORDINATE_DIGITS = 6
+
+
+def facility_features():
+    """ A GeoJSON Feature for every facility we know the location of """
+    rows = (db.session.query(Facility.id, Facility.nickname, Facility.type,
+                             Facility.company_id, Company.trade_name,
+                             Address.city, Address.state, Address.country,
+                             Address.latitude, Address.longitude, Address.location_precision)
+            .join(Facility.address)
+            .outerjoin(Facility.company)
+            .filter(Address.latitude.isnot(None), Address.longitude.isnot(None))
+            .order_by(Facility.id))
+
+    for (facility_id, nickname, facility_type, company_id, trade_name,
+         city, state, country, latitude, longitude, precision) in rows:
+        if latitude != latitude or longitude != longitude:
+            # NaN - we don't know where this one is
+            continue
+        yield {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [round(longitude, COORDINATE_DIGITS),
+                                round(latitude, COORDINATE_DIGITS)],
+            },
+            "properties": {
+                "facility_id": facility_id,
+                "nickname": nickname,
+                "type": facility_type,
+                "company_id": company_id,
+                "trade_name": trade_name,
+                "city": city,
+                "state": state,
+                "country": country,
+                # "address", or "postal"/"city" for an approximate point
+                "precision": precision,
+            },
+        }
+
+
+class GeoJSONLayer(Rebuildable):
+
+    label = "facilities GeoJSON"
+
+    def __init__(self):
+        super().__init__()
+        # (content encoding ("identity", "gzip", "br") -> body bytes,
+        #  the fingerprint of the uncompressed body, number of features)
+        # - one tuple, so a request never gets one build's body with
+        # another build's ETag
+        self.current = ({}, None, 0)
+
+    def build(self):
+        """
+        Make the GeoJSON for every facility and compress it every way we
+        can. The new bodies are swapped in all at once.
+        """
+        features = list(facility_features())
+        body = json.dumps({"type": "FeatureCollection", "features": features},
+                          separators=(",", ":")).encode()
+        # mtime=0 keeps the gzip bytes the same every time we build
+        # the same data
+        bodies = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            bodies["br"] = brotli.compress(body, quality=11)
+
+        self.current = (bodies, hashlib.sha1(body).hexdigest(), len(features))
+
+    def body_for(self, accepted_encodings):
+        """
+        (encoding, body bytes, ETag) - the smallest body in one of
+        accepted_encodings, or the uncompressed one, and the ETag of the
+        build it came from
+        """
+        bodies, etag, features = self.current
+        choices = [ encoding for encoding in accepted_encodings if encoding in bodies ]
+        choices.append("identity")
+        encoding = min(choices, key=lambda encoding: len(bodies[encoding]))
+        return encoding, bodies[encoding], etag
+
+    def stats(self):
+        """ How many features the layer has and how big each encoding is """
+        bodies, etag, features = self.current
+        return {
+            "features": features,
+            "bytes": { encoding: len(body) for encoding, body in bodies.items() },
+            "etag": etag,
+            **super().stats(),
+        }
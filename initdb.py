@@ -1,21 +1,30 @@
 from typing import ClassVar, List
 from model import Company, Address, Product, Facility
-from model import db
-from sqlalchemy import create_engine
+from model import db, refresh_search_vectors, DataVersion, RowHash
+from sqlalchemy import bindparam, delete, insert, text, update
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import DBAPIError
+import numpy as np
 import pandas as pd
+import psycopg2
 import argparse
+import json
 import os
-from db_utils import download_google_worksheet, backup_data_file, get_matching_column_names
+from geo import encode_geohash
+from geocoding import PRECISION_ADDRESS, PostalCentroids
+from db_utils import download_google_worksheets, get_matching_column_names
+from db_utils.clean import clean_sheet, read_sheet, sheet_dtypes
+from db_utils.bulk_load import add_ids, copy_dataframe, frame_for_table, reset_id_sequence
+from db_utils.row_sync import diff_rows, hash_rows, records
+from db_utils.snapshots import save_snapshot
 
 
 #####################################################################
 # Setup/Configuraton
 #####################################################################
 
-# TODO: get DB_URI from a config
-from server import DB_URI
+# the database comes from DATABASE_URL and friends (see db_utils/engine.py)
+from db_utils.engine import make_engine
 
 # The ID of our google sheets document see the "sharing url" to find this
 GSHEET_ID = "1IXViZcOCmt5ZO-QJBKQ0HUjwna52Vnr6_WcMlQbpCp4"
@@ -28,6 +37,15 @@ GSHEET_ID = "1IXViZcOCmt5ZO-QJBKQ0HUjwna52Vnr6_WcMlQbpCp4"
 # data folder with the contents of our google sheet document:
 #  $ python ./initdb.py -update all 
 #  $ python ./initdb.py -update [sheet name]
+#
+# and these pick how we load our data into the database:
+#  $ python ./initdb.py -loader copy    (the default, see load_with_copy)
+#  $ python ./initdb.py -loader orm     (one model object per row)
+#  $ python ./initdb.py -loader sync    (only change rows that changed,
+#                                        see load_with_sync)
+#  $ python ./initdb.py -data ./some/other/folder   (where the CSVs are)
+#  $ python ./initdb.py -rollback      (put back the tables from before the
+#                                       last full load, see swap_in_staging)
 #####################################################################
 
 sheet_names = [
@@ -42,6 +60,10 @@ sheet_names = [
 # contents of our google sheets worksheets
 arg_parser = argparse.ArgumentParser(description="backup CSVs and replace")
 arg_parser.add_argument("-update", action="store")
+arg_parser.add_argument("-loader", action="store", choices=["copy", "orm", "sync"],
+                        default="copy")
+arg_parser.add_argument("-data", action="store", default="./data")
+arg_parser.add_argument("-rollback", action="store_true")
 # you can add more 'add_argument' lines like the one immediately 
 # above when you want to create more arguments
 args = vars(arg_parser.parse_args())
@@ -53,89 +75,102 @@ if args.get('update', False):
     # print(
     # f"We're going to update our {args['update']} data from google sheets")
 
-    # this makes sure we have a data dir and a backup dir
-    os.makedirs("./data/backup", exist_ok=True)
+    # this makes sure we have a data dir, and keeps a snapshot of the
+    # sheets we have now in case the new ones are bad (see db_utils/snapshots.py)
+    os.makedirs("./data", exist_ok=True)
+    save_snapshot("./data", note="before -update", skip_if_unchanged=True)
 
-    if thing_name == "all":
-        for sheet_name in sheet_names:
-            backup_data_file(sheet_name)
-            download_google_worksheet(GSHEET_ID, sheet_name)
-    else:
-        backup_data_file(thing_name)
-        download_google_worksheet(GSHEET_ID, thing_name)
+    # all the sheets download at the same time, and a sheet that hasn't
+    # changed since last time isn't backed up or written again
+    # (see db_utils/sheet_download.py)
+    names_to_update = sheet_names if thing_name == "all" else [thing_name]
+    results = download_google_worksheets(GSHEET_ID, names_to_update)
+    for sheet_name, result in results.items():
+        print(f"  {sheet_name}: {result}")
+    if "failed" in results.values():
+        raise SystemExit(1)
 
 
 #####################################################################
 # Functions for finding rows we need in csv files / worksheets
+#
+# We need "the products of company X", "the address with nickname Y" for
+# every company and facility. Instead of searching the whole sheet once
+# per company, we go through each sheet ONCE and make a dict from the
+# value we look things up by to the rows that have it:
+#
+#   products_by_company = index_sheet(df_product_sheet, 'company_trade_name', product_fields)
+#   products_by_company["AeroFarms"] -> [{"name": "Arugula", ...}, ...]
+#
+# Looking a company up in the dict takes the same time however big the
+# sheet is (and a trade name like "Nature's Greens" is just a dict key).
 #####################################################################
 
 
-def find_first_matching(join_column_value: str, # column value to look for 
-                        df_to_search: pd.DataFrame, # daframe to look in
-                        join_column_name: str, # column name to look in
-                        columns: List[str], # cols to use when creating a result
-                        _class: db.Model, # class type of object to create
-                        query: str=None
-                        ):
-
-
+def index_sheet(df_to_search: pd.DataFrame, # daframe to look in
+                join_column_name: str, # column name we'll look things up by
+                columns: List[str], # cols to use when creating a result
+                rows_to_use: pd.Series=None # True for the rows to include
+                ):
     """
-    Function takes in a value, a dataframe to search, the column name to search, 
-    and a lst of columns to return as a result and creates an object of type
-    specified  
+    Go through a sheet once and return a dict of join column value -> list
+    of dicts (one per matching row, in sheet order, just the given columns)
     """
+    if join_column_name not in df_to_search.columns.values:
+        print(f"!!!!!!! {join_column_name} : Join column not found!  Columns:")
+        print(df_to_search.columns.values)
+        return {}
 
-    # Use pandas DataFrame.query to find address records in the spreadsheet
-    # where the company trade name matches
-    df_matching = df_to_search.query(f" {join_column_name} == '{join_column_value}' ")
-    if query: 
-        df_matching = df_matching.query(query)
-    if df_matching.shape[0] >= 1:
-        # we found at least one matching row - we'll add the first/only one found
-        # pandas iloc[] function lets us select rows by index
-        row = df_matching.iloc[0]
-        address_fields_dict = row[columns].to_dict()
-        return _class(**address_fields_dict)
-    else:
-        print(f"   !!! !!! No {_class.__name__} found for {join_column_value} !!! !!!")
-
-
-
-# def find_all_matching(join_column_name: str,
-#                       join_column_value: str,
-#                       df_to_search: pd.DataFrame,
-#                       columns: List[str],
-#                       _class: db.Model
-#                       ):
-#
+    if rows_to_use is not None:
+        df_to_search = df_to_search[rows_to_use]
+    # records() turns blank cells into None, which SQLAlchemy saves as NULL
+    return { value: records(rows[columns])
+             for value, rows in df_to_search.groupby(join_column_name, sort=False) }
 
 
-def find_all_matching(join_column_value: str, #  value to look for 
-                        df_to_search: pd.DataFrame, # daframe to look for it in
-                        join_column_name: str, # column name to look in
-                        columns: List[str], # cols to use when creating a result
+def find_first_matching(join_column_value: str, # column value to look for
+                        sheet_index: dict, # made by index_sheet
                         _class: db.Model # class type of object to create
                         ):
+    """ An object of type _class made from the first row with join_column_value, or None """
+    rows = sheet_index.get(join_column_value)
+    if rows:
+        return _class(**rows[0])
 
 
+def find_all_matching(join_column_value: str, #  value to look for
+                      sheet_index: dict, # made by index_sheet
+                      _class: db.Model # class type of object to create
+                      ):
     """
     Given a company name, find products in the spreadsheet where the company_trade_name matches.
     Return a list of Product objects we can insert.
     """
-    # initialize an empty list to return
-    result = []
+    return [ _class(**fields_dict) for fields_dict in sheet_index.get(join_column_value, []) ]
 
-    if join_column_name not in df_to_search.columns.values:
-        print(f"!!!!!!! {_class.__name__} : Join column not found!  Columns:")
-        return
-
-    df_matching = df_to_search.query(f"{join_column_name} == '{join_column_value}'")
 
-    for row in df_matching[columns].itertuples(index=False):
-        fields_dict = row._asdict()
-        result.append(_class(**fields_dict))
-
-    return result
+def report_missing(df_looking: pd.DataFrame, # rows that need a match
+                   looking_column_name: str, # the value they look for
+                   df_to_search: pd.DataFrame, # the sheet they look in
+                   join_column_name: str, # the column they look in
+                   _class: db.Model, # what they're looking for
+                   rows_to_use: pd.Series=None # True for the rows of df_to_search to use
+                   ):
+    """
+    Print every value in df_looking's looking column that no row of
+    df_to_search has - all at once, with one isin() (an "anti-join")
+    instead of one check per row
+    """
+    if rows_to_use is not None:
+        df_to_search = df_to_search[rows_to_use]
+    values = df_looking[looking_column_name]
+    missing = values[~values.isin(df_to_search[join_column_name])].drop_duplicates()
+    if len(missing):
+        print(f"   !!! !!! No {_class.__name__} found for {len(missing)} "
+              f"{looking_column_name} values: !!! !!!")
+        for value in missing:
+            print(f"      {value}")
+    return missing
 
 
 #####################################################################
@@ -145,17 +180,171 @@ def find_all_matching(join_column_value: str, #  value to look for
 # Note: we just want to talk to our db right now and don't yet need
 # to start up Flask, so instead of using Flask SQLalchemy to make the 
 # db connection, we're using regular SQLAlchemy's create_engine 
-# function to create en engine object, info here:
+# function (through make_engine) to create en engine object, info here:
 # https://docs.sqlalchemy.org/en/14/core/engines.html
-engine = create_engine(DB_URI)
+# (no statement timeout - building the search vectors for a big product
+# sheet takes a while)
+engine = make_engine(statement_timeout_ms=0)
+
+#####################################################################
+# Full loads (-loader copy or orm) happen off to the side, so the site
+# keeps working while we load:
+#
+#   1. make an empty "staging" schema (a schema is a folder of tables
+#      inside our database) and all of our tables in it
+#   2. load everything into the staging tables, build the search vectors,
+#      stamp a new DataVersion
+#   3. in ONE transaction, move our tables (just the ones in model.py)
+#      from "public" (where the site uses them) to a "previous" schema,
+#      and the staging ones into "public" - each new table gets the owner
+#      and grants the table it replaces had, so a server logging in as a
+#      different user can still read it
+#
+# Until step 3 commits, server.py sees only the old tables, and after it
+# only the new ones - never empty or half-loaded tables. Everything else in
+# "public" (extensions, functions, other apps' tables) stays where it is.
+# The old tables stay in "previous" until the next full load, so if the
+# new data is bad:
+#  $ python ./initdb.py -rollback
+# swaps them back instead.
+#
+# The user initdb.py connects as has to own our tables (it made them) and
+# be allowed to create tables in "public" and make schemas in our database.
+# If the site is busy reading a table for longer than SWAP_LOCK_TIMEOUT_MS,
+# the swap gives up and changes nothing - just run initdb.py again.
+# https://www.postgresql.org/docs/current/ddl-schemas.html
+#####################################################################
+
+STAGING_SCHEMA = "staging"
+PREVIOUS_SCHEMA = "previous"
+# moving a table waits for requests reading it to finish, and new requests
+# wait behind the move - give up rather than hold the site up for long
+SWAP_LOCK_TIMEOUT_MS = 10000
+
+# the same database, but where our table names mean the tables in the
+# staging schema (PostgreSQL looks table names up in the schemas on the
+# search_path, and we only put staging on it)
+staging_engine = make_engine(statement_timeout_ms=0, search_path=STAGING_SCHEMA)
 
-# We'll use SQL Alchemy's metadata object here to drop and create
-# our tables
+
+# We'll use SQL Alchemy's metadata object here to create our tables
 # https://docs.sqlalchemy.org/en/14/tutorial/metadata.html#tutorial-working-with-metadata
-print("Dropping tables!!!!!")
-db.metadata.drop_all(engine)  
-print("Creating tables!")
-db.metadata.create_all(engine)  
+def recreate_tables():
+    """ A fresh, empty staging schema with all of our tables in it """
+    print("Dropping staging tables!!!!!")
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {STAGING_SCHEMA}"))
+    print("Creating staging tables!")
+    db.metadata.create_all(staging_engine)
+
+
+def schema_exists(connection, schema_name: str):
+    return connection.execute(text("SELECT 1 FROM pg_namespace WHERE nspname = :name"),
+                              {"name": schema_name}).scalar() is not None
+
+
+def table_exists(connection, schema_name: str, table_name: str):
+    return connection.execute(text("SELECT to_regclass(:name)"),
+                              {"name": f'{schema_name}."{table_name}"'}).scalar() is not None
+
+
+def move_our_tables(connection, from_schema: str, to_schema: str):
+    """
+    Move every table in model.py from one schema to another - their
+    indexes, constraints and id sequences go with them
+    """
+    for table in db.metadata.sorted_tables:
+        if table_exists(connection, from_schema, table.name):
+            connection.execute(text(f'ALTER TABLE {from_schema}."{table.name}" SET SCHEMA {to_schema}'))
+
+
+# a table and the id sequences that belong to it, with their owners and
+# grants ("aclexplode" lists the grants, grantee 0 means PUBLIC)
+RELATION_ACCESS_SQL = text("""
+    SELECT relation.relname AS name,
+           pg_get_userbyid(relation.relowner) AS owner,
+           acl.privilege_type AS privilege,
+           acl.is_grantable AS grantable,
+           CASE WHEN acl.grantee = 0 THEN 'PUBLIC'
+                ELSE quote_ident(pg_get_userbyid(acl.grantee)) END AS grantee
+    FROM pg_class relation
+    JOIN pg_namespace schema ON schema.oid = relation.relnamespace
+    LEFT JOIN LATERAL aclexplode(relation.relacl) acl ON true
+    WHERE schema.nspname = :schema
+      AND (relation.relname = :table
+           OR relation.oid IN (SELECT dependency.objid FROM pg_depend dependency
+                               JOIN pg_class owner ON owner.oid = dependency.refobjid
+                               WHERE owner.relname = :table
+                                 AND owner.relnamespace = schema.oid
+                                 AND dependency.deptype = 'a'
+                                 AND relation.relkind = 'S'))
+""")
+
+
+def copy_table_access(connection, from_schema: str, to_schema: str):
+    """
+    Give each of our tables in to_schema (and its id sequences) the owner
+    and grants of the one with the same name in from_schema
+    """
+    for table in db.metadata.sorted_tables:
+        rows = connection.execute(RELATION_ACCESS_SQL,
+                                  {"schema": from_schema, "table": table.name}).all()
+        for name, owner, privilege, grantable, grantee in rows:
+            if not table_exists(connection, to_schema, name):
+                continue
+            relation = f'{to_schema}."{name}"'
+            kind = "SEQUENCE" if name != table.name else "TABLE"
+            connection.execute(text(f'ALTER {kind} {relation} OWNER TO "{owner}"'))
+            if privilege is not None and grantee != f'"{owner}"' and grantee != owner:
+                grant_option = " WITH GRANT OPTION" if grantable else ""
+                connection.execute(text(f"GRANT {privilege} ON {kind} {relation} "
+                                        f"TO {grantee}{grant_option}"))
+
+
+def swap_in_staging():
+    """ Make the staging tables the ones the site uses, keep the old ones """
+    with engine.begin() as connection:
+        connection.execute(text(f"SET LOCAL lock_timeout = {SWAP_LOCK_TIMEOUT_MS}"))
+        copy_table_access(connection, "public", STAGING_SCHEMA)
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {PREVIOUS_SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {PREVIOUS_SCHEMA}"))
+        move_our_tables(connection, "public", PREVIOUS_SCHEMA)
+        move_our_tables(connection, STAGING_SCHEMA, "public")
+        connection.execute(text(f"DROP SCHEMA {STAGING_SCHEMA}"))
+    print("Swapped in the new tables!")
+
+
+def rollback_to_previous():
+    """ Swap the tables from before the last full load back in """
+    with engine.begin() as connection:
+        if not schema_exists(connection, PREVIOUS_SCHEMA):
+            print("  !!! No previous tables to roll back to")
+            return False
+        connection.execute(text(f"SET LOCAL lock_timeout = {SWAP_LOCK_TIMEOUT_MS}"))
+        connection.execute(text("CREATE SCHEMA rolling_back"))
+        move_our_tables(connection, "public", "rolling_back")
+        move_our_tables(connection, PREVIOUS_SCHEMA, "public")
+        move_our_tables(connection, "rolling_back", PREVIOUS_SCHEMA)
+        connection.execute(text("DROP SCHEMA rolling_back"))
+    print("Rolled back to the previous tables!")
+    return True
+
+
+if args['rollback']:
+    try:
+        rolled_back = rollback_to_previous()
+    except DBAPIError as err:
+        print(f"  !!! ERROR: {err}")
+        raise SystemExit(1)
+    if rolled_back:
+        # a new version, so a running server.py drops what it cached
+        with Session(engine) as session:
+            data_version = DataVersion()
+            session.add(data_version)
+            session.commit()
+            print(f"Data version is now {data_version.version}")
+    raise SystemExit
 
 
 #####################################################################
@@ -167,33 +356,46 @@ db.metadata.create_all(engine)
 #####################################################################
 
 # load our CSV files as pandas DataFrames
-df_company_sheet = pd.read_csv('./data/company.csv')
-df_facility_sheet = pd.read_csv('./data/facility.csv')
-df_product_sheet = pd.read_csv('./data/product.csv')
-dtypes = {"postal" : "object"}
-df_address_sheet = pd.read_csv('./data/address.csv', dtype=dtypes)
-# dtypes = {"latitude" : "float64", "longitude" : "float64"}
-df_locations_sheet = pd.read_csv('./data/locations.csv', names=["nickname", "latitude", "longitude"])
-df_address_sheet = df_address_sheet.merge(df_locations_sheet, on="nickname", how="left")
-
-
-
-#####################################################################
-# Code that cleans our pandas dataframes 
+# (the product sheet is the big one - each loader below reads it itself,
+# load_with_copy a chunk at a time)
+data_dir = args['data']
+# remember exactly which sheets this load used, so we can go back to them
+# with `python -m db_utils.snapshots restore <id>` (if they're the same as
+# last time, the snapshot we already have does that)
+snapshot_id = save_snapshot(data_dir, note=f"initdb.py -loader {args['loader']}",
+                            skip_if_unchanged=True)
+print(f"Snapshot of this load's sheets: {snapshot_id}")
 #
-# First, makes sure each field in each column conforms to a dtype 
-# that is compatible with the column type of our database table
-
-#####################################################################
-
-
-df_company_sheet['for_profit'] = df_company_sheet['for_profit'].astype(bool)
-df_company_sheet['parent_id'] = df_company_sheet['parent_id'].astype("Int32")
-# df_company_sheet['total_employees'] = df_company_sheet['total_employees'].astype("Int32")
+# read_sheet converts each column that goes into a table to the pandas
+# type for that table column's type in model.py - see db_utils/clean.py
+tables = db.metadata.tables
+df_company_sheet = read_sheet(f'{data_dir}/company.csv', tables['company'])
+df_facility_sheet = read_sheet(f'{data_dir}/facility.csv', tables['facility'])
+product_sheet_path = f'{data_dir}/product.csv'
+df_address_sheet = read_sheet(f'{data_dir}/address.csv', tables['address'])
+# (locations.csv is written by gc.py - older ones don't say how exact each
+# location is, those were all geocoded street addresses)
+df_locations_sheet = pd.read_csv(f'{data_dir}/locations.csv')
+if 'location_precision' not in df_locations_sheet.columns:
+    df_locations_sheet['location_precision'] = PRECISION_ADDRESS
+df_address_sheet = df_address_sheet.merge(df_locations_sheet, on="nickname", how="left")
 
+# addresses gc.py couldn't find (or hasn't looked up yet) get the middle of
+# their postal code, if we have a GeoNames postal code file (see geocoding.py)
+postal_codes_path = f'{data_dir}/postal_codes.txt'
+unlocated = df_address_sheet['latitude'].isna()
+if unlocated.any() and os.path.exists(postal_codes_path):
+    centroids = PostalCentroids(postal_codes_path)
+    located = centroids.locate(df_address_sheet[unlocated])
+    df_address_sheet.update(located)
+    print(f"Placed {located['latitude'].notna().sum()} of {unlocated.sum()} addresses without a "
+          f"location by postal code or city: {centroids.stats()}")
+df_address_sheet = clean_sheet(df_address_sheet, tables['address'],
+                               ['latitude', 'longitude', 'location_precision'])
+# put each address on our geohash grid so we can search by location (see geo.py)
+df_address_sheet['geohash'] = [encode_geohash(lat, lon) for lat, lon
+                               in zip(df_address_sheet['latitude'], df_address_sheet['longitude'])]
 
-# Also apply pandas NA/NaN where we had blank cells in order to represent
-# NULL in our database table columns that are optional/nullable.
 
 
 #####################################################################
@@ -211,7 +413,6 @@ df_company_sheet['parent_id'] = df_company_sheet['parent_id'].astype("Int32")
 company_fields = get_matching_column_names(df_company_sheet, 'company', db)
 facility_fields = get_matching_column_names(df_facility_sheet, 'facility', db)
 address_fields = get_matching_column_names(df_address_sheet, 'address', db)
-product_fields = get_matching_column_names(df_product_sheet, 'product', db)
 # print(f"matching fields for product: {product_fields}")
 # print("")
 
@@ -221,63 +422,75 @@ product_fields = get_matching_column_names(df_product_sheet, 'product', db)
 # DataFrames 
 #####################################################################
 
+def report_missing_links():
+    """
+    Print the rows that won't get loaded the way they should, because what
+    they point at isn't in our sheets (the product sheet is checked by each
+    loader, see report_missing)
+    """
+    report_missing(df_company_sheet, 'trade_name', df_address_sheet, 'company_trade_name',
+                   Address, df_address_sheet['make_default'] == True)
+    report_missing(df_facility_sheet, 'company_trade_name', df_company_sheet, 'trade_name', Company)
+    report_missing(df_facility_sheet, 'nickname', df_address_sheet, 'nickname', Address)
+
+
 # note - using the sqlachemy.orm Session class, so our session syntax 
 # is slightly different than that of flask sqlalchemy (we use the below 
 # instead of model.db.session.add_all(...) and model.db.session.commit() )
-with Session(engine) as session:
+def load_with_orm(session):
+    """
+    Build a Company object (with its products, facilities and addresses)
+    for every row of the company sheet and let SQLAlchemy insert them all.
+    Simple, but every row is its own INSERT - see load_with_copy for big
+    sheets. (It doesn't save row hashes, so the next -loader sync loads
+    everything again.)
+    """
+    df_product_sheet = read_sheet(product_sheet_path, tables['product'])
+    product_fields = get_matching_column_names(df_product_sheet, 'product', db)
+    report_missing_links()
+    report_missing(df_product_sheet, 'company_trade_name', df_company_sheet, 'trade_name', Company)
+
+    # go through each sheet once, up front (see index_sheet above)
+    default_addresses = index_sheet(df_address_sheet, 'company_trade_name', address_fields,
+                                    df_address_sheet['make_default'] == True)
+    addresses_by_nickname = index_sheet(df_address_sheet, 'nickname', address_fields)
+    products_by_company = index_sheet(df_product_sheet, 'company_trade_name', product_fields)
+    facilities_by_company = index_sheet(df_facility_sheet, 'company_trade_name', facility_fields)
 
     # Taking just the columns we want from df_company_sheet, iterate 
-    # over each row and create from it a namedtuple
-    # Store that namedtuple in variable 'company_row' 
-    # https://docs.python.org/3/library/collections.html#collections.namedtuple
-    for company_row in df_company_sheet[company_fields].itertuples(index=False):
-
-        # now use namedtuple's function _asdict() to convert each company_row 
-        # tuple into a dict
-        # NOTE: each key in this dict will be the column name we used in our
-        # gsheet and will go into our db table, the value is the val in each col
-        # for that row
-        company_fields = company_row._asdict()
+    # over each row as a dict (records() turns blank cells into None)
+    # NOTE: each key in this dict will be the column name we used in our
+    # gsheet and will go into our db table, the value is the val in each col
+    # for that row
+    for company_row_fields in records(df_company_sheet[company_fields]):
 
         # now let's construct a new Company object
         # because class Company extends SQLAlchemy Model (db.Model) it can take
         # kwargs 
         # we'll use the value of any key in the kwargs that matches a 
         # Company atttribute as the value of that attribute
-        new_company = Company(**company_fields) #  unpacks company_fields dict
+        new_company = Company(**company_row_fields) #  unpacks company_row_fields dict
      
         new_company.address = find_first_matching(new_company.trade_name,
-                                                 df_address_sheet,
-                                                 'company_trade_name',
-                                                 address_fields,
-                                                 Address,
-                                                 "make_default==True")
+                                                  default_addresses,
+                                                  Address)
 
-        # use function 'find_all_matching' (line 121) to populate the company
+        # use function 'find_all_matching' (see above) to populate the company
         # object with products 
         new_company.products = find_all_matching(new_company.trade_name, # value to search for
-                                                df_product_sheet, # df to look in
-                                                'company_trade_name', # col to look in
-                                                product_fields, # columns to take for result
-                                                Product) # create a Product object
+                                                 products_by_company, # sheet index to look in
+                                                 Product) # create a Product object
 
- 
         # now populate the company object with facilities 
         new_company.facilities = find_all_matching(new_company.trade_name, # value to search for
-                                                df_facility_sheet, # df to look in
-                                                'company_trade_name', # col to look in
-                                                facility_fields, # columns to take for result
-                                                Facility) # create a Facility object
-
-        
+                                                   facilities_by_company, # sheet index to look in
+                                                   Facility) # create a Facility object
 
         # now populate each of the company's facilities with an address
         for facility in new_company.facilities:
             facility.address = find_first_matching(facility.nickname, # value to search for
-                                                df_address_sheet, # df to look in
-                                                'nickname', # col name to look in
-                                                address_fields, #  cols to take for result
-                                                Address) # object type to create
+                                                   addresses_by_nickname, # sheet index to look in
+                                                   Address) # object type to create
  
         session.add(new_company)
 
@@ -308,6 +521,347 @@ with Session(engine) as session:
         session.commit()
     except DBAPIError as err:
         print(f"  !!! ERROR: {err}")
+        raise SystemExit(1)
+
+
+#####################################################################
+# Linking our sheets together
+#
+# load_with_copy and load_with_sync both start from one DataFrame per
+# table, made with a few pandas merges per sheet instead of a lookup per
+# row. Each row has:
+#   natural_key  - what names this row in our sheets (see RowHash in model.py)
+#   link columns - the natural keys of the rows it points at (address_key,
+#                  company_trade_name), which the loaders turn into ids
+#   the table's columns, converted to the table's column types
+#   row_hash     - a fingerprint of all of the above
+#####################################################################
+
+# id columns in our sheets - we work ids out ourselves
+SHEET_ID_COLUMNS = ['id', 'company_id', 'address_id', 'default_address_id']
+
+
+def drop_duplicate_keys(frame: pd.DataFrame, table_name: str):
+    """ Keep the first row for each natural key, and say which ones repeat """
+    duplicated = frame['natural_key'].duplicated()
+    if duplicated.any():
+        print(f"   !!! !!! {duplicated.sum()} {table_name} rows repeat one we already have, "
+              f"skipping them: !!! !!!")
+        for key in frame.loc[duplicated, 'natural_key'].drop_duplicates():
+            print(f"      {key}")
+    return frame[~duplicated]
+
+
+def table_frame(df: pd.DataFrame, table_name: str, fields: List[str], links: List[str]):
+    """ df's rows as natural_key, links, the table's columns and row_hash """
+    columns = [ name for name in fields if name not in SHEET_ID_COLUMNS ]
+    frame = frame_for_table(df, db.metadata.tables[table_name], columns)
+    frame.insert(0, 'natural_key', df['natural_key'])
+    for link in links:
+        frame[link] = df[link]
+    frame = drop_duplicate_keys(frame, table_name).reset_index(drop=True)
+    frame['row_hash'] = hash_rows(frame, sorted(links + columns))
+    return frame
+
+
+def table_columns(frame: pd.DataFrame, table_name: str):
+    """ The columns of frame that go in the table """
+    table = db.metadata.tables[table_name]
+    return [ name for name in frame.columns if name in table.columns ]
+
+
+def link_sheets():
+    """ (companies, facilities, addresses) frames from our small sheets """
+    companies = df_company_sheet.assign(natural_key=df_company_sheet['trade_name'])
+    companies = companies.drop_duplicates('natural_key')
+
+    # each company's default address: the first make_default row for it
+    default_addresses = (df_address_sheet[df_address_sheet['make_default'] == True]
+                         .drop_duplicates('company_trade_name'))
+    default_addresses = default_addresses[
+        default_addresses['company_trade_name'].isin(companies['trade_name'])]
+    default_addresses = default_addresses.assign(
+        natural_key='company:' + default_addresses['company_trade_name'])
+    companies['address_key'] = ('company:' + companies['trade_name']).where(
+        companies['trade_name'].isin(default_addresses['company_trade_name']))
+
+    # each facility's address: the first address row with its nickname
+    facilities = df_facility_sheet[
+        df_facility_sheet['company_trade_name'].isin(companies['trade_name'])]
+    # (nicknames like "Headquarters" repeat, so a facility is named by its
+    # company and its nickname)
+    facilities = facilities.assign(natural_key=[
+        json.dumps([trade_name, nickname]) for trade_name, nickname
+        in zip(facilities['company_trade_name'], facilities['nickname']) ])
+    facilities = facilities.drop_duplicates('natural_key')
+    facility_addresses = (facilities[['natural_key', 'nickname']]
+                          .merge(df_address_sheet.drop_duplicates('nickname'), on='nickname'))
+    facility_addresses['natural_key'] = 'facility:' + facility_addresses['natural_key']
+    facilities['address_key'] = ('facility:' + facilities['natural_key']).where(
+        facilities['nickname'].isin(facility_addresses['nickname']))
+
+    addresses = pd.concat([default_addresses, facility_addresses], ignore_index=True)
+    return (table_frame(companies, 'company', company_fields, ['address_key']),
+            table_frame(facilities, 'facility', facility_fields,
+                        ['company_trade_name', 'address_key']),
+            table_frame(addresses, 'address', address_fields, []))
+
+
+def link_products(df_products: pd.DataFrame, company_keys: pd.Series):
+    """ A products frame from (a chunk of) the product sheet """
+    product_fields = get_matching_column_names(df_products, 'product', db)
+    report_missing(df_products, 'company_trade_name', df_company_sheet, 'trade_name', Company)
+    products = df_products[df_products['company_trade_name'].isin(company_keys)]
+    products = products.assign(natural_key=[ json.dumps([trade_name, name]) for trade_name, name
+                                             in zip(products['company_trade_name'], products['name']) ])
+    return table_frame(products, 'product', product_fields, ['company_trade_name'])
+
+
+#####################################################################
+# Bulk loading with COPY
+#
+# We give every row an id, turn the natural keys each row points at into
+# ids, and stream each table into PostgreSQL with COPY (see
+# db_utils/bulk_load.py). The product sheet is read and sent a chunk at a
+# time, so a million products don't take any more memory than a thousand.
+# We also save every row's hash, for the next -loader sync.
+#####################################################################
+
+def copy_with_hashes(cursor, table_name: str, frame: pd.DataFrame):
+    """ COPY frame's rows into table_name, and their hashes into row_hash """
+    copy_dataframe(cursor, table_name, frame[table_columns(frame, table_name)])
+    copy_dataframe(cursor, 'row_hash', pd.DataFrame({
+        'table_name': table_name,
+        'natural_key': frame['natural_key'],
+        'row_hash': frame['row_hash'],
+        'row_id': frame['id'],
+    }))
+
+
+def load_with_copy(connection, chunk_rows: int=50000):
+    """ Load the same rows load_with_orm does, with COPY """
+    cursor = connection.cursor()
+    report_missing_links()
+
+    companies, facilities, addresses = link_sheets()
+    addresses = add_ids(addresses)
+    address_ids = addresses.set_index('natural_key')['id']
+    companies = add_ids(companies)
+    companies['default_address_id'] = companies['address_key'].map(address_ids).astype('Int64')
+    company_ids = companies.set_index('natural_key')['id']
+    facilities = add_ids(facilities)
+    facilities['company_id'] = facilities['company_trade_name'].map(company_ids)
+    facilities['address_id'] = facilities['address_key'].map(address_ids).astype('Int64')
+
+    # addresses first - companies and facilities point at them
+    for table_name, frame in (('address', addresses), ('company', companies),
+                              ('facility', facilities)):
+        copy_with_hashes(cursor, table_name, frame)
+
+    # products: one chunk of the sheet at a time. A product can only be in
+    # once, so we remember the (hashes of the) keys of earlier chunks
+    next_product_id = 1
+    seen_keys = np.array([], dtype='uint64')
+    for df_products in pd.read_csv(product_sheet_path, chunksize=chunk_rows,
+                                   dtype=sheet_dtypes(tables['product'])):
+        products = link_products(df_products, company_ids.index)
+        key_hashes = pd.util.hash_pandas_object(products['natural_key'], index=False).to_numpy()
+        repeated = np.isin(key_hashes, seen_keys)
+        if repeated.any():
+            drop_duplicate_keys(pd.concat([products[~repeated], products[repeated]]), 'product')
+            products = products[~repeated]
+            key_hashes = key_hashes[~repeated]
+        seen_keys = np.union1d(seen_keys, key_hashes)
+
+        products = add_ids(products, first_id=next_product_id)
+        products['company_id'] = products['company_trade_name'].map(company_ids)
+        next_product_id += len(products)
+        copy_with_hashes(cursor, 'product', products)
+
+    for table_name in ('address', 'company', 'facility', 'product'):
+        reset_id_sequence(cursor, table_name)
+    connection.commit()
+    print(f"Copied {len(companies)} companies, {len(facilities)} facilities, "
+          f"{len(addresses)} addresses, {next_product_id - 1} products")
+
+
+#####################################################################
+# Incremental sync
+#
+# Instead of reloading everything, compare each row's hash with the one
+# we saved last time (see db_utils/row_sync.py) and only insert, update or
+# delete the rows that changed. A one-cell change in our Google Sheet
+# changes one row, and the site never sees empty tables.
+#####################################################################
+
+# in the order we insert and update (a row has to exist before anything
+# points at it), with each table's foreign keys:
+#   id column -> (link column, table it points at)
+SYNC_TABLES = [
+    ('address', {}),
+    ('company', {'default_address_id': ('address_key', 'address')}),
+    ('facility', {'company_id': ('company_trade_name', 'company'),
+                  'address_id': ('address_key', 'address')}),
+    ('product', {'company_id': ('company_trade_name', 'company')}),
+]
+
+
+def load_with_sync(session):
+    """
+    Apply the changes in our sheets since the last load. Returns the ids
+    of the products we inserted or updated, or None if nothing changed.
+    """
+    report_missing_links()
+    companies, facilities, addresses = link_sheets()
+    products = link_products(read_sheet(product_sheet_path, tables['product']), companies['natural_key'])
+    frames = {'address': addresses, 'company': companies,
+              'facility': facilities, 'product': products}
+
+    stored_rows = pd.DataFrame(session.query(RowHash.table_name, RowHash.natural_key,
+                                             RowHash.row_hash, RowHash.row_id).all(),
+                               columns=['table_name', 'natural_key', 'row_hash', 'row_id'])
+    # table name -> natural key -> id, for every row we end up with
+    ids = {}
+    deletes = {}
+    changed_product_ids = []
+    changes = 0
+
+    for table_name, foreign_keys in SYNC_TABLES:
+        table = db.metadata.tables[table_name]
+        stored = stored_rows[stored_rows['table_name'] == table_name].drop(columns=['table_name'])
+        inserts, updates, deletes[table_name] = diff_rows(frames[table_name], stored)
+        ids[table_name] = dict(zip(stored['natural_key'], stored['row_id']))
+
+        def table_rows(frame):
+            frame = frame.copy()
+            for id_column, (link, target) in foreign_keys.items():
+                frame[id_column] = frame[link].map(ids[target]).astype('Int64')
+            return records(frame[table_columns(frame, table_name)])
+
+        new_hashes = []
+        if len(inserts):
+            # one statement for all of them - the ids come back in the
+            # order we sent the rows
+            new_ids = session.execute(insert(table).returning(table.c.id),
+                                      table_rows(inserts)).scalars().all()
+            for natural_key, row_hash, row_id in zip(inserts['natural_key'], inserts['row_hash'],
+                                                     new_ids):
+                ids[table_name][natural_key] = row_id
+                new_hashes.append({'natural_key': natural_key, 'row_hash': row_hash,
+                                   'row_id': row_id})
+            if table_name == 'product':
+                changed_product_ids.extend(new_ids)
+
+        if len(updates):
+            rows = [ dict(row, row_id=row_id) for row, row_id
+                     in zip(table_rows(updates), updates['row_id'].tolist()) ]
+            session.execute(update(table).where(table.c.id == bindparam('row_id')), rows)
+            new_hashes.extend(records(updates[['natural_key', 'row_hash', 'row_id']]))
+            session.execute(delete(RowHash).where(RowHash.table_name == table_name,
+                                                  RowHash.natural_key.in_(updates['natural_key'].tolist())))
+            if table_name == 'product':
+                changed_product_ids.extend(updates['row_id'].tolist())
+
+        if new_hashes:
+            session.execute(insert(RowHash), [ dict(hashes, table_name=table_name)
+                                               for hashes in new_hashes ])
+        print(f"  {table_name}: {len(inserts)} new, {len(updates)} changed, "
+              f"{len(deletes[table_name])} gone")
+        changes += len(inserts) + len(updates) + len(deletes[table_name])
+
+    # deletes go the other way - nothing can point at a row when it goes
+    for table_name, foreign_keys in reversed(SYNC_TABLES):
+        gone = deletes[table_name]
+        if len(gone):
+            table = db.metadata.tables[table_name]
+            session.execute(delete(table).where(table.c.id.in_(gone['row_id'].tolist())))
+            session.execute(delete(RowHash).where(RowHash.table_name == table_name,
+                                                  RowHash.natural_key.in_(gone['natural_key'].tolist())))
+
+    session.commit()
+    return changed_product_ids if changes else None
+
+
+def copy_everything():
+    connection = staging_engine.raw_connection()
+    try:
+        load_with_copy(connection)
+    except psycopg2.Error as err:
+        connection.rollback()
+        print(f"  !!! ERROR: {err}")
+        # stop here - a full load never swaps in tables we couldn't finish
+        raise SystemExit(1)
+    finally:
+        connection.close()
+
+
+# products whose search_vector needs building - None means all of them
+changed_product_ids = None
+# where we load to - the staging tables, unless we're syncing
+load_engine = staging_engine
+
+if args['loader'] == 'sync':
+    # makes any tables we don't have yet, like row_hash the first time
+    db.metadata.create_all(engine)
+    with Session(engine) as session:
+        have_hashes = session.query(RowHash).first() is not None
+    if have_hashes:
+        # syncing only changes a few rows, each change is as quick as the
+        # site editing a row itself - so we sync the tables the site uses
+        print("Syncing changes!")
+        load_engine = engine
+        with Session(engine) as session:
+            changed_product_ids = load_with_sync(session)
+        if changed_product_ids is None:
+            print("Nothing changed")
+            raise SystemExit
+    else:
+        # the last load didn't save row hashes (or there wasn't one)
+        print("No row hashes from an earlier load - loading everything")
+
+if load_engine is staging_engine:
+    recreate_tables()
+    if args['loader'] == 'orm':
+        with Session(staging_engine) as session:
+            load_with_orm(session)
+    else:
+        copy_everything()
+
+
+with Session(load_engine) as session:
+
+#####################################################################
+# Code that builds our full-text search index
+#
+# Product.search_vector is made from the product's columns plus its
+# company's trade name, so we fill it in after everything is loaded
+# (see refresh_search_vectors in model.py)
+#####################################################################
+
+    print("Building search index!")
+    try:
+        refresh_search_vectors(session, changed_product_ids)
+        session.commit()
+    except DBAPIError as err:
+        print(f"  !!! ERROR: {err}")
+        raise SystemExit(1)
+
+#####################################################################
+# Stamp this load with a new data version - this tells a running
+# server.py to throw away its cached search results and indexes
+#####################################################################
+
+    data_version = DataVersion()
+    session.add(data_version)
+    session.commit()
+    print(f"Data version is now {data_version.version}")
+
+if load_engine is staging_engine:
+    try:
+        swap_in_staging()
+    except DBAPIError as err:
+        print(f"  !!! ERROR: {err}")
+        raise SystemExit(1)
 
    
 
@@ -0,0 +1,210 @@
+"""
+Numbers about all the requests server.py has answered, in the text format
+Prometheus reads (server.py serves them at /metrics):
+
+    http_request_duration_seconds   how long requests took
+    http_request_phase_seconds      ... of which in db, search, serialize, encode
+    http_request_queries            SQL statements per request
+    http_request_db_rows            rows fetched from the database per request
+    http_response_bytes             size of the response body
+    http_requests_total             requests, by status code
+
+All of them are labelled with the route (e.g. endpoint="/search.json"), not
+the whole URL, so there's one set of numbers per page no matter what people
+search for. The histograms count how many requests were at most each bucket
+("le" = less than or equal) - Prometheus works out percentiles from those:
+
+    histogram_quantile(0.95, rate(http_request_duration_seconds_bucket[5m]))
+
+Every server process keeps its own numbers, so with several workers
+Prometheus should scrape each one (or add them up by instance).
+
+The numbers for one request come from db_utils/request_metrics.py.
+
+The text format: https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import bisect
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# bucket upper bounds - Prometheus adds one more, +Inf, for everything
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ A number that only goes up, one for each set of label values """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [ f"{self.name}{_label_text(self.label_names, labels)} {_number(value)}"
+                 for labels, value in values ]
+
+
+class Histogram(object):
+    """ How many observations were at most each bucket bound, and their sum """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.label_names = tuple(label_names)
+        # label values -> [count in each bucket (not added up yet)..., +Inf], sum
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # the first bucket whose bound is >= value
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(label_values) or ([0] * (len(self.buckets) + 1), 0)
+            counts[position] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def lines(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self._values.items())
+        lines = []
+        names = self.label_names + ("le",)
+        for labels, (counts, total) in values:
+            # Prometheus buckets are cumulative: "le=0.1" counts everything <= 0.1
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                running += count
+                lines.append(f"{self.name}_bucket{_label_text(names, labels + (_number(bound),))} "
+                             f"{running}")
+            label_text = _label_text(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_number(total)}")
+            lines.append(f"{self.name}_count{label_text} {running}")
+        return lines
+
+
+class Registry(object):
+    """ All our metrics, and the text Prometheus reads """
+
+    def __init__(self):
+        self.metrics = []
+        # functions returning [(name, type, help, value)] for numbers we only
+        # look at when someone asks (like how busy the connection pool is)
+        self.sources = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, buckets, label_names=()):
+        return self.add(Histogram(name, help_text, buckets, label_names))
+
+    def exposition(self):
+        """ Everything in Prometheus' text format """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+        for source in self.sources:
+            for name, kind, help_text, value in source():
+                if value is None:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestHistograms(object):
+    """ The request metrics server.py keeps (see the top of this file) """
+
+    def __init__(self, registry: Registry=None):
+        self.registry = registry or Registry()
+        self.requests = self.registry.counter(
+            "http_requests_total", "Requests answered.", ("endpoint", "method", "status"))
+        self.duration = self.registry.histogram(
+            "http_request_duration_seconds", "Time to answer a request, body included.",
+            SECONDS_BUCKETS, ("endpoint",))
+        self.phase = self.registry.histogram(
+            "http_request_phase_seconds", "Time a request spent in each part of answering it.",
+            SECONDS_BUCKETS, ("endpoint", "phase"))
+        self.queries = self.registry.histogram(
+            "http_request_queries", "SQL statements run for a request.",
+            QUERY_BUCKETS, ("endpoint",))
+        self.rows = self.registry.histogram(
+            "http_request_db_rows", "Rows fetched from the database for a request.",
+            ROW_BUCKETS, ("endpoint",))
+        self.response_bytes = self.registry.histogram(
+            "http_response_bytes", "Size of the response body.",
+            BYTE_BUCKETS, ("endpoint",))
+
+    def observe(self, endpoint: str, method: str, status: int, metrics, body_bytes: int=None):
+        """ Add one finished request (metrics is its RequestMetrics) """
+        self.requests.inc(endpoint, method, str(status))
+        self.duration.observe(metrics.total_seconds, endpoint)
+        self.phase.observe(metrics.db_seconds, endpoint, "db")
+        for phase, seconds in metrics.phase_seconds.items():
+            self.phase.observe(seconds, endpoint, phase)
+        self.queries.observe(metrics.queries, endpoint)
+        self.rows.observe(metrics.rows, endpoint)
+        if body_bytes is not None:
+            self.response_bytes.observe(body_bytes, endpoint)
+
+    def exposition(self):
+        return self.registry.exposition()
+
+
+def pool_metrics(pool_stats: dict):
+    """ [(name, type, help, value)] for db_utils/engine.py's TimedQueuePool.stats() """
+    return [
+        ("db_pool_size", "gauge", "Connections the pool keeps open.", pool_stats["size"]),
+        ("db_pool_checked_out", "gauge", "Connections in use right now.",
+         pool_stats["checked_out"]),
+        ("db_pool_saturation", "gauge", "Connections in use / most the pool will open.",
+         pool_stats["saturation"]),
+        ("db_pool_checkouts_total", "counter", "Connections handed out.",
+         pool_stats["checkouts"]),
+        ("db_pool_waited_checkouts_total", "counter",
+         "Checkouts that had to wait for a free connection.", pool_stats["waited_checkouts"]),
+        ("db_pool_timeouts_total", "counter", "Checkouts that gave up waiting.",
+         pool_stats["timeouts"]),
+    ]
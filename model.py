@@ -1,5 +1,7 @@
-from mimetypes import init
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import TSVECTOR
+import uuid
 
 # create a SQLAlchemy object to represent our database - we'll call it "db"
 db = SQLAlchemy()
@@ -11,14 +13,72 @@ class BetterModel(object):
     def __repr__(self):
         """Show json-ish string """
         # these are inside db.Model __table__.columns.keys()
-        return "{" + ", \n".join( [ f" '{name}': '{getattr(self, name)}'" for name in self.__table__.columns.keys()] ) + "}"
+        return "{" + ", \n".join( [ f" '{name}': '{value}'" for name, value in self.to_dict().items()] ) + "}"
     
+    @classmethod
+    def column_names(cls):
+        """
+        Names of the columns we show to the outside world. Columns created
+        with info={"serialize": False} (like Product.search_vector) are only
+        for the database's own use, so we leave them out.
+        We work this out once per class and keep it in cls._column_names
+        """
+        names = cls.__dict__.get("_column_names")
+        if names is None:
+            names = tuple( column.key for column in cls.__table__.columns 
+                           if column.info.get("serialize", True) )
+            cls._column_names = names
+        return names
+
+    @classmethod
+    def serializer(cls):
+        """
+        This class's to_dict function, written for its exact columns the
+        first time we need it (see compile_to_dict below)
+        """
+        compiled = cls.__dict__.get("_compiled_to_dict")
+        if compiled is None:
+            compiled = compile_to_dict(cls.column_names())
+            cls._compiled_to_dict = compiled
+        return compiled
+
     # SQLAlchemy doesn't seem to offer a simple way to do this, so we got 
     # some help creating this function to make it easier to make JSON later
     # We created a new class, BetterModel, objects that inherit from it can
     # call the to_dict method 
     def to_dict(self):
-        return { name : getattr(self, name) for name in self.__table__.columns.keys() }
+        return self.serializer()(self)
+
+
+def compile_to_dict(names):
+    """
+    Write a to_dict function for one model class. For Address it comes out
+    as (roughly):
+
+        def to_dict(obj):
+            values = obj.__dict__
+            try:
+                return {'id': values['id'], 'address_1': values['address_1'], ...}
+            except KeyError:
+                return {name: getattr(obj, name) for name in names}
+
+    Looking each column up with getattr goes through SQLAlchemy's attribute
+    machinery every time, but once a row is loaded its values are sitting
+    in the object's __dict__ - so we read them from there, with the column
+    names written right into the code. If a column hasn't been loaded yet
+    (it's deferred or expired) it won't be in __dict__, and we fall back to
+    getattr, which asks SQLAlchemy to load it.
+    """
+    fields = ", ".join(f"{name!r}: values[{name!r}]" for name in names)
+    source = ("def to_dict(obj):\n"
+              "    values = obj.__dict__\n"
+              "    try:\n"
+              f"        return {{{fields}}}\n"
+              "    except KeyError:\n"
+              "        return {name: getattr(obj, name) for name in names}\n")
+    namespace = {"names": names}
+    exec(source, namespace)
+    return namespace["to_dict"]
 
 #####################################################################
 # Company
@@ -37,7 +97,7 @@ class Company(db.Model, BetterModel):
     parent_id = db.Column(db.Integer)
     year_founded = db.Column(db.Integer)
     statement = db.Column(db.String(1000))
-    total_employees = db.Column(db.Integer) #TODO: fix bug, not getting stored as Int
+    total_employees = db.Column(db.Integer)
     legal_form = db.Column(db.String(50))
     for_profit = db.Column(db.Boolean, default=True)
     ownership = db.Column(db.String(50))
@@ -58,9 +118,20 @@ class Company(db.Model, BetterModel):
     # a company has many products, a product has one company
     # a company has many facilities, a facility has one company
     # a company has one default address
+    #
+    # Eager loading plan: our search results always need a company's default
+    # address and all of its facilities (each with its own address), so we
+    # tell SQLAlchemy to load them up front instead of one query per object
+    # (the "N+1" problem). "joined" adds a LEFT OUTER JOIN to the query that
+    # loads the company, "selectin" runs one extra query for the facilities of
+    # every company loaded - no matter how many companies that is.
+    # https://docs.sqlalchemy.org/en/14/orm/loading_relationships.html
+    # products stay lazy - a company can have lots of them and search starts
+    # from the product side anyway.
     products = db.relationship("Product", back_populates="company")
-    facilities = db.relationship("Facility", back_populates="company")
-    address = db.relationship("Address")
+    facilities = db.relationship("Facility", back_populates="company",
+                                 lazy="selectin")
+    address = db.relationship("Address", lazy="joined")
 
 
 
@@ -101,7 +172,10 @@ class Facility(db.Model, BetterModel):
 
     # a facility has one address, an address has many facilities
     # a facility has one company, a company has many facilities
-    address = db.relationship("Address", back_populates="facilities") 
+    # (the address is joined in whenever facilities are loaded, see the
+    # eager loading plan on Company)
+    address = db.relationship("Address", back_populates="facilities",
+                              lazy="joined")
     company = db.relationship("Company", back_populates="facilities")
 
 
@@ -123,6 +197,19 @@ class Address(db.Model, BetterModel):
     country = db.Column(db.String(50))
     latitude = db.Column(db.Float())
     longitude = db.Column(db.Float())
+    # how exact latitude/longitude are: "address", or just the middle of
+    # the "postal" code or "city" (see geocoding.py)
+    location_precision = db.Column(db.String(10))
+    # where latitude/longitude is on a grid, so we can find nearby addresses
+    # with an ordinary index (see geo.py). initdb.py fills this in.
+    geohash = db.Column(db.String(12), info={"serialize": False})
+
+    # text_pattern_ops lets postgres use this index for geohash LIKE 'dr5r%'
+    # https://www.postgresql.org/docs/current/indexes-opclass.html
+    __table_args__ = (
+        db.Index('ix_address_geohash', 'geohash',
+                 postgresql_ops={'geohash': 'text_pattern_ops'}),
+    )
 
     # an address Address properties/relationships
     facilities = db.relationship("Facility", back_populates="address")
@@ -145,14 +232,127 @@ class Product(db.Model, BetterModel):
     key_words = db.Column(db.String(1000))
     distribution = db.Column(db.String(50))
 
+    # PostgreSQL full-text search document for this product - see
+    # refresh_search_vectors() below. deferred() means we never load it
+    # unless we ask for it, it's only used inside our search queries
+    search_vector = db.deferred(db.Column(TSVECTOR, info={"serialize": False}))
+
    # Declarative Table Configuration
    # https://docs.sqlalchemy.org/en/14/orm/declarative_tables.html#declarative-table-configuration
     __table_args__ = (
         db.ForeignKeyConstraint(
             # local field   # foreign (table.column)
             ['company_id'], ['company.id'], name="fk_product_company"),
+        # GIN is the index type PostgreSQL uses for full-text search, it maps
+        # each word to the rows that contain it
+        # https://www.postgresql.org/docs/current/textsearch-indexes.html
+        db.Index('ix_product_search_vector', 'search_vector',
+                 postgresql_using='gin'),
             )
 
     # Product properties/relationships
     # a product belongs to one compant
-    company = db.relationship("Company", back_populates = "products")
+    # joined: the company (and through it, its default address) comes back in
+    # the same query as the product
+    company = db.relationship("Company", back_populates = "products",
+                              lazy="joined")
+
+
+
+#####################################################################
+# Full-text search
+#
+# Each product gets a tsvector - PostgreSQL's pre-processed list of the
+# (stemmed) words in a document. We build it from a few columns, and label
+# the words with a weight so a match in the product name counts for more
+# than a match somewhere in the description:
+#   A - product name
+#   B - category and key words
+#   C - the trade name of the company that makes the product
+#   D - description
+# https://www.postgresql.org/docs/current/textsearch-controls.html
+#####################################################################
+
+SEARCH_CONFIG = 'english'
+
+
+def _weighted(column, weight):
+    return func.setweight(
+        func.to_tsvector(SEARCH_CONFIG, func.coalesce(column, '')), weight)
+
+
+def product_search_document():
+    """ SQL expression that builds the search_vector for a product row """
+    trade_name = (select(Company.trade_name)
+                  .where(Company.id == Product.company_id)
+                  .scalar_subquery())
+
+    return (_weighted(Product.name, 'A')
+            .op('||')(_weighted(Product.category, 'B'))
+            .op('||')(_weighted(Product.key_words, 'B'))
+            .op('||')(_weighted(trade_name, 'C'))
+            .op('||')(_weighted(Product.description, 'D')))
+
+
+def refresh_search_vectors(session, product_ids=None):
+    """
+    Rebuild Product.search_vector for every product (or just the products
+    with ids in product_ids). initdb.py calls this after it loads our data -
+    run it again whenever products or company trade names change.
+    """
+    statement = update(Product).values(search_vector=product_search_document())
+    if product_ids is not None:
+        statement = statement.where(Product.id.in_(list(product_ids)))
+    session.execute(statement.execution_options(synchronize_session=False))
+
+
+#####################################################################
+# DataVersion
+#
+# initdb.py adds a row here every time it finishes loading our data. The
+# server compares the newest version with the one it last saw to know
+# when everything it has cached (search results, indexes) is out of date.
+#####################################################################
+
+class DataVersion(db.Model, BetterModel):
+
+    __tablename__ = 'data_version'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # a random string, so versions never repeat - even after drop_all
+    # starts the id column over
+    version = db.Column(db.String(32), nullable=False,
+                        default=lambda: uuid.uuid4().hex)
+    loaded_at = db.Column(db.DateTime, server_default=func.now())
+
+    @classmethod
+    def current(cls, session):
+        """ The version string of the latest data load, or None """
+        return (session.query(cls.version)
+                .order_by(cls.id.desc())
+                .limit(1)
+                .scalar())
+
+
+#####################################################################
+# RowHash
+#
+# initdb.py -loader sync only touches the rows whose line in our sheets
+# changed since the last load. To tell, we keep a fingerprint (hash) of
+# every sheet row we loaded, under a "natural key" - something from the
+# sheet that stays the same when the rest of the row changes:
+#   company   its trade name
+#   facility  its company's trade name and its nickname
+#   product   its company's trade name and its name
+#   address   "company:<trade name>" or "facility:<the facility's key>"
+# and the id of the database row we made from it.
+#####################################################################
+
+class RowHash(db.Model, BetterModel):
+
+    __tablename__ = 'row_hash'
+
+    table_name = db.Column(db.String(50), primary_key=True)
+    natural_key = db.Column(db.String(), primary_key=True)
+    row_hash = db.Column(db.String(16), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
@@ -0,0 +1,79 @@
+"""
+Turns what someone typed in our search box into a plan for one search.
+
+    plan_search("Baby  kale OR the spinach")
+    -> SearchPlan(terms=['baby', 'kale', 'spinach'], mode='any')
+
+What the planner does:
+  * normalizes every word the same way our search index does (lowercase,
+    no accents or punctuation, plurals folded - see search_index.tokenize)
+  * drops empty words (two spaces in a row) and stopwords ("the", "of"...)
+    that would match almost everything
+  * drops repeated words, so "kale kale" is the same search as "kale"
+  * works out whether a product has to match ALL of the words or ANY of
+    them: typing AND or OR (in capitals) between words picks one, otherwise
+    we use the mode we were given (the default is "any")
+
+Whoever runs the plan (search.search_product or SearchIndex.search) runs
+it as ONE search and gives each product one score: for every word it
+matched, the weight of each kind of field the word was found in, added up.
+
+    product name              8
+    category / key words      4
+    company / facilities      2
+    description               1
+
+So a product with "kale" in its name and description scores 9 for "kale".
+"""
+from search_index import tokenize
+
+
+ANY = "any"     # a product matches if it has at least one of the words
+ALL = "all"     # a product only matches if it has every word
+MODES = (ANY, ALL)
+
+# words that are in (nearly) every product, so searching for them just
+# slows the search down and floods the results
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in",
+    "into", "is", "it", "its", "of", "on", "or", "our", "the", "their",
+    "this", "to", "we", "with", "you", "your",
+}
+
+
+class SearchPlan(object):
+
+    def __init__(self, terms, mode=ANY, corrected=False):
+        self.terms = terms
+        self.mode = mode
+        # True if these are the spelling-fixed versions of what was typed
+        self.corrected = corrected
+
+    @property
+    def key(self):
+        """ A string that is the same for every search with the same plan """
+        return f"{self.mode}:{' '.join(sorted(self.terms))}"
+
+    def __bool__(self):
+        return bool(self.terms)
+
+    def __repr__(self):
+        return f"SearchPlan(terms={self.terms}, mode='{self.mode}')"
+
+
+def plan_search(search_terms: str, mode: str=None):
+    """ Make a SearchPlan from the words someone typed """
+    if mode not in MODES:
+        mode = ANY
+
+    terms = []
+    for word in search_terms.split():
+        # AND / OR typed between words decide the mode
+        if word in ("AND", "OR"):
+            mode = ALL if word == "AND" else ANY
+            continue
+        for term in tokenize(word):
+            if term not in STOPWORDS and term not in terms:
+                terms.append(term)
+
+    return SearchPlan(terms, mode)
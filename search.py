@@ -1,5 +1,11 @@
-from model import Company, Address, Product, Facility
+from model import Company, Address, Product, Facility, SEARCH_CONFIG
+from query_planner import plan_search, SearchPlan, ALL
+from serializers import FieldSet, SubtreeCache, product_result
+from db_utils.request_metrics import timed
+from sqlalchemy import and_, case, func, or_
 from sqlalchemy.sql.expression import literal
+import base64
+import itertools
 
 
 # search companies by product name
@@ -8,67 +14,222 @@ from sqlalchemy.sql.expression import literal
 
 """
 
-# Write a function that takes in a search term and searches the 
-# 'name' column in the Product table column for matches 
-# When it finds matches, it gets a bunch of data related to each
+# Write a function that takes in a search term and searches our products
+# for matches. When it finds matches, it gets a bunch of data related to each
 # matched product (e.g. the company) and makes a dict of some fields
 # we want to see on the search results part of our web page.  We'll add
 # dicts like this for each product our search terms match.
 #
-# We'll call this function from our flask route "/search.json" and 
-# return it our list of dicts.  
+# We'll call this function from our flask route "/search.json" and
+# return it our list of dicts.
 # Our flask route will turn the list of dicts it gets back from this function
-# into json and send it back whenever a user performs a search - and makes the 
+# into json and send it back whenever a user performs a search - and makes the
 # ajax/fetch thing GET from our "/search.json" route
 #
-# Note the names of the keys to each dict we put into the list here, we'll 
-# use these same key names in any React components that render our search 
+# Note the names of the keys to each dict we put into the list here, we'll
+# use these same key names in any React components that render our search
 # results.
-def search_product(search_terms: str):
-    print(f"searching for {search_terms}")
-    results = []
-    word_list = search_terms.split(" ")
-    # loop over the words the user is searching for and
-    # query the database with each one
-    for word in word_list:
-        # query the name column of our Product table to see
-        # if it contains this word
-        # products = Product.query.filter(Product.name
-        #                                 .contains(literal(word)
-        #                                 )).all()
-        products = Product.query.filter(Product.name.ilike(f"%{word}%")).all()
-        
-
-
-        # hopefully we got some products that matched our search word
-        # let's loop over the results for this word and add some data 
-        # from the product object (and other objects related to it like 
-        # company)
-        for product in products:
-            # let's get the company for this product using the company
-            # relationship on our Product object
-            # let's also get the default address for this company using
-            # the address relationship on our Company object
-            company = product.company
-            address = company.address
-        
-            # let's make an object with some data we want to send back to our
-            # web app - we'll use these in our react props
-            this_result = {
-                "product": product.to_dict(),
-                "company": company.to_dict()
-            }
-            this_result["company"].update({ "address": address.to_dict() })
-            facilities = company.facilities
-            this_result["facilities"] = []
-            for facility in facilities:
-                this_facility = facility.to_dict()
-                this_facility.update({ "address": facility.address.to_dict() })
-                this_result["facilities"].append(this_facility)                
-            results.append(this_result)
+#
+# The words are turned into a SearchPlan first (see query_planner.py): empty
+# words and stopwords are dropped, and mode decides whether a product has to
+# match "all" of the words or "any" of them. Each product comes back once,
+# best match first, with a "score" for how well it matched.
+#
+# If we're given a SearchIndex (see search_index.py), we answer from memory
+# instead of asking the database.
+# If we're given a SuggestIndex (see suggest.py) as "spelling" and nothing
+# matches, we try again with the known words spelled most like the ones we
+# were given - so "arugla" still finds arugula.
+#
+# limit and cursor let us return one page of results at a time, see
+# search_page() below.
+#
+# subtrees is a SubtreeCache (see serializers.py) to reuse company dicts
+# from - if we aren't given one, each search makes its own.
+# fields is a FieldSet (see serializers.py) if we only want some columns.
+def search_product(search_terms: str, index=None, spelling=None, mode: str=None,
+                   limit: int=None, cursor: str=None, subtrees: SubtreeCache=None,
+                   fields: FieldSet=None):
+    return list(iter_search(search_terms, index, spelling, mode, limit, cursor, subtrees,
+                            fields))
+
+
+def iter_search(search_terms: str, index=None, spelling=None, mode: str=None,
+                limit: int=None, cursor: str=None, subtrees: SubtreeCache=None,
+                fields: FieldSet=None):
+    """
+    Same as search_product, but gives back a generator that makes each
+    result when it's asked for - so we never have every result in memory at
+    once (server.py uses this to stream results)
+    """
+    _, results = _search(search_terms, index, spelling, mode, limit, cursor, subtrees, fields)
     return results
 
 
+def search_page(search_terms: str, index=None, spelling=None, mode: str=None,
+                limit: int=50, cursor: str=None, subtrees: SubtreeCache=None,
+                fields: FieldSet=None):
+    """
+    One page of results plus a cursor for the next page (None if this is
+    the last page). To get the next page, call again with the same search
+    terms and the cursor we gave back.
+
+    This is "keyset" pagination: results are sorted by score and then
+    product id, and the cursor remembers the score and id of the last
+    result on the page - so the next page just asks for results that sort
+    after that one. Unlike LIMIT/OFFSET, the database doesn't have to find
+    (and throw away) every result on the earlier pages first.
+    """
+    # ask for one extra result so we know whether there's another page
+    plan, results = _search(search_terms, index, spelling, mode, limit + 1, cursor, subtrees,
+                            fields)
+    results = list(results)
+    if len(results) <= limit:
+        return results, None
+
+    results = results[:limit]
+    last = results[-1]
+    return results, encode_cursor(last["score"], last["product"]["id"], plan)
+
+
+def encode_cursor(score: int, product_id: int, plan: SearchPlan):
+    """ Make an opaque string holding the position of a result """
+    # we also remember whether we had to fix the spelling of the search
+    # words, so the next page searches for the same (fixed) words
+    text = f"{score}:{product_id}:{' '.join(plan.terms) if plan.corrected else ''}"
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    Turn a cursor from encode_cursor back into (score, product id,
+    fixed words or None). Raises ValueError if it isn't one of ours.
+    """
+    try:
+        text = base64.urlsafe_b64decode(cursor.encode()).decode()
+        score, product_id, corrected = text.split(":", 2)
+        return int(score), int(product_id), corrected.split() or None
+    except (ValueError, UnicodeDecodeError) as err:
+        raise ValueError(f"bad cursor: {cursor}") from err
+
+
+def _search(search_terms, index, spelling, mode, limit, cursor, subtrees, fields):
+    """ Works out the SearchPlan and returns it with a generator of results """
+    plan = plan_search(search_terms, mode)
+    after = None
+    if cursor:
+        score, product_id, corrected = decode_cursor(cursor)
+        after = (score, product_id)
+        if corrected:
+            plan = SearchPlan(corrected, plan.mode, corrected=True)
+    if not plan:
+        return plan, iter([])
+
+    if index is not None:
+        index.ensure_built()
+        results = (result for result in index.search(plan)
+                   if after is None or _sorts_after(result, after))
+        results = itertools.islice(results, limit)
+        if fields is not None:
+            results = (fields.trim(result) for result in results)
+        return plan, results
+
+    if subtrees is None:
+        subtrees = SubtreeCache()
+    results = _fulltext_results(plan, after, limit, subtrees, fields)
+    if after is None and spelling is not None:
+        # peek at the first result, if there isn't one try fixing the spelling
+        first = next(results, None)
+        if first is not None:
+            return plan, itertools.chain([first], results)
+
+        # only words we've never seen are misspelled - "basil" is spelled
+        # right even when nothing matches "farm basil", and the word
+        # spelled most like it ("bass") would find something else
+        # (SearchIndex.search only corrects unknown words too)
+        spelling.ensure_built()
+        corrected = SearchPlan([ term if spelling.knows(term)
+                                 else (spelling.correct(term) or [term])[0]
+                                 for term in plan.terms ],
+                               plan.mode, corrected=True)
+        if corrected.terms != plan.terms:
+            return corrected, _fulltext_results(corrected, after, limit, subtrees, fields)
+    return plan, results
+
+
+def _sorts_after(result, after):
+    """ True if result comes after position (score, product id) """
+    return (-result["score"], result["product"]["id"]) > (-after[0], after[1])
+
+
+def _fulltext_results(plan, after, limit, subtrees, fields):
+    query, score = fulltext_query(plan)
+    if fields is not None:
+        # only SELECT the columns we're going to send
+        query = query.options(*fields.query_options())
+    if after is not None:
+        after_score, after_id = after
+        query = query.filter(or_(score < after_score,
+                                 and_(score == after_score, Product.id > after_id)))
+    if limit is not None:
+        query = query.limit(limit)
+
+    # hopefully we got some products that matched our search words
+    # let's loop over the results and add some data from the product
+    # object (and other objects related to it like company)
+    # Note: the relationships were already loaded by the query
+    # above (see the eager loading plan in model.py), so walking them
+    # doesn't go back to the database for every product
+    # yield_per fetches rows from postgres 100 at a time instead of all at once
+    # (timed() adds up the time spent making result dicts for server.py's
+    # Server-Timing header, see db_utils/request_metrics.py)
+    for product, product_score in query.yield_per(100):
+        with timed("serialize"):
+            this_result = product_result(product, subtrees, fields)
+        this_result["score"] = product_score
+        yield this_result
+
+
+# the weight of a match in each part of Product.search_vector (see
+# product_search_document in model.py) - the same weights our in-memory
+# index uses (see search_index.py)
+LABEL_WEIGHTS = {
+    'a': 8,     # product name
+    'b': 4,     # category and key words
+    'c': 2,     # company trade name
+    'd': 1,     # description
+}
+
 
+def fulltext_query(plan: SearchPlan):
+    """
+    Turn a SearchPlan into one full-text query for (product, score) rows,
+    best match first. Returns the query and the score expression.
+    """
+    # Instead of one ILIKE '%word%' query per word (which has to read every
+    # row in the product table) we ask PostgreSQL's full-text search to do
+    # it: plainto_tsquery turns each word into a search query, and we
+    # combine them with '&&' (match all) or '||' (match any).
+    # The GIN index on Product.search_vector (see model.py) means postgres
+    # only looks at the products that contain our words.
+    # https://www.postgresql.org/docs/current/textsearch-controls.html
+    combine = '&&' if plan.mode == ALL else '||'
+    ts_query = None
+    score = None
+    for term in plan.terms:
+        term_query = func.plainto_tsquery(SEARCH_CONFIG, term)
+        ts_query = term_query if ts_query is None else ts_query.op(combine)(term_query)
 
+        # ts_filter keeps just the words with one weight label, so this asks
+        # "is the term in the product name?", "...in the key words?" and so
+        # on, and adds up the weights of the fields it was found in
+        for label, weight in LABEL_WEIGHTS.items():
+            in_field = func.ts_filter(Product.search_vector, f'{{{label}}}').op('@@')(term_query)
+            field_score = case((in_field, weight), else_=0)
+            score = field_score if score is None else score + field_score
 
+    query = (Product.query
+             .add_columns(score.label("score"))
+             .filter(Product.search_vector.op('@@')(ts_query))
+             .order_by(score.desc(), Product.id))
+    return query, score
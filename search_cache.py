@@ -0,0 +1,130 @@
+"""
+Caching for /search.json.
+
+Most of our searches are the same few words ("lettuce", "strawberries",
+"microgreens"), and the answer only changes when initdb.py loads new data.
+So we keep the finished JSON for recent searches and send it straight back.
+
+ResultCache - an LRU ("least recently used") cache: when it's full, the
+    entry nobody has asked for in the longest time is thrown out. Entries
+    also expire after ttl_seconds, and every entry remembers the data
+    version it was made from, so a new data load makes them all stale at
+    once.
+
+DataVersionWatcher - asks the database for the current DataVersion (see
+    model.py) at most once every few seconds, and calls back when it
+    changes so server.py can clear its caches and rebuild its indexes.
+
+to use:
+    cache = ResultCache(max_entries=256, ttl_seconds=300)
+    entry = cache.get(key, version)
+    if entry is None:
+        entry = cache.put(key, version, body_bytes, {"X-Next-Cursor": ...})
+    print(cache.stats())
+"""
+from collections import OrderedDict
+from model import DataVersion
+import hashlib
+import threading
+import time
+
+
+class CacheEntry(object):
+
+    def __init__(self, version, body, headers):
+        self.version = version
+        self.body = body
+        self.headers = headers
+        # the body's fingerprint, browsers send it back in If-None-Match
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.stored_at = time.monotonic()
+
+
+class ResultCache(object):
+
+    def __init__(self, max_entries: int=256, ttl_seconds: float=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> CacheEntry, the least recently used entry comes first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, version):
+        """ The CacheEntry for key, or None if we don't have a fresh one """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            too_old = time.monotonic() - entry.stored_at > self.ttl_seconds
+            if too_old or entry.version != version:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # we just used this one, move it to the back of the line
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, body: bytes, headers: dict=None):
+        entry = CacheEntry(version, body, headers or {})
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self.expirations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "bytes": sum(len(entry.body) for entry in list(self._entries.values())),
+        }
+
+
+class DataVersionWatcher(object):
+
+    def __init__(self, check_seconds: float=2):
+        self.check_seconds = check_seconds
+        self.version = None
+        self.checked_at = None
+        # functions to call with the new version when it changes
+        self.on_change = []
+
+    def current(self, session):
+        """ The current data version - only asks the database now and then """
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at > self.check_seconds:
+            first_check = self.checked_at is None
+            self.checked_at = now
+            version = DataVersion.current(session)
+            if version != self.version:
+                print(f"Data version changed: {self.version} -> {version}")
+                self.version = version
+                # the first time we look, nothing has been built from an
+                # older version yet, so there's nobody to tell
+                if not first_check:
+                    for callback in self.on_change:
+                        callback(version)
+        return self.version
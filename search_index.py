@@ -0,0 +1,270 @@
+"""
+An in-memory search index for our products.
+
+Our site is read-heavy: the data only changes when we run initdb.py, but
+people search all day. So instead of asking PostgreSQL for every search, we
+can read everything once, build an "inverted index" and answer searches from
+memory.
+
+An inverted index maps each word (a "term") to the products that contain it,
+kind of like the index in the back of a book:
+
+    "lettuce" -> {3: NAME, 17: NAME | DESCRIPTION, 42: KEY_WORDS}
+    "newark"  -> {3: COMPANY, 4: COMPANY}
+
+The dict for each term is called a "posting list": product id -> which kinds
+of fields the term showed up in. We add up those field weights to rank the
+results, the same way our full-text search in model.py weights its columns.
+
+We also keep the finished result dict (the same dict serializers.product_result
+makes) for each product, so a search never has to touch the database.
+
+to use:
+    index = SearchIndex()
+    index.rebuild()              # needs an app context, reads our tables
+    results = index.search(plan_search("lettuce basil"))   # see query_planner.py
+    print(index.stats())
+"""
+from db_utils.rebuildable import Rebuildable
+from model import Product
+from serializers import SubtreeCache, product_result
+import re
+import sys
+import unicodedata
+
+
+#####################################################################
+# Turning text into terms
+#####################################################################
+
+# field weights - these are bit flags, so one int can say "this term was in
+# the name AND the description". The numbers match the A/B/C/D weights our
+# full-text search uses (see product_search_document in model.py)
+NAME = 8            # product name
+KEY_WORDS = 4       # product category and key words
+COMPANY = 2         # company trade name, facility nicknames and locations
+DESCRIPTION = 1     # product description
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def normalize_term(word: str):
+    """
+    Very light "stemming" so plurals find singulars:
+    berries -> berry, greens -> green (but not grass -> gras)
+    """
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """
+    Split text into normalized terms: lowercase, accents removed
+    ("Café" -> "cafe"), punctuation dropped, plurals folded
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", str(text))
+    text = text.encode("ascii", "ignore").decode("ascii").lower()
+    return [normalize_term(word) for word in TOKEN_PATTERN.findall(text)]
+
+
+#####################################################################
+# Trigrams - for finding words that are spelled almost the same
+#
+# A trigram is three letters in a row. "arugla" and "arugula" share most of
+# their trigrams ("  a", " ar", "aru", "rug", "la "), so when someone
+# misspells a word we can find the real words it's close to. This is the
+# same trick PostgreSQL's pg_trgm extension uses:
+# https://www.postgresql.org/docs/current/pgtrgm.html
+#####################################################################
+
+def trigrams(word: str):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex(object):
+    """ Maps each trigram to the terms that contain it """
+
+    # pg_trgm's default similarity threshold
+    THRESHOLD = 0.3
+
+    def __init__(self):
+        self.terms = {}     # trigram -> set of terms
+        self.sizes = {}     # term -> number of trigrams in it
+
+    def __contains__(self, term: str):
+        return term in self.sizes
+
+    def add(self, term: str):
+        if term in self.sizes:
+            return
+        grams = trigrams(term)
+        self.sizes[term] = len(grams)
+        for gram in grams:
+            self.terms.setdefault(gram, set()).add(term)
+
+    def similar(self, word: str, limit: int=3):
+        """
+        The terms most similar to word (but not word itself), best first.
+        similarity = shared trigrams / all trigrams in either word
+        """
+        grams = trigrams(word)
+        shared = {}
+        for gram in grams:
+            for term in self.terms.get(gram, ()):
+                shared[term] = shared.get(term, 0) + 1
+
+        scored = []
+        for term, count in shared.items():
+            similarity = count / (len(grams) + self.sizes[term] - count)
+            if term != word and similarity >= self.THRESHOLD:
+                scored.append((similarity, term))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [term for similarity, term in scored[:limit]]
+
+
+#####################################################################
+# The index
+#####################################################################
+
+class SearchIndex(Rebuildable):
+
+    label = "search index"
+
+    def __init__(self):
+        super().__init__()
+        # term -> { product id -> field flags }
+        self.postings = {}
+        # product id -> result dict for our web app
+        self.results = {}
+        # every term in postings, for fixing misspelled search words
+        self.spelling = TrigramIndex()
+        # products of the same company share one company dict
+        self.subtrees = SubtreeCache()
+        # measured once per build, deep_sizeof walks the whole index
+        self.memory_bytes = 0
+
+    def _add(self, term, product_id, field):
+        posting = self.postings.setdefault(term, {})
+        posting[product_id] = posting.get(product_id, 0) | field
+
+    def _add_text(self, text, product_id, field):
+        for term in tokenize(text):
+            self._add(term, product_id, field)
+
+    def add_product(self, product: Product):
+        """ Index one product, its company and the company's facilities """
+        self._add_text(product.name, product.id, NAME)
+        self._add_text(product.category, product.id, KEY_WORDS)
+        self._add_text(product.key_words, product.id, KEY_WORDS)
+        self._add_text(product.description, product.id, DESCRIPTION)
+
+        company = product.company
+        if company is not None:
+            self._add_text(company.trade_name, product.id, COMPANY)
+            for facility in company.facilities:
+                self._add_text(facility.nickname, product.id, COMPANY)
+                if facility.address is not None:
+                    self._add_text(facility.address.city, product.id, COMPANY)
+                    self._add_text(facility.address.state, product.id, COMPANY)
+
+        self.results[product.id] = product_result(product, self.subtrees)
+
+    def build(self):
+        """
+        Read every product (with its company, facilities and addresses -
+        see the eager loading plan in model.py) and build a fresh index
+        (see db_utils/rebuildable.py for when)
+        """
+        self.build_from(Product.query.order_by(Product.id).all())
+
+    def build_from(self, products):
+        """
+        Build a fresh index of products. The new postings are swapped in
+        all at once, so searches running while we build keep using the
+        old ones.
+        """
+        fresh = SearchIndex()
+        for product in products:
+            fresh.add_product(product)
+        for term in fresh.postings:
+            fresh.spelling.add(term)
+
+        self.postings, self.results, self.spelling = (
+            fresh.postings, fresh.results, fresh.spelling)
+        self.memory_bytes = (deep_sizeof(fresh.postings) + deep_sizeof(fresh.results)
+                             + deep_sizeof(fresh.spelling.terms))
+
+    def search(self, plan):
+        """
+        Run a SearchPlan (see query_planner.py) against the index. Each
+        product comes back once, best match first, with a "score": the
+        sum of the field weights of every word it matched. Misspelled
+        words match the words spelled most like them.
+        """
+        postings, results, spelling = self.postings, self.results, self.spelling
+
+        scores = None
+        for term in plan.terms:
+            # a word we've never seen is probably misspelled ("arugla"),
+            # so search for the words spelled most like it instead
+            if term in postings:
+                matching_terms = [term]
+            else:
+                matching_terms = spelling.similar(term)
+
+            term_scores = {}
+            for matching_term in matching_terms:
+                for product_id, fields in postings[matching_term].items():
+                    term_scores[product_id] = term_scores.get(product_id, 0) + fields
+
+            if scores is None:
+                scores = term_scores
+            elif plan.mode == "all":
+                scores = {product_id: score + term_scores[product_id]
+                          for product_id, score in scores.items()
+                          if product_id in term_scores}
+            else:
+                for product_id, score in term_scores.items():
+                    scores[product_id] = scores.get(product_id, 0) + score
+
+        scores = scores or {}
+        ranked = sorted(scores, key=lambda product_id: (-scores[product_id], product_id))
+        return [dict(results[product_id], score=scores[product_id])
+                for product_id in ranked if product_id in results]
+
+    def stats(self):
+        """ Size of the index, how much memory it uses and how long it took to build """
+        return {
+            "products": len(self.results),
+            "terms": len(self.postings),
+            "postings": sum(len(posting) for posting in self.postings.values()),
+            "memory_bytes": self.memory_bytes,
+            **super().stats(),
+        }
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    sys.getsizeof only counts the outside of a container (a dict, not the
+    things in it), so walk everything inside too. Objects we've already
+    counted (shared strings, shared dicts) are only counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
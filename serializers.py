@@ -0,0 +1,283 @@
+"""
+Turning our model objects into the dicts our web app gets as JSON.
+
+Every search result has the same shape (see search.py):
+
+    {
+        "product": {...product columns...},
+        "company": {...company columns..., "address": {...}},
+        "facilities": [{...facility columns..., "address": {...}}, ...]
+    }
+
+The "company" and "facilities" parts only depend on the company, and one
+company can have dozens of matching products - so instead of building
+them again for every product, a SubtreeCache builds them once per company
+and hands out the same dicts every time. The JSON we send is exactly the
+same, there's just less work to make it.
+
+A SubtreeCache can live for one request (search.py makes one if it isn't
+given one), or across requests until the next data load (server.py keeps
+one and clears it when the DataVersion changes).
+
+A FieldSet (from the fields= parameter of /search.json) picks which
+columns of each part we send - and which columns we load from the
+database in the first place:
+
+    fields=product.name,product.description,company.trade_name,company.address
+
+NOTE: results share their company dicts, so never change a result's
+"company" or "facilities" in place - make a copy first.
+"""
+from model import Company, Facility, Address, Product, compile_to_dict
+from sqlalchemy.orm import joinedload, lazyload, load_only, selectinload
+import threading
+
+
+#####################################################################
+# FieldSet - which columns of each part of a result to send
+#####################################################################
+
+# the parts of a search result, and the model each part comes from
+SECTIONS = {
+    "product": Product,
+    "company": Company,
+    "company.address": Address,
+    "facilities": Facility,
+    "facilities.address": Address,
+}
+
+
+class FieldSet(object):
+    """
+    Built from a list like "product.name,company.trade_name,company.address"
+      * "company.address" or "company.address.*" means every column
+      * asking for something inside a part includes the part it's in
+        ("company.address.city" gets you a company with just an id and an
+        address with just a city and id)
+      * parts nobody asks for are left out, except the product
+      * facilities belong to the company, so asking for any facility field
+        includes the company too (with just its id) - the same for the
+        full-text search and the in-memory index
+      * ids are always sent - our web app (and our page cursors) need them
+    """
+
+    def __init__(self, columns):
+        # section -> tuple of column names, only for sections we send
+        self.columns = columns
+        self._serializers = { section: compile_to_dict(names)
+                              for section, names in columns.items() }
+
+    @classmethod
+    def parse(cls, text: str):
+        """ A FieldSet from a fields= string, or None for "everything" """
+        if not text or not text.strip():
+            return None
+
+        wanted = {"product": set()}
+        for item in text.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            if item.endswith(".*"):
+                item = item[:-2]
+
+            if item in SECTIONS:
+                section, column = item, "*"
+            else:
+                section, _, column = item.rpartition(".")
+                if section not in SECTIONS or column not in SECTIONS[section].column_names():
+                    raise ValueError(f"unknown field: {item}")
+
+            wanted.setdefault(section, set()).add(column)
+            # include the parts this one is inside of
+            while "." in section:
+                section = section.rpartition(".")[0]
+                wanted.setdefault(section, set())
+            # we get to the facilities through the company
+            if section == "facilities":
+                wanted.setdefault("company", set())
+
+        columns = {}
+        for section, names in wanted.items():
+            all_names = SECTIONS[section].column_names()
+            # keep the model's column order so the JSON looks the same
+            columns[section] = tuple( name for name in all_names
+                                      if "*" in names or name in names or name == "id" )
+        return cls(columns)
+
+    @property
+    def key(self):
+        """ A string that's the same for every FieldSet asking for the same columns """
+        return ";".join(f"{section}:{','.join(names)}"
+                        for section, names in sorted(self.columns.items()))
+
+    def __contains__(self, section):
+        return section in self.columns
+
+    def to_dict(self, section, obj):
+        # (a company or facility might not have an address)
+        return self._serializers[section](obj) if obj is not None else None
+
+    def trim(self, result: dict):
+        """ Cut a full search result dict down to just our columns """
+        trimmed = { "product": self._pick("product", result["product"]) }
+        company = result.get("company")
+        if "company" in self:
+            trimmed["company"] = self._pick("company", company)
+            if company is not None and "company.address" in self:
+                trimmed["company"]["address"] = self._pick("company.address",
+                                                           company.get("address"))
+        if "facilities" in self:
+            trimmed["facilities"] = []
+            for facility in result.get("facilities") or []:
+                this_facility = self._pick("facilities", facility)
+                if "facilities.address" in self:
+                    this_facility["address"] = self._pick("facilities.address",
+                                                          facility.get("address"))
+                trimmed["facilities"].append(this_facility)
+        for key, value in result.items():
+            if key not in SECTIONS:
+                # e.g. the search score
+                trimmed[key] = value
+        return trimmed
+
+    def _pick(self, section, values: dict):
+        if values is None:
+            return None
+        return { name: values[name] for name in self.columns[section] }
+
+    def query_options(self):
+        """
+        SQLAlchemy loader options for a Product query, so we only SELECT the
+        columns we're going to send - and skip joining parts we won't send.
+        (see the eager loading plan in model.py for what these override)
+        https://docs.sqlalchemy.org/en/14/orm/loading_columns.html#load-only-and-wildcard-options
+        """
+        def only(section, model_class):
+            return [ getattr(model_class, name) for name in self.columns[section] ]
+
+        options = [ load_only(*only("product", Product)) ]
+        if "company" not in self:
+            options.append(lazyload(Product.company))
+            return options
+
+        company = joinedload(Product.company).load_only(*only("company", Company))
+        if "company.address" in self:
+            options.append(company.joinedload(Company.address)
+                           .load_only(*only("company.address", Address)))
+        else:
+            options.append(company.lazyload(Company.address))
+
+        if "facilities" in self:
+            facilities = (company.selectinload(Company.facilities)
+                          .load_only(*only("facilities", Facility)))
+            if "facilities.address" in self:
+                options.append(facilities.joinedload(Facility.address)
+                               .load_only(*only("facilities.address", Address)))
+            else:
+                options.append(facilities.lazyload(Facility.address))
+        else:
+            options.append(company.lazyload(Company.facilities))
+        return options
+
+
+#####################################################################
+# Building result dicts
+#####################################################################
+
+class SubtreeCache(object):
+
+    def __init__(self):
+        # (FieldSet key, company id) -> (company dict, list of facility dicts)
+        # - one copy of a company for every FieldSet we're asked for, so
+        # server.py only shares a cache between requests for whole results
+        self.companies = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def company_subtree(self, company: Company, fields: FieldSet=None):
+        """ The (company dict, facilities list) for company """
+        key = (fields.key if fields is not None else None, company.id)
+        subtree = self.companies.get(key)
+        if subtree is not None:
+            self.hits += 1
+            return subtree
+
+        subtree = (company_dict(company, fields), facility_dicts(company, fields))
+        with self._lock:
+            self.misses += 1
+            # if another request beat us to it, use theirs
+            return self.companies.setdefault(key, subtree)
+
+    def clear(self):
+        with self._lock:
+            self.companies = {}
+
+    def stats(self):
+        return {"companies": len(self.companies), "hits": self.hits, "misses": self.misses}
+
+
+def company_dict(company: Company, fields: FieldSet=None):
+    """ company columns plus its default address """
+    if fields is None:
+        # let's also get the default address for this company using
+        # the address relationship on our Company object
+        this_company = company.to_dict()
+        address = company.address
+        this_company.update({ "address": address.to_dict() if address is not None else None })
+        return this_company
+
+    if "company" not in fields:
+        return None
+    this_company = fields.to_dict("company", company)
+    if "company.address" in fields:
+        this_company["address"] = fields.to_dict("company.address", company.address)
+    return this_company
+
+
+def facility_dicts(company: Company, fields: FieldSet=None):
+    """ company's facilities, each with its address """
+    if fields is not None and "facilities" not in fields:
+        return None
+
+    facilities = []
+    for facility in company.facilities:
+        if fields is None:
+            this_facility = facility.to_dict()
+            # (a facility whose nickname isn't in the address sheet has none)
+            address = facility.address
+            this_facility.update({ "address": address.to_dict() if address is not None else None })
+        else:
+            this_facility = fields.to_dict("facilities", facility)
+            if "facilities.address" in fields:
+                this_facility["address"] = fields.to_dict("facilities.address", facility.address)
+        facilities.append(this_facility)
+    return facilities
+
+
+def product_result(product: Product, subtrees: SubtreeCache=None, fields: FieldSet=None):
+    """ Make the dict we send back to our web app for one matched product """
+    if subtrees is None:
+        subtrees = SubtreeCache()
+
+    if fields is None:
+        this_product = product.to_dict()
+    else:
+        this_product = fields.to_dict("product", product)
+        if "company" not in fields:
+            return { "product": this_product }
+
+    # let's get the company for this product using the company
+    # relationship on our Product object
+    company_part, facilities_part = subtrees.company_subtree(product.company, fields)
+
+    # let's make an object with some data we want to send back to our
+    # web app - we'll use these in our react props
+    this_result = {
+        "product": this_product,
+        "company": company_part,
+    }
+    if facilities_part is not None:
+        this_result["facilities"] = facilities_part
+    return this_result
@@ -1,19 +1,31 @@
 from model import db, Company
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, g, json
+from flask import abort, stream_with_context
 from sqlalchemy import literal
-from search import search_product
+from search import iter_search, search_page
+from search_index import SearchIndex
+from search_cache import ResultCache, DataVersionWatcher
+from serializers import FieldSet, SubtreeCache
+from suggest import SuggestIndex
+from query_planner import plan_search
+from geo import facilities_near, facilities_in_box, facility_result
+from clusters import ClusterIndex
+from geojson_layer import GeoJSONLayer
+from db_utils.engine import configure_app, sql_log
+from db_utils.request_metrics import finish_request, start_request, timed
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestHistograms, pool_metrics
+import os
+import signal
 
 
-DB_URI = 'postgresql:///indoorfarms'
-# TODO: make a config for database URI
-
 # create a Flask object and call it "app"
 app = Flask(__name__)
 
-# tell our app where to find the db
-app.config["SQLALCHEMY_DATABASE_URI"] = DB_URI
-# print our SQL commands to Python terminal, shut off if needed
-app.config["SQLALCHEMY_ECHO"] = True
+# tell our app where to find the db, how many connections to keep open
+# and which SQL to print - all from environment variables, e.g.
+#   $ DATABASE_URL=postgresql:///indoorfarms DB_SLOW_QUERY_MS=50 python server.py
+# (see db_utils/engine.py)
+database_settings = configure_app(app)
 # include this line and set to False, otherwise it will waste memory
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
@@ -21,6 +33,128 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 # and tell the app to start running with db
 db.init_app(app)
 
+# Where /search.json gets its answers:
+#   "fulltext" - ask PostgreSQL's full-text search for every search
+#   "memory"   - answer from an in-memory index we build from our tables
+#                (see search_index.py), the database isn't touched at all
+# e.g.  $ SEARCH_BACKEND=memory python server.py
+app.config["SEARCH_BACKEND"] = os.environ.get("SEARCH_BACKEND", "fulltext")
+# how many results /search.json sends back at once, unless asked for fewer
+app.config["SEARCH_PAGE_SIZE"] = 50
+app.config["SEARCH_MAX_PAGE_SIZE"] = 500
+# the most facilities /nearby.json and /viewport.json send back at once
+app.config["MAP_MAX_RESULTS"] = 1000
+search_index = SearchIndex()
+# search box suggestions and spelling fixes (see suggest.py)
+suggest_index = SuggestIndex()
+# farms grouped for every map zoom level (see clusters.py)
+cluster_index = ClusterIndex()
+# every facility as one precompressed GeoJSON file (see geojson_layer.py)
+facilities_layer = GeoJSONLayer()
+# how long browsers can use /facilities.geojson before checking its ETag
+app.config["FACILITIES_GEOJSON_MAX_AGE"] = int(os.environ.get("FACILITIES_GEOJSON_MAX_AGE", 300))
+
+
+# finished /search.json responses for recent searches (see search_cache.py)
+app.config["SEARCH_CACHE_SIZE"] = int(os.environ.get("SEARCH_CACHE_SIZE", 256))
+app.config["SEARCH_CACHE_TTL"] = float(os.environ.get("SEARCH_CACHE_TTL", 300))
+result_cache = ResultCache(app.config["SEARCH_CACHE_SIZE"], app.config["SEARCH_CACHE_TTL"])
+# company/facility dicts shared by every search until the next data load
+# (see serializers.py) - only whole ones: any client can ask for a new
+# fields= combination, so those get a cache of their own per request
+# instead of adding a copy of every company to this one
+company_subtrees = SubtreeCache()
+# initdb.py stamps every data load with a new DataVersion (see model.py),
+# we check for a new one at most every couple of seconds
+data_version = DataVersionWatcher(check_seconds=2)
+
+
+# When initdb.py has loaded new data, everything we built from the old data
+# is out of date: we just mark our indexes stale here, the next search
+# rebuilds them
+def data_reloaded(version=None):
+    print("Data reloaded, clearing search caches")
+    search_index.stale = True
+    suggest_index.stale = True
+    cluster_index.stale = True
+    facilities_layer.stale = True
+    result_cache.clear()
+    company_subtrees.clear()
+
+data_version.on_change.append(data_reloaded)
+
+
+# We notice new data by ourselves (see data_version above), but we can also
+# be told to reload right away with:  $ kill -HUP <server pid>
+def reload_search_index(signum, frame):
+    print("Got reload signal")
+    data_reloaded()
+
+if hasattr(signal, "SIGHUP"):
+    signal.signal(signal.SIGHUP, reload_search_index)
+
+
+# Time every request: how long it spent waiting for SQL, searching, making
+# result dicts and turning them into JSON goes back to the browser in a
+# Server-Timing header, and into the histograms at /metrics (see
+# db_utils/request_metrics.py and metrics.py). The number of SQL queries it
+# made goes back in an X-Query-Count header too - handy for spotting N+1
+# problems (see db_utils/query_counter.py)
+request_histograms = RequestHistograms()
+
+def database_pool_metrics():
+    pool = db.engine.pool
+    return pool_metrics(pool.stats()) if hasattr(pool, "stats") else []
+
+request_histograms.registry.sources.append(database_pool_metrics)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = start_request()
+
+
+@app.after_request
+def add_server_timing_header(response):
+    metrics = g.pop("request_metrics", None)
+    if metrics is None:
+        return response
+    # the header has to go out before the body, so it has what we know so
+    # far - a streamed body is measured as it's sent, for /metrics
+    response.headers["Server-Timing"] = metrics.server_timing()
+    response.headers["X-Query-Count"] = str(metrics.queries)
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    method = request.method
+    sent = [0]
+    if response.is_streamed:
+        response.response = count_bytes(response.response, response.charset, sent)
+    else:
+        sent[0] = response.calculate_content_length() or 0
+
+    # called once the whole body has gone to the browser
+    def finished():
+        finish_request(metrics)
+        request_histograms.observe(endpoint, method, response.status_code, metrics, sent[0])
+
+    response.call_on_close(finished)
+    return response
+
+
+def count_bytes(chunks, charset, sent):
+    """ Pass on a streamed body's chunks (as bytes), adding up their size in sent[0] """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        # stop the generator we're reading from too, so stream_with_context
+        # lets go of the request right away
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
 
 # Below are our view functions, view functions return a string 
 # (usually a string of HTML)
@@ -35,11 +169,253 @@ def get_main():
 
 # This function gets called by our search form and will show search results
 # Our queries are in 'search.py', we call them on this page
+#
+# Results come back one page at a time:
+#   /search.json?search=kale&limit=20
+# If there are more, the response has an X-Next-Cursor header - ask for the
+# next page with the same search and &cursor=<that value> (our web app's
+# doSearch does, see static/js/visGardens.jsx)
+#
+# Or ask for every result, sent as they're made instead of all at once:
+#   /search.json?search=kale&stream=ndjson   (one JSON object per line)
+#   /search.json?search=kale&stream=json     (one JSON list, in chunks)
+#
+# Only need a few columns? Ask for just those, and we'll only load those
+# from the database too (see FieldSet in serializers.py):
+#   /search.json?search=kale&fields=product.name,company.trade_name,company.address
 @app.get("/search.json")
 def get_results():
     words = request.args['search'] 
-    results = search_product(words) # function defined in search.py
-    return jsonify(results)
+    index = search_index if app.config["SEARCH_BACKEND"] == "memory" else None
+    # mode=all to only find products matching every word (see query_planner.py)
+    mode = request.args.get("mode")
+    cursor = request.args.get("cursor")
+    stream = request.args.get("stream")
+
+    try:
+        fields = FieldSet.parse(request.args.get("fields"))
+        # notice new data first, so neither kind of answer uses old indexes
+        version = data_version.current(db.session)
+        limit = request.args.get("limit", type=int)
+        if limit is not None:
+            limit = max(1, min(limit, app.config["SEARCH_MAX_PAGE_SIZE"]))
+        subtrees = company_subtrees if fields is None else SubtreeCache()
+
+        if stream in ("ndjson", "json"):
+            # no limit: every result
+            results = iter_search(words, index, suggest_index, mode, limit, cursor,
+                                  subtrees, fields)
+            return stream_results(results, stream)
+
+        if limit is None:
+            limit = app.config["SEARCH_PAGE_SIZE"]
+        # searches that only differ by capitals, extra spaces, stopwords or
+        # word order share a cache entry (see query_planner.py)
+        cache_key = (app.config["SEARCH_BACKEND"], plan_search(words, mode).key, limit, cursor,
+                     fields.key if fields is not None else None)
+        entry = result_cache.get(cache_key, version)
+        if entry is None:
+            # function defined in search.py
+            with timed("search"):
+                results, next_cursor = search_page(words, index, suggest_index, mode, limit,
+                                                   cursor, subtrees, fields)
+            headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+            with timed("encode"):
+                body = jsonify(results).get_data()
+            entry = result_cache.put(cache_key, version, body, headers)
+    except ValueError as err:
+        abort(400, str(err))
+
+    response = Response(entry.body, mimetype="application/json", headers=entry.headers)
+    # the ETag lets the browser ask "has this changed?" with If-None-Match,
+    # if it hasn't, make_conditional sends back an empty 304 Not Modified
+    response.set_etag(entry.etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def stream_results(results, stream):
+    """
+    Send results to the browser as we make them. Flask sends each string
+    our generator yields as a chunk, so only one result at a time has to be
+    in memory and the browser starts getting data right away.
+    (stream_with_context keeps our database session around until we're done)
+    """
+    def ndjson_lines():
+        for result in results:
+            with timed("encode"):
+                line = json.dumps(result) + "\n"
+            yield line
+
+    def json_chunks():
+        yield "["
+        for number, result in enumerate(results):
+            with timed("encode"):
+                chunk = ("," if number else "") + json.dumps(result)
+            yield chunk
+        yield "]"
+
+    if stream == "ndjson":
+        return Response(stream_with_context(ndjson_lines()), mimetype="application/x-ndjson")
+    return Response(stream_with_context(json_chunks()), mimetype="application/json")
+
+
+# Suggestions for what the user might be typing in our search box, e.g.
+# /suggest.json?q=aru  ->  [{"text": "Arugula", "kind": "product"}, ...]
+# The SearchBox calls this on every keystroke, so it answers from a trie we
+# build ahead of time (see suggest.py)
+@app.get("/suggest.json")
+def get_suggestions():
+    prefix = request.args.get("q", "")
+    limit = request.args.get("limit", 8, type=int)
+    data_version.current(db.session)
+    suggest_index.ensure_built()
+    response = jsonify(suggest_index.suggest(prefix, limit))
+    # let the browser reuse suggestions for a minute
+    response.cache_control.max_age = 60
+    return response
+
+
+def map_limit(limit: int):
+    """ limit, but at least 1 and at most MAP_MAX_RESULTS (like /search.json's) """
+    return max(1, min(limit, app.config["MAP_MAX_RESULTS"]))
+
+
+# Farms near a place, closest first, e.g. everything within 25km of
+# Brooklyn:  /nearby.json?lat=40.67&lon=-73.98&km=25
+# Each result has the facility (with its address), its company and the
+# company's products (see geo.py)
+@app.get("/nearby.json")
+def get_nearby():
+    latitude = request.args.get("lat", type=float)
+    longitude = request.args.get("lon", type=float)
+    km = request.args.get("km", 50, type=float)
+    limit = map_limit(request.args.get("limit", 100, type=int))
+    if (latitude is None or longitude is None
+            or not -90 <= latitude <= 90 or not -180 <= longitude <= 180):
+        abort(400, "lat and lon are required")
+    km = max(0, min(km, 2000))
+
+    found = facilities_near(latitude, longitude, km, limit)
+    return jsonify([facility_result(facility, distance) for distance, facility in found])
+
+
+# Farms inside a box - like the part of the map that's on screen, e.g.
+# /viewport.json?south=40.5&west=-74.3&north=40.9&east=-73.7
+# closest to the middle of the box first
+@app.get("/viewport.json")
+def get_viewport():
+    south = request.args.get("south", type=float)
+    west = request.args.get("west", type=float)
+    north = request.args.get("north", type=float)
+    east = request.args.get("east", type=float)
+    limit = map_limit(request.args.get("limit", 500, type=int))
+    if None in (south, west, north, east) or south > north:
+        abort(400, "south, west, north and east are required")
+
+    found = facilities_in_box(south, west, north, east, limit)
+    return jsonify([facility_result(facility, distance) for distance, facility in found])
+
+
+# Farms on the map, grouped into clusters for the map's zoom level, e.g.
+# /clusters.json?zoom=5&south=38&west=-80&north=44&east=-70
+# -> {"zoom": 5, "clusters": [{"count": 37, "latitude": ..., "longitude": ...,
+#                              "regions": {"NY": 30, "NJ": 7}, ...}, ...],
+#     "regions": {"NY": 30, "NJ": 7, ...}}
+# "regions" adds up the farms on screen by state, for the Data Maps view.
+# No matter how much data we have, that's at most a few hundred clusters
+@app.get("/clusters.json")
+def get_clusters():
+    zoom = request.args.get("zoom", type=float)
+    south = request.args.get("south", -90, type=float)
+    west = request.args.get("west", -180, type=float)
+    north = request.args.get("north", 90, type=float)
+    east = request.args.get("east", 180, type=float)
+    if zoom is None or south > north:
+        abort(400, "zoom is required, and south can't be above north")
+
+    data_version.current(db.session)
+    cluster_index.ensure_built()
+    clusters = cluster_index.clusters(zoom, south, west, north, east)
+    regions = {}
+    for cluster in clusters:
+        for region, count in cluster["regions"].items():
+            regions[region] = regions.get(region, 0) + count
+    response = jsonify({"zoom": max(0, min(int(zoom), cluster_index.max_zoom)),
+                        "clusters": clusters, "regions": regions})
+    # the map asks again every time it moves, let the browser reuse answers
+    # for a minute
+    response.cache_control.max_age = 60
+    return response
+
+
+# Every facility we know the location of, as GeoJSON the map can draw
+# directly. The body is made once per data load and compressed ahead of
+# time - we send brotli or gzip if the browser's Accept-Encoding says it can
+# read them (see geojson_layer.py)
+@app.get("/facilities.geojson")
+def get_facilities_geojson():
+    data_version.current(db.session)
+    facilities_layer.ensure_built()
+    accepted = [ encoding for encoding in ("br", "gzip")
+                 if request.accept_encodings.quality(encoding) > 0 ]
+    encoding, body, etag = facilities_layer.body_for(accepted)
+
+    response = Response(body, mimetype="application/geo+json")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    # the answer depends on Accept-Encoding, so caches in between have to
+    # keep one copy per encoding
+    response.vary.add("Accept-Encoding")
+    # the ETag only changes when the data does, so it stays good across
+    # server restarts - each encoding needs its own
+    response.set_etag(etag if encoding == "identity" else f"{etag}-{encoding}")
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["FACILITIES_GEOJSON_MAX_AGE"]
+    return response.make_conditional(request)
+
+
+# How many features /facilities.geojson has and how big each encoding is
+@app.get("/facilities/layer.json")
+def get_facilities_layer_stats():
+    return jsonify(facilities_layer.stats())
+
+
+# How busy our database connection pool is (how long requests wait for a
+# connection, how close it is to full) and how much SQL we've run
+@app.get("/db/pool.json")
+def get_db_pool_stats():
+    pool = db.engine.pool
+    return jsonify({
+        "pool": pool.stats() if hasattr(pool, "stats") else None,
+        "sql": sql_log.stats(),
+    })
+
+
+# Request latency, queries, rows and response sizes for Prometheus to
+# scrape (see metrics.py)
+@app.get("/metrics")
+def get_metrics():
+    return Response(request_histograms.exposition(), content_type=METRICS_CONTENT_TYPE)
+
+
+# How many clusters each zoom level has
+@app.get("/clusters/index.json")
+def get_cluster_index_stats():
+    return jsonify(cluster_index.stats())
+
+
+# How big the in-memory search index is and how long it took to build
+@app.get("/search/index.json")
+def get_search_index_stats():
+    return jsonify(search_index.stats())
+
+
+# How well our search result cache is doing - hits, misses, evictions
+@app.get("/search/cache.json")
+def get_search_cache_stats():
+    return jsonify(dict(result_cache.stats(), data_version=data_version.version,
+                        company_subtrees=company_subtrees.stats()))
 
 
 # This gets called by our search form and will show search results
@@ -54,4 +430,12 @@ def get_results():
 
 
 if __name__ == "__main__":
+    if app.config["SEARCH_BACKEND"] == "memory":
+        # build the index now so the first search doesn't have to wait
+        with app.app_context():
+            search_index.rebuild()
+    with app.app_context():
+        suggest_index.rebuild()
+        cluster_index.rebuild()
+        facilities_layer.rebuild()
     app.run(host="0.0.0.0", debug=True)
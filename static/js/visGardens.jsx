@@ -19,6 +19,31 @@ function NavBar(props) {
 
 // Components on this page ordered from smallest/finest to largest
 function SearchBox(props) {
+    const [suggestions, setSuggestions] = React.useState([])
+    // the last thing we asked /suggest.json about, so a slow answer for an
+    // older keystroke doesn't replace the answer for the newest one
+    const latestPrefix = React.useRef("")
+
+    /**
+     * Called on every keystroke - asks our /suggest.json route for product
+     * names, categories and companies that start with what's been typed
+     * (calls get_suggestions() in server.py)
+     */
+    const updateSuggestions = (prefix) => {
+        latestPrefix.current = prefix
+        if (!prefix.trim()) {
+            setSuggestions([])
+            return
+        }
+        fetch(`/suggest.json?q=${encodeURIComponent(prefix)}`)
+            .then((response) => response.json())
+            .then((data) => {
+                if (prefix === latestPrefix.current) {
+                    setSuggestions(data)
+                }
+            });
+    }
+
     return (
         <div className="searchbox-outline">
             <form>
@@ -28,7 +53,14 @@ function SearchBox(props) {
                     type="search"
                     autoComplete="off"
                     placeholder="Search..."
+                    list="search-suggestions"
+                    onChange={(event) => updateSuggestions(event.target.value)}
                 />
+                <datalist id="search-suggestions">
+                    {suggestions.map((suggestion) =>
+                        <option key={`${suggestion.kind}-${suggestion.text}`} value={suggestion.text} />
+                    )}
+                </datalist>
                 <button
                     onClick={(event) => {
                         event.preventDefault();
@@ -75,6 +107,8 @@ function AddressTemplate(props) {
 function SearchResultsContainer(props) {
     const productDivs = []
     const coords = []
+    // one map icon per company, not one per matching product
+    const companiesOnMap = new Set()
     for (let res of props.searchResults) {
         productDivs.push(
             <div key={res.product.id}
@@ -91,8 +125,11 @@ function SearchResultsContainer(props) {
                 </div>
             </div>
         )
-        let addr = res.company.address
-        coords.push([addr.longitude, addr.latitude])
+        if (!companiesOnMap.has(res.company.id)) {
+            companiesOnMap.add(res.company.id)
+            let addr = res.company.address
+            coords.push([addr.longitude, addr.latitude])
+        }
     }
     if (coords.length > 0) {
         setMapIcons(coords)
@@ -117,16 +154,42 @@ function Shell(props) {
      * gets a list of companies back and then sets the searchResults
      * state to the list of companies
      */
+    // the only columns our search result cards use - the server won't load
+    // or send anything else (see FieldSet in serializers.py)
+    const searchFields = "product.name,product.description,company.trade_name,company.address"
+
+    // the search we're showing results for, so pages of an older search
+    // that arrive late don't get mixed in
+    const latestSearch = React.useRef("")
+
+    // /search.json sends results a page at a time - we show the first page
+    // right away, and while the response has an X-Next-Cursor header we
+    // ask for the next page and add it on
     const doSearch = (searchKeywords) => {
-        fetch(`/search.json?search=${searchKeywords}`)  // calls get_results() function from server.py
-            .then((response) => response.json()) // converts the json text our flask route returned into an object
-            .then((data) => {
-                if (data !== undefined && data.length) {
-                    setShellState({ searchResults: data })
-                } else {
-                    console.log(`No data returned for search [${searchKeywords}]`)
-                }
-            });
+        latestSearch.current = searchKeywords
+        const searchUrl = `/search.json?search=${encodeURIComponent(searchKeywords)}&fields=${searchFields}`
+
+        const fetchPage = (cursor, resultsSoFar) => {
+            const pageUrl = cursor ? `${searchUrl}&cursor=${encodeURIComponent(cursor)}` : searchUrl
+            fetch(pageUrl)  // calls get_results() function from server.py
+                .then((response) => response.json() // converts the json text our flask route returned into an object
+                    .then((data) => [data, response.headers.get("X-Next-Cursor")]))
+                .then(([data, nextCursor]) => {
+                    if (searchKeywords !== latestSearch.current) {
+                        return
+                    }
+                    const results = resultsSoFar.concat(data || [])
+                    if (results.length) {
+                        setShellState({ searchResults: results })
+                    } else {
+                        console.log(`No data returned for search [${searchKeywords}]`)
+                    }
+                    if (nextCursor) {
+                        fetchPage(nextCursor, results)
+                    }
+                });
+        }
+        fetchPage(null, [])
     }
 
     const toggleContactFormVis = () => {
@@ -238,7 +301,12 @@ const map = new mapboxgl.Map({
     ]
 });
 
-map.on('load', () => { map.resize(); });
+map.on('load', () => {
+    map.resize();
+    loadClusters();
+});
+// every time the map stops moving, get the clusters for what's on screen
+map.on('moveend', () => loadClusters());
 map.on('style.load', () => {
     map.setFog({}); // Set the default atmosphere style
     // map.invalidateSize();
@@ -251,6 +319,67 @@ map.on('style.load', () => {
     })
 });
 
+/**
+ * Asks our /clusters.json route for every farm on screen, grouped into
+ * clusters for the current zoom level (calls get_clusters() in server.py)
+ * - so we get a few hundred points at most, however many farms there are
+ */
+function loadClusters() {
+    const bounds = map.getBounds()
+    const params = new URLSearchParams({
+        zoom: Math.floor(map.getZoom()),
+        south: Math.max(bounds.getSouth(), -90),
+        west: Math.max(bounds.getWest(), -180),
+        north: Math.min(bounds.getNorth(), 90),
+        east: Math.min(bounds.getEast(), 180),
+    })
+    fetch(`/clusters.json?${params}`)
+        .then((response) => response.json())
+        .then((data) => setClusterIcons(data.clusters));
+}
+
+function setClusterIcons(clusters) {
+    const clusterData = {
+        'type': 'FeatureCollection',
+        'features': clusters.map((cluster) => ({
+            'type': 'Feature',
+            'properties': { 'id': cluster.id, 'count': cluster.count },
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [cluster.longitude, cluster.latitude]
+            }
+        }))
+    }
+
+    let clusterSource = map.getSource('farm-clusters')
+    if (clusterSource) {
+        clusterSource.setData(clusterData)
+        return
+    }
+
+    map.addSource('farm-clusters', { 'type': 'geojson', 'data': clusterData })
+    map.addLayer({
+        'id': 'farm-clusters',
+        'type': 'circle',
+        'source': 'farm-clusters',
+        'paint': {
+            'circle-color': '#4f9d4f',
+            'circle-opacity': 0.7,
+            // bigger clusters get bigger circles
+            'circle-radius': ['interpolate', ['linear'], ['get', 'count'], 1, 8, 100, 24]
+        }
+    })
+    map.addLayer({
+        'id': 'farm-cluster-counts',
+        'type': 'symbol',
+        'source': 'farm-clusters',
+        'layout': {
+            'text-field': ['to-string', ['get', 'count']],
+            'text-size': 12
+        }
+    })
+}
+
 function updateMap(latitude, longitude) {
     map.flyTo({ center: [longitude, latitude], zoom: 9 })
 }
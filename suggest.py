@@ -0,0 +1,168 @@
+"""
+Search suggestions ("autocomplete") for our search box.
+
+The SearchBox in static/js/visGardens.jsx asks /suggest.json for
+suggestions on every keystroke, so answering has to be quick. We get there
+by doing the work up front: we read every product name, category and
+company trade name once and put them in a "trie" - a tree with one letter
+per level, so everything starting with "ar" lives under root -> a -> r.
+
+Each node of the trie also keeps the best few completions of everything
+underneath it, so answering "what starts with 'aru'?" is just three steps
+down the tree - no matter how many names we have.
+
+We add each name under every word in it, so "butter" suggests
+"Baby Butterhead" as well as "Butterhead".
+
+We also keep a TrigramIndex of every word a search can match - in our
+names, key words and descriptions (see search_index.py) - so
+search_product can fix misspelled search words like "arugla", and leave
+the words we know alone.
+
+to use:
+    suggestions = SuggestIndex()
+    suggestions.rebuild()           # needs an app context, reads our tables
+    suggestions.suggest("aru")      # [{"text": "Arugula", "kind": "product"}, ...]
+    suggestions.correct("arugla")   # ["arugula"]
+"""
+from db_utils.rebuildable import Rebuildable
+from model import db, Company, Product
+from search_index import TrigramIndex, tokenize
+import unicodedata
+
+
+# a suggestion's score is how many products it covers times the weight of
+# its kind, so product names come before categories and companies
+KIND_WEIGHTS = {
+    "product": 3,
+    "category": 2,
+    "company": 1,
+}
+
+
+def normalize_prefix(text: str):
+    """ lowercase, no accents, single spaces - so "  Aru" finds "Arugula" """
+    text = unicodedata.normalize("NFKD", text)
+    text = text.encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(text.split())
+
+
+class _TrieNode(object):
+    # __slots__ keeps each of the (many) nodes small
+    __slots__ = ("children", "entries", "top")
+
+    def __init__(self):
+        self.children = {}
+        # suggestions whose key ends right here: text -> (score, kind)
+        self.entries = {}
+        # best suggestions at or below this node, filled in by finalize()
+        self.top = []
+
+
+class PrefixTrie(object):
+
+    def __init__(self, top_size: int=10):
+        self.root = _TrieNode()
+        self.top_size = top_size
+
+    def insert(self, key: str, text: str, kind: str, score: int):
+        node = self.root
+        for letter in key:
+            node = node.children.setdefault(letter, _TrieNode())
+        if text not in node.entries or node.entries[text][0] < score:
+            node.entries[text] = (score, kind)
+
+    def finalize(self):
+        """
+        Work out the best completions for every node, from the bottom of the
+        tree up. Call this once after inserting everything.
+        """
+        self._finalize(self.root)
+
+    def _finalize(self, node):
+        best = {text: (score, kind) for text, (score, kind) in node.entries.items()}
+        for child in node.children.values():
+            for score, text, kind in self._finalize(child):
+                if text not in best or best[text][0] < score:
+                    best[text] = (score, kind)
+
+        ranked = sorted(((score, text, kind) for text, (score, kind) in best.items()),
+                        key=lambda entry: (-entry[0], entry[1]))
+        node.top = ranked[:self.top_size]
+        return node.top
+
+    def complete(self, prefix: str):
+        node = self.root
+        for letter in prefix:
+            node = node.children.get(letter)
+            if node is None:
+                return []
+        return node.top
+
+
+class SuggestIndex(Rebuildable):
+
+    label = "suggestions"
+
+    def __init__(self, top_size: int=10):
+        super().__init__()
+        self.top_size = top_size
+        self.trie = PrefixTrie(top_size)
+        self.spelling = TrigramIndex()
+        self.names = 0
+
+    def build(self):
+        # count how many products share each name/category/company,
+        # we only need a few columns - not whole objects
+        counts = {}
+        trie = PrefixTrie(self.top_size)
+        spelling = TrigramIndex()
+        rows = (db.session.query(Product.name, Product.category, Product.key_words,
+                                 Product.description, Company.trade_name)
+                .outerjoin(Company, Company.id == Product.company_id))
+        for name, category, key_words, description, trade_name in rows:
+            for text, kind in ((name, "product"), (category, "category"),
+                               (trade_name, "company")):
+                if text:
+                    text = " ".join(text.split())
+                    counts[(text, kind)] = counts.get((text, kind), 0) + 1
+            # key words and descriptions aren't suggested, but we do know
+            # how to spell them
+            for term in tokenize(key_words) + tokenize(description):
+                spelling.add(term)
+
+        for (text, kind), count in counts.items():
+            score = count * KIND_WEIGHTS[kind]
+            key = normalize_prefix(text)
+            words = key.split(" ")
+            # add the text under every word in it
+            for i in range(len(words)):
+                trie.insert(" ".join(words[i:]), text, kind, score)
+            for term in tokenize(text):
+                spelling.add(term)
+        trie.finalize()
+
+        self.trie, self.spelling = trie, spelling
+        self.names = len(counts)
+
+    def suggest(self, prefix: str, limit: int=8):
+        prefix = normalize_prefix(prefix)
+        if not prefix:
+            return []
+        return [{"text": text, "kind": kind}
+                for score, text, kind in self.trie.complete(prefix)[:limit]]
+
+    def correct(self, word: str):
+        """ Known words spelled most like word (see TrigramIndex) """
+        return self.spelling.similar(word)
+
+    def knows(self, word: str):
+        """ True if word is in our names, key words or descriptions - it isn't misspelled """
+        return word in self.spelling
+
+    def stats(self):
+        """ How many names we suggest and how long they took to build """
+        return {
+            "names": self.names,
+            **super().stats(),
+        }
@@ -0,0 +1,31 @@
+"""
+Shared setup for our tests.
+
+    $ python -m pytest tests
+
+Tests that need our PostgreSQL database (with our data loaded by initdb.py)
+use the app fixture - they're skipped if we can't connect to it.
+"""
+import os
+import sys
+
+import pytest
+
+# let the tests import our modules from the repo's top folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+@pytest.fixture(scope="session")
+def app():
+    from sqlalchemy import exc, text
+    from server import app
+    from model import db
+
+    with app.app_context():
+        try:
+            db.session.execute(text("SELECT 1 FROM product LIMIT 1"))
+        except exc.SQLAlchemyError as err:
+            pytest.skip(f"needs our database: {err.__class__.__name__}")
+        finally:
+            db.session.rollback()
+        yield app
@@ -0,0 +1,77 @@
+import pytest
+
+from serializers import FieldSet
+
+# fields= strings our web app (or anyone) might send to /search.json
+FIELDS = [
+    "product.name",
+    "product.name,company.trade_name",
+    "product.name,facilities.nickname",
+    "product.name,facilities.address.city",
+    "product.name,company.address,facilities",
+    "product.*,company.*,company.address.*,facilities.*,facilities.address.*",
+]
+
+
+def test_facility_fields_include_the_company_id():
+    fields = FieldSet.parse("product.name,facilities.nickname")
+    assert fields.columns["company"] == ("id",)
+    assert fields.columns["facilities"] == ("id", "nickname")
+
+
+def test_trim_keeps_missing_addresses_and_companies_blank():
+    fields = FieldSet.parse("product.name,company.address.city,facilities.address.city")
+    result = {"product": {"id": 1, "name": "Kale"}, "company": None, "facilities": [],
+              "score": 8}
+    assert fields.trim(result) == {"product": {"id": 1, "name": "Kale"}, "company": None,
+                                   "facilities": [], "score": 8}
+
+    result["company"] = {"id": 2, "trade_name": "Oishii", "address": None}
+    result["facilities"] = [{"id": 3, "nickname": "Headquarters", "address": None}]
+    assert fields.trim(result)["company"] == {"id": 2, "address": None}
+    assert fields.trim(result)["facilities"] == [{"id": 3, "address": None}]
+
+
+@pytest.fixture(scope="module")
+def memory_index(app):
+    from search_index import SearchIndex
+    index = SearchIndex()
+    index.rebuild()
+    return index
+
+
+@pytest.mark.parametrize("text", FIELDS)
+def test_both_search_backends_send_the_same_fields(app, memory_index, text):
+    from search import search_page
+
+    fields = FieldSet.parse(text)
+    fulltext, _ = search_page("lettuce", None, None, None, 100, None, None, fields)
+    memory, _ = search_page("lettuce", memory_index, None, None, 100, None, None, fields)
+    assert fulltext and memory
+
+    # the two backends score matches differently, so compare each product
+    # they both found, without its score
+    def by_product(results):
+        return { result["product"]["id"]: { key: value for key, value in result.items()
+                                            if key != "score" }
+                 for result in results }
+
+    fulltext, memory = by_product(fulltext), by_product(memory)
+    both = fulltext.keys() & memory.keys()
+    assert both
+    for product_id in both:
+        assert fulltext[product_id] == memory[product_id]
+    assert set(next(iter(fulltext.values()))) == {"product"} | {
+        section for section in ("company", "facilities") if section in fields }
+
+
+def test_custom_fields_dont_grow_the_shared_company_cache(app):
+    from server import company_subtrees
+
+    client = app.test_client()
+    client.get("/search.json?search=greens").close()
+    shared = company_subtrees.stats()["companies"]
+    for fields in ("product.name,company.trade_name", "product.id,company.website",
+                   "product.name,facilities.nickname"):
+        client.get(f"/search.json?search=greens&fields={fields}").close()
+    assert company_subtrees.stats()["companies"] == shared
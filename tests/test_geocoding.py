@@ -0,0 +1,98 @@
+import os
+import runpy
+import time
+
+from geocoding import (PRECISION_ADDRESS, FakeGeocoder, GeocodeCache, Provider, TokenBucket,
+                       geocode_addresses, normalize_address)
+
+NEWARK = (40.7282, -74.1767)
+BROOKLYN = (40.7003, -73.9672)
+
+
+def queries_for(*addresses):
+    return { normalize_address(address): address for address in addresses }
+
+
+def test_cache_means_each_address_is_asked_once(tmp_path):
+    path = str(tmp_path / "geocode_cache.csv")
+    geocoder = FakeGeocoder({"212 Rome St Newark NJ": NEWARK})
+    providers = [Provider("fake", geocoder, per_second=1000)]
+
+    # the same address spelled two ways is one lookup
+    queries = queries_for("212 Rome Street, Newark NJ", "212 rome st. newark nj",
+                          "1 Nowhere Lane")
+    cache = GeocodeCache(path)
+    found = geocode_addresses(queries, providers, cache)
+    cache.save()
+    assert found == {"212 rome st newark nj": NEWARK + ("fake",)}
+    assert len(geocoder.queries) == 2
+
+    # next run: found and not-found addresses both come from the file
+    cache = GeocodeCache(path)
+    assert geocode_addresses(queries, providers, cache) == found
+    assert len(geocoder.queries) == 2
+    assert cache.stats()["not_found"] == 1
+
+    geocoder.coordinates[normalize_address("1 Nowhere Lane")] = BROOKLYN
+    found = geocode_addresses(queries, providers, cache, retry_not_found=True)
+    assert found["1 nowhere ln"] == BROOKLYN + ("fake",)
+    assert len(geocoder.queries) == 3
+
+
+def test_another_provider_tries_what_one_could_not_find(tmp_path):
+    def broken(query):
+        raise TimeoutError("no answer")
+
+    first = Provider("first", FakeGeocoder({"212 Rome St Newark NJ": NEWARK}), per_second=1000)
+    second = Provider("second", FakeGeocoder({"Brooklyn Navy Yard": BROOKLYN}), per_second=1000)
+    cache = GeocodeCache(str(tmp_path / "geocode_cache.csv"))
+    found = geocode_addresses(queries_for("212 Rome St Newark NJ", "Brooklyn Navy Yard",
+                                          "1 Nowhere Lane"),
+                              [first, second], cache)
+    assert found == {"212 rome st newark nj": NEWARK + ("first",),
+                     "brooklyn navy yard": BROOKLYN + ("second",)}
+    assert cache.entries["1 nowhere ln"]["provider"] == "first,second"
+
+    # a provider that fails doesn't make us remember "not found"
+    cache = GeocodeCache(str(tmp_path / "other_cache.csv"))
+    flaky = Provider("flaky", broken, per_second=1000)
+    assert geocode_addresses(queries_for("1 Nowhere Lane"), [flaky], cache) == {}
+    assert flaky.stats()["errors"] == 1
+    assert cache.entries == {}
+
+
+def test_token_bucket_keeps_to_its_rate():
+    bucket = TokenBucket(per_second=20, burst=2)
+    started = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # two right away from the burst, then one every 1/20 second
+    assert time.monotonic() - started >= 4 / 20 * 0.9
+
+
+def test_provider_waits_for_its_bucket():
+    provider = Provider("slow", FakeGeocoder({}), per_second=10)
+    for query in ("a", "b", "c"):
+        provider.lookup(query)
+    assert provider.stats()["requests"] == 3
+    assert provider.waited_seconds >= 2 / 10 * 0.9
+
+
+def test_facilities_with_the_same_nickname_keep_their_own_addresses():
+    # gc.py has the same name as Python's own gc module, so load it by path
+    gc_script = runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "gc.py"))
+    address_keys, address_changes = gc_script["address_keys"], gc_script["address_changes"]
+
+    # (Facility.nickname, Address.id, address_1 ... country, latitude, longitude, precision)
+    rows = [("Headquarters", 1, "315 3rd Ave", None, None, "Brooklyn", "NY", "11215", "USA",
+             None, None, None),
+            ("Headquarters", 2, "212 Rome St", None, None, "Newark", "NJ", "07105", "USA",
+             None, None, None)]
+    key_for_address, queries = address_keys(rows)
+    assert len(queries) == 2
+    found = { key_for_address[1]: BROOKLYN + (PRECISION_ADDRESS,),
+              key_for_address[2]: NEWARK + (PRECISION_ADDRESS,) }
+
+    changes = address_changes(rows, key_for_address, found, {})
+    assert (changes[1]["lat"], changes[1]["lon"]) == BROOKLYN
+    assert (changes[2]["lat"], changes[2]["lon"]) == NEWARK
@@ -0,0 +1,20 @@
+import gzip
+import hashlib
+
+import geojson_layer
+from geojson_layer import GeoJSONLayer
+
+
+def test_body_and_etag_come_from_the_same_build(monkeypatch):
+    layer = GeoJSONLayer()
+    for count in (1, 2):
+        features = [ {"type": "Feature", "properties": {"facility_id": number}}
+                     for number in range(count) ]
+        monkeypatch.setattr(geojson_layer, "facility_features", lambda: iter(features))
+        layer.rebuild()
+
+        encoding, body, etag = layer.body_for(["gzip"])
+        assert encoding == "gzip"
+        assert etag == hashlib.sha1(gzip.decompress(body)).hexdigest()
+        assert layer.stats()["etag"] == etag
+        assert layer.stats()["features"] == count
@@ -0,0 +1,10 @@
+def test_map_limits_are_clamped(app):
+    client = app.test_client()
+    everything = client.get("/viewport.json?south=-90&west=-180&north=90&east=180").get_json()
+    assert len(everything) > 1
+    for limit in (0, -1):
+        one = client.get(f"/viewport.json?south=-90&west=-180&north=90&east=180&limit={limit}")
+        assert len(one.get_json()) == 1
+        near = client.get(f"/nearby.json?lat=40.67&lon=-73.98&km=50&limit={limit}")
+        assert len(near.get_json()) == 1
+    assert client.get("/nearby.json?lat=40.67&lon=-273.98").status_code == 400
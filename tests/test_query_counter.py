@@ -0,0 +1,32 @@
+from sqlalchemy import create_engine, text
+
+from db_utils.query_counter import count_queries, statement_listeners
+from db_utils.request_metrics import finish_request, start_request, timed
+
+
+def test_counters_listeners_and_request_metrics_see_the_same_statements():
+    engine = create_engine("sqlite://")
+    heard = []
+
+    def listener(statement, parameters, seconds):
+        heard.append(statement)
+
+    statement_listeners.append(listener)
+    try:
+        metrics = start_request()
+        with count_queries() as counter, engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            with timed("serialize"):
+                connection.execute(text("SELECT 2"))
+        finish_request(metrics)
+        # not counted any more
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 3"))
+    finally:
+        statement_listeners.remove(listener)
+
+    assert counter.statements == ["SELECT 1", "SELECT 2"]
+    assert metrics.queries == 2
+    assert metrics.phase_queries == {"serialize": 1}
+    assert 'desc="1 lazy query"' in metrics.server_timing()
+    assert heard == ["SELECT 1", "SELECT 2", "SELECT 3"]
@@ -0,0 +1,26 @@
+"""
+A search runs the same few queries however many products it finds - the
+relationships a result needs are loaded up front (see the loading plan in
+model.py), not one product at a time while we make the result dicts.
+"""
+import pytest
+
+from db_utils import count_queries
+from search import search_product
+from serializers import FieldSet
+
+
+@pytest.mark.parametrize("fields", [None, "product.name,company.trade_name",
+                                    "product.name,facilities.nickname"])
+def test_search_query_count_does_not_grow_with_results(app, fields):
+    field_set = FieldSet.parse(fields) if fields else None
+    counts = {}
+    for words in ("greens", "lettuce", "basil"):
+        with count_queries() as counter:
+            results = search_product(words, fields=field_set)
+        assert results
+        counts[words] = counter.count
+    # one query for the products (and their companies), one more for the
+    # companies' facilities if we're sending them
+    assert len(set(counts.values())) == 1 and counts["greens"] <= 2, counts
+
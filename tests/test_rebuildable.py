@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+from db_utils.rebuildable import Rebuildable
+
+
+class CountingIndex(Rebuildable):
+    """ Takes a while to build, and counts how many times it did """
+
+    def __init__(self):
+        super().__init__()
+        self.builds = 0
+
+    def build(self):
+        time.sleep(0.05)
+        self.builds += 1
+
+
+def test_requests_that_find_it_stale_at_once_build_it_once():
+    index = CountingIndex()
+    threads = [ threading.Thread(target=index.ensure_built) for _ in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert index.builds == 1
+    assert not index.stale
+
+    # a data load marks it stale, the next request builds it again
+    index.stale = True
+    index.ensure_built()
+    index.ensure_built()
+    assert index.builds == 2
+
+
+def test_a_failed_build_stays_stale():
+    index = CountingIndex()
+
+    def broken_build():
+        raise RuntimeError("database went away")
+
+    index.build = broken_build
+    with pytest.raises(RuntimeError):
+        index.ensure_built()
+    assert index.stale
+    assert index.built_at is None
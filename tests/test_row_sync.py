@@ -0,0 +1,54 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+from db_utils.row_sync import diff_rows, hash_rows, records
+
+
+def sheet(rows):
+    df = pd.DataFrame(rows, columns=["trade_name", "city", "postal"])
+    df["natural_key"] = df["trade_name"]
+    df["row_hash"] = hash_rows(df, ["city", "postal", "trade_name"])
+    return df
+
+
+def test_hashes_depend_on_values_not_dtypes():
+    as_numbers = pd.DataFrame({"postal": [7105, None], "city": ["Newark", None]})
+    as_floats = pd.DataFrame({"postal": [7105.0, np.nan], "city": ["Newark", np.nan]})
+    as_text = pd.DataFrame({"postal": ["7105", None], "city": ["Newark", None]})
+    as_nullable = as_numbers.astype({"postal": "Int64", "city": "string"})
+    expected = hash_rows(as_numbers, ["postal", "city"]).tolist()
+    for df in (as_floats, as_text, as_nullable):
+        assert hash_rows(df, ["postal", "city"]).tolist() == expected
+    # a value that did change, or moved to another column, changes the hash
+    assert hash_rows(as_numbers.assign(postal=[7106, None]), ["postal", "city"])[0] != expected[0]
+    assert hash_rows(as_numbers, ["city", "postal"])[0] != expected[0]
+    # the same strings every time, with any pandas - they're saved in the
+    # row_hash table
+    assert expected[0] == hashlib.blake2b(json.dumps(["7105", "Newark"]).encode(),
+                                          digest_size=8).hexdigest()
+
+
+def test_diff_rows_sorts_inserts_updates_and_deletes():
+    before = sheet([("AeroFarms", "Newark", 7105), ("Oishii", "Jersey City", 7306),
+                    ("Plenty", "South San Francisco", 94080)])
+    stored = before[["natural_key", "row_hash"]].assign(row_id=[1, 2, 3])
+
+    after = sheet([("AeroFarms", "Newark", 7105), ("Oishii", "Kearny", 7032),
+                   ("Gotham Greens", "Brooklyn", 11231)])
+    inserts, updates, deletes = diff_rows(after, stored)
+    assert inserts["natural_key"].tolist() == ["Gotham Greens"]
+    assert updates[["natural_key", "city", "row_id"]].values.tolist() == [["Oishii", "Kearny", 2]]
+    assert deletes[["natural_key", "row_id"]].values.tolist() == [["Plenty", 3]]
+
+    # nothing changed, nothing to do
+    inserts, updates, deletes = diff_rows(before, stored)
+    assert len(inserts) == len(updates) == len(deletes) == 0
+
+
+def test_records_are_plain_values_with_none_for_blanks():
+    df = pd.DataFrame({"postal": [7105, None], "city": ["Newark", np.nan]}).astype(
+        {"postal": "Int64"})
+    assert records(df) == [{"postal": 7105, "city": "Newark"}, {"postal": None, "city": None}]
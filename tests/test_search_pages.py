@@ -0,0 +1,32 @@
+import json
+
+
+def all_pages(client, url):
+    """ Every result of a paged /search.json, following X-Next-Cursor like our web app """
+    results, cursor = [], None
+    while True:
+        response = client.get(url + (f"&cursor={cursor}" if cursor else ""))
+        assert response.status_code == 200
+        results.extend(response.get_json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return results
+
+
+def test_following_cursors_gets_every_streamed_result(app):
+    client = app.test_client()
+    streamed = [ json.loads(line) for line in
+                 client.get("/search.json?search=greens&stream=ndjson").get_data(as_text=True)
+                 .splitlines() ]
+    paged = all_pages(client, "/search.json?search=greens&limit=7")
+    assert len(streamed) > 7
+    assert [ result["product"]["id"] for result in paged ] == \
+           [ result["product"]["id"] for result in streamed ]
+
+
+def test_stream_limit_is_clamped_like_pages(app):
+    client = app.test_client()
+    one = client.get("/search.json?search=greens&stream=ndjson&limit=0")
+    assert len(one.get_data(as_text=True).splitlines()) == 1
+    page = client.get("/search.json?search=greens&limit=0")
+    assert len(page.get_json()) == 1
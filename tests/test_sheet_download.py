@@ -0,0 +1,113 @@
+"""
+db_utils/sheet_download.py against a little HTTP server of our own that
+stands in for Google Sheets.
+"""
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+from db_utils.sheet_download import (CHANGED, FAILED, UNCHANGED, download_google_worksheets,
+                                     load_download_state)
+
+
+class StandInSheets(http.server.BaseHTTPRequestHandler):
+    """ Serves sheets["<name>"] at /<name>.csv, with an ETag unless the name is in no_etags """
+
+    sheets = {}
+    no_etags = set()
+    requests = []
+
+    def do_GET(self):
+        name = self.path.strip("/")[:-len(".csv")]
+        self.requests.append((name, self.headers.get("If-None-Match")))
+        body = self.sheets.get(name)
+        if body is None:
+            self.send_error(500)
+            return
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if name not in self.no_etags and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        if name not in self.no_etags:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def sheet_server():
+    StandInSheets.sheets = {}
+    StandInSheets.no_etags = set()
+    StandInSheets.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInSheets)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield StandInSheets, f"http://127.0.0.1:{server.server_port}/{{sheet_name}}.csv"
+    server.shutdown()
+    server.server_close()
+
+
+def read(data_dir, name):
+    with open(os.path.join(data_dir, f"{name}.csv"), "rb") as file:
+        return file.read()
+
+
+def test_downloads_only_what_changed(sheet_server, tmp_path):
+    sheets, base_url = sheet_server
+    data_dir = str(tmp_path)
+    sheets.sheets = {"company": b'"trade_name"\n"AeroFarms"\n',
+                     "product": b'"name"\n"Basil"\n'}
+    sheets.no_etags = {"product"}
+
+    def download():
+        return download_google_worksheets("", ["company", "product"], data_dir, base_url)
+
+    assert download() == {"company": CHANGED, "product": CHANGED}
+    assert read(data_dir, "company") == sheets.sheets["company"]
+
+    # the server says "not modified" for company, and product's hash is the same
+    sheets.requests.clear()
+    assert download() == {"company": UNCHANGED, "product": UNCHANGED}
+    asked = dict(sheets.requests)
+    assert asked["company"] is not None
+    assert asked["product"] is None
+
+    sheets.sheets["company"] = b'"trade_name"\n"Oishii"\n'
+    assert download() == {"company": CHANGED, "product": UNCHANGED}
+    assert read(data_dir, "company") == sheets.sheets["company"]
+    assert load_download_state(data_dir)["company"]["sha256"] == \
+        hashlib.sha256(sheets.sheets["company"]).hexdigest()
+
+    # a changed file on disk (restored from a snapshot, say) is downloaded again
+    with open(os.path.join(data_dir, "company.csv"), "wb") as file:
+        file.write(b'"trade_name"\n')
+    assert download()["company"] == CHANGED
+    assert read(data_dir, "company") == sheets.sheets["company"]
+
+
+def test_a_failed_download_keeps_the_sheet_we_had(sheet_server, tmp_path):
+    sheets, base_url = sheet_server
+    data_dir = str(tmp_path)
+    sheets.sheets = {"company": b'"trade_name"\n"AeroFarms"\n'}
+    assert download_google_worksheets("", ["company"], data_dir, base_url) == {"company": CHANGED}
+
+    del sheets.sheets["company"]
+    assert download_google_worksheets("", ["company"], data_dir, base_url) == {"company": FAILED}
+    assert read(data_dir, "company") == b'"trade_name"\n"AeroFarms"\n'
+    assert "company" in load_download_state(data_dir)
+    # no half-written temporary files left behind
+    assert sorted(os.listdir(data_dir)) == ["company.csv", "downloads.json"]
+
+    # nothing running there at all
+    closed = "http://127.0.0.1:9/{sheet_name}.csv"
+    assert download_google_worksheets("", ["company"], data_dir, closed) == {"company": FAILED}
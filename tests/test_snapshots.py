@@ -0,0 +1,33 @@
+import os
+
+from db_utils.snapshots import list_snapshots, save_snapshot, snapshot_order
+
+
+def write_sheet(data_dir, name, text):
+    with open(os.path.join(data_dir, f"{name}.csv"), "w") as file:
+        file.write(text)
+
+
+def test_snapshot_order_puts_same_second_snapshots_in_order():
+    ids = ["20261018-140815-10", "20261018-140815-2", "20261018-140816",
+           "20261018-140815", "20261017-235959"]
+    assert sorted(ids, key=snapshot_order) == [
+        "20261017-235959", "20261018-140815", "20261018-140815-2",
+        "20261018-140815-10", "20261018-140816"]
+
+
+def test_unchanged_sheets_reuse_the_latest_snapshot(tmp_path):
+    data_dir = str(tmp_path)
+    write_sheet(data_dir, "company", '"trade_name"\n"AeroFarms"\n')
+    first = save_snapshot(data_dir, skip_if_unchanged=True)
+    assert save_snapshot(data_dir, skip_if_unchanged=True) == first
+
+    # several snapshots in the same second - "latest" is still the newest
+    write_sheet(data_dir, "company", '"trade_name"\n"Oishii"\n')
+    second = save_snapshot(data_dir, skip_if_unchanged=True)
+    write_sheet(data_dir, "company", '"trade_name"\n"Smallhold"\n')
+    third = save_snapshot(data_dir, skip_if_unchanged=True)
+    assert len({first, second, third}) == 3
+    assert [ manifest["id"] for manifest in list_snapshots(os.path.join(data_dir, "backup")) ] \
+        == [first, second, third]
+    assert save_snapshot(data_dir, skip_if_unchanged=True) == third
@@ -0,0 +1,36 @@
+"""
+When a full-text search finds nothing, search_product tries again with
+misspelled words fixed (see suggest.py) - but only the words we don't know.
+"""
+import pytest
+
+from search import search_product
+from suggest import SuggestIndex
+
+
+@pytest.fixture(scope="module")
+def spelling(app):
+    spelling = SuggestIndex()
+    spelling.rebuild()
+    return spelling
+
+
+def product_ids(results):
+    return [ result["product"]["id"] for result in results ]
+
+
+def test_known_words_are_left_alone(spelling):
+    for word in ("basil", "strawberry", "farm", "kale", "lettuce"):
+        assert spelling.knows(word)
+    assert not spelling.knows("lettuse")
+
+    # nothing has all of these words, and that's the right answer - not
+    # "bass lettuce" or "kale berry"
+    for words in ("basil lettuce", "kale strawberry"):
+        assert search_product(words, spelling=spelling, mode="all") == []
+
+
+def test_only_the_misspelled_word_is_fixed(spelling):
+    fixed = search_product("farm lettuse", spelling=spelling, mode="all")
+    assert fixed
+    assert product_ids(fixed) == product_ids(search_product("farm lettuce", mode="all"))
@@ -0,0 +1,52 @@
+"""
+A full load builds new tables in the "staging" schema and swaps them in
+(see the top of initdb.py). These run the real initdb.py - it reloads the
+same sheets, so the data is the same afterwards.
+"""
+import os
+import subprocess
+import sys
+
+from sqlalchemy import text
+
+from model import db
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+READER_ROLE = "farm_test_reader"
+
+
+def run_initdb(*arguments):
+    subprocess.run([sys.executable, "initdb.py", *arguments], cwd=REPO_DIR, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def test_swap_keeps_grants_and_everything_else_in_public(app):
+    # initdb.py waits for (then gives up on) tables we're still reading
+    db.session.remove()
+    engine = db.engine
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS public.not_ours"))
+        connection.execute(text(f"""
+            DO $$BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = '{READER_ROLE}') THEN
+                    CREATE ROLE {READER_ROLE};
+                END IF;
+            END$$"""))
+        connection.execute(text(f"GRANT SELECT ON public.product TO {READER_ROLE}"))
+        connection.execute(text(f"GRANT USAGE ON SEQUENCE public.product_id_seq TO {READER_ROLE}"))
+        connection.execute(text("CREATE TABLE public.not_ours (id integer)"))
+
+    try:
+        for arguments in ((), ("-rollback",)):
+            run_initdb(*arguments)
+            with engine.connect() as connection:
+                can_read = connection.execute(text(
+                    f"SELECT has_table_privilege('{READER_ROLE}', 'public.product', 'SELECT'), "
+                    f"has_sequence_privilege('{READER_ROLE}', 'public.product_id_seq', 'USAGE'), "
+                    f"to_regclass('public.not_ours') IS NOT NULL")).one()
+                assert tuple(can_read) == (True, True, True)
+    finally:
+        with engine.begin() as connection:
+            connection.execute(text("DROP TABLE IF EXISTS public.not_ours"))
+            connection.execute(text(f"DROP OWNED BY {READER_ROLE}"))
+            connection.execute(text(f"DROP ROLE {READER_ROLE}"))